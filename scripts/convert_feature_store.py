@@ -0,0 +1,49 @@
+"""
+Convert extracted features and targets (features_{split}.pt, targets_{split}.pt) to the memory-mapped feature store
+(features_{split}.npy + features_{split}.json, see sim_consistency.utils.feature_store).
+The tree is expected to be laid out as features_root/dataset/model_id.
+"""
+import argparse
+import glob
+import os
+
+from tqdm import tqdm
+
+from sim_consistency.utils.feature_store import convert_pt_store
+from project_location import FEATURES_ROOT
+
+
+def main(args):
+    pt_files = []
+    for split in args.split:
+        pattern = os.path.join(args.features_root, '**', f'features_{split}.pt')
+        pt_files.extend((fn, split) for fn in sorted(glob.glob(pattern, recursive=True)))
+    print(f"Found {len(pt_files)} feature files in {args.features_root}")
+
+    n_converted = 0
+    for fn, split in tqdm(pt_files, desc="Converting features to the feature store"):
+        model_dir = os.path.dirname(fn)
+        try:
+            converted = convert_pt_store(model_dir, split, remove=args.remove_pt)
+        except (RuntimeError, OSError) as e:
+            print(f'\nCould not convert {fn}. Skipping...')
+            print(f'>> Error: {e}\n')
+            continue
+        if converted:
+            n_converted += 1
+            print(f"Converted {', '.join(converted)} of the {split} split in {model_dir}")
+
+    print(f"Converted {n_converted} of {len(pt_files)} model directories.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features_root', default=FEATURES_ROOT,
+                        help='Root directory of the extracted features (features_root/dataset/model_id).')
+    parser.add_argument('--split', nargs='+', default=['train', 'test'],
+                        help='Split(s) whose features and targets are converted.')
+    parser.add_argument('--remove_pt', action='store_true',
+                        help='Remove the .pt files once the features and targets of a split are converted.')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,15 +1,27 @@
 import argparse
 import json
+import os
+import subprocess
 
 from helper import load_models, parse_datasets
 from project_location import DATASETS_ROOT, SUBSET_ROOT, FEATURES_ROOT, MODEL_SIM_ROOT
 from slurm import run_job
 
+from sim_consistency.tasks.model_similarity import group_metric_configs
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--models_config', type=str, default='./configs/models_config_wo_alignment.json')
 parser.add_argument('--datasets', type=str, nargs='+', default='./configs/webdatasets_w_insub10k.txt',
                     help="datasets can be a list of dataset names or a file (e.g., webdatasets.txt) containing "
                          "dataset names.")
+parser.add_argument('--sweep', action='store_true',
+                    help="Submit a single job per dataset that computes all metrics of the similarity metric config "
+                         "in one sweep (each feature file is read once), instead of one job per metric.")
+parser.add_argument('--num_shards', type=int, default=1,
+                    help="Split the model pairs of each dataset into balanced shards that run as separate array tasks, "
+                         "followed by a merge job that assembles the similarity matrices.")
+parser.add_argument('--local', action='store_true',
+                    help="Run the shards as local worker processes instead of submitting SLURM jobs.")
 args = parser.parse_args()
 
 MODELS_CONFIG = args.models_config
@@ -19,6 +31,59 @@ SIM_METRIC_CONFIG = "./configs/similarity_metric_config_local_global.json"
 with open(SIM_METRIC_CONFIG, "r") as file:
     sim_method_config = json.load(file)
 
+
+def submit(job_name, job_cmd, partition, num_jobs, mem):
+    """Submits one array task per dataset, or per dataset and shard followed by a merge job if sharding is used."""
+    if args.num_shards == 1:
+        run_job(job_name=job_name, job_cmd=job_cmd, partition=partition, log_dir=f'{MODEL_SIM_ROOT}/logs',
+                num_jobs_in_array=num_jobs, mem=mem)
+        return
+
+    shard_cmd = f"{job_cmd.strip()} --num_shards {args.num_shards}"
+    merge_cmd = f"{job_cmd.strip()} --task=model_similarity_merge"
+    if args.local:
+        for dataset_idx in range(num_jobs):
+            env = dict(os.environ, SLURM_ARRAY_JOB_ID='0', SLURM_ARRAY_TASK_ID=str(dataset_idx))
+            workers = [subprocess.Popen(f"{shard_cmd} --shard_index {shard_index}", shell=True, env=env)
+                       for shard_index in range(args.num_shards)]
+            for worker in workers:
+                worker.wait()
+            subprocess.run(merge_cmd, shell=True, env=env, check=True)
+        return
+
+    job_id = run_job(job_name=job_name, job_cmd=shard_cmd, partition=partition, log_dir=f'{MODEL_SIM_ROOT}/logs',
+                     num_jobs_in_array=num_jobs * args.num_shards, mem=mem)
+    run_job(job_name=f"{job_name}Merge", job_cmd=merge_cmd, partition='cpu-2d', log_dir=f'{MODEL_SIM_ROOT}/logs',
+            num_jobs_in_array=num_jobs, mem=mem, depends_on=[job_id])
+
+
+def get_metric_args(config):
+    """
+    Command line arguments of the jobs of a metric config grouped by `group_metric_configs`, e.g., one job for all
+    sigmas of rbf CKA. SVD based metrics are not grouped on the command line, hence they yield one job per method.
+    """
+    config = dict(config)
+    sim_method = config.pop('sim_method')
+    if sim_method == 'svd':
+        methods = config.pop('svd_methods')
+        return [(method, get_metric_args(dict(config, sim_method=method))[0][1]) for method in methods]
+    args_list = [f"--sim_method {sim_method}"]
+    for key, value in config.items():
+        if key == 'kernel':
+            args_list.append(f"--sim_kernel {value}")
+        elif key == 'unbiased':
+            if not value:
+                args_list.append("--biased_cka")
+        elif isinstance(value, bool):
+            if value:
+                args_list.append(f"--{key}")
+        elif isinstance(value, list):
+            args_list.append(f"--{key} {' '.join(str(v) for v in value)}")
+        elif value is not None:
+            args_list.append(f"--{key} {value}")
+    return [(sim_method, ' '.join(args_list))]
+
+
 if __name__ == "__main__":
     # Retrieve the configuration of all models we intend to evaluate.
     models, n_models = load_models(MODELS_CONFIG)
@@ -29,11 +94,8 @@ if __name__ == "__main__":
 
     datasets = ' '.join(DATASETS)
 
-    for exp_dict in sim_method_config:
-        print(f"Computing model similarity matrix with config:\n{json.dumps(exp_dict, indent=4)}")
-
-        max_workers = 8
-
+    if args.sweep:
+        print(f"Computing model similarity matrices for all configs in {SIM_METRIC_CONFIG} in one sweep.")
         job_cmd = f"""export XLA_PYTHON_CLIENT_PREALLOCATE=false && \
                       export XLA_PYTHON_CLIENT_ALLOCATOR=platform && \
                       sim_consistency --dataset {datasets} \
@@ -44,23 +106,40 @@ if __name__ == "__main__":
                                       --model_key {model_keys} \
                                       --models_config_file {MODELS_CONFIG} \
                                       --train_split train \
-                                      --sim_method {exp_dict['sim_method']} \
-                                      --sim_kernel {exp_dict['sim_kernel']} \
-                                      --rsa_method {exp_dict['rsa_method']} \
-                                      --corr_method {exp_dict['corr_method']} \
-                                      --sigma {exp_dict['sigma']} \
-                                      --max_workers {max_workers} \
+                                      --sim_metric_config {SIM_METRIC_CONFIG} \
+                                      --max_workers 8 \
                                       --use_ds_subset \
-                                      --subset_root {SUBSET_ROOT}
+                                      --subset_root {SUBSET_ROOT} \
+                                      --cache_root {MODEL_SIM_ROOT}/cache
                         """
-        partition = 'gpu-2d' if exp_dict['sim_method'] == 'cka' else 'cpu-2d'
-        mem = 150
-
-        run_job(
-            job_name=f"{exp_dict['sim_method'].capitalize()}",
-            job_cmd=job_cmd,
-            partition=partition,
-            log_dir=f'{MODEL_SIM_ROOT}/logs',
-            num_jobs_in_array=num_jobs,
-            mem=mem
-        )
+        partition = 'gpu-2d' if any(exp_dict['sim_method'] == 'cka' for exp_dict in sim_method_config) else 'cpu-2d'
+        submit(job_name="Sweep", job_cmd=job_cmd, partition=partition, num_jobs=num_jobs, mem=150)
+        exit(0)
+
+    for config in group_metric_configs(sim_method_config):
+        print(f"Computing model similarity matrix with config:\n{json.dumps(config, indent=4)}")
+
+        max_workers = 8
+
+        for sim_method, metric_args in get_metric_args(config):
+            job_cmd = f"""export XLA_PYTHON_CLIENT_PREALLOCATE=false && \
+                          export XLA_PYTHON_CLIENT_ALLOCATOR=platform && \
+                          sim_consistency --dataset {datasets} \
+                                          --dataset_root {DATASETS_ROOT} \
+                                          --feature_root {FEATURES_ROOT} \
+                                          --output {MODEL_SIM_ROOT} \
+                                          --task=model_similarity \
+                                          --model_key {model_keys} \
+                                          --models_config_file {MODELS_CONFIG} \
+                                          --train_split train \
+                                          {metric_args} \
+                                          --max_workers {max_workers} \
+                                          --use_ds_subset \
+                                          --subset_root {SUBSET_ROOT} \
+                                          --cache_root {MODEL_SIM_ROOT}/cache
+                            """
+            partition = 'gpu-2d' if sim_method == 'cka' else 'cpu-2d'
+            mem = 150
+
+            submit(job_name=f"{sim_method.capitalize()}", job_cmd=job_cmd, partition=partition, num_jobs=num_jobs,
+                   mem=mem)
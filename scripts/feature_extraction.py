@@ -8,6 +8,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--models_config', type=str, default='./configs/models_config_wo_alignment.json')
 parser.add_argument('--datasets', type=str, nargs='+', default='./configs/webdatasets_w_in1k.txt',
                     help="datasets can be a list of dataset names or a file (e.g., webdatasets.txt) containing dataset names.")
+parser.add_argument('--models_per_job', type=int, default=1,
+                    help="Number of models per job. The models of a job that share the preprocessing are extracted "
+                         "from one pass over the data (--mode combined_models).")
 args = parser.parse_args()
 
 MODELS_CONFIG = args.models_config
@@ -21,15 +24,19 @@ if __name__ == "__main__":
     model_keys = list(models.keys())
 
     # Extract features for all models and datasets.
-    for key in model_keys:
-        print(f"Running feature extraction for {key}")
+    for start in range(0, len(model_keys), args.models_per_job):
+        keys = model_keys[start:start + args.models_per_job]
+        mode = "combined_models" if len(keys) > 1 else "single_model"
+        job_name = f"feat_extr_{keys[0]}" if len(keys) == 1 else f"feat_extr_{keys[0]}_{len(keys)}_models"
+        print(f"Running feature extraction for {' '.join(keys)}")
         job_cmd = f"""export XLA_PYTHON_CLIENT_PREALLOCATE=false && \
         export XLA_PYTHON_CLIENT_ALLOCATOR=platform && \
         sim_consistency --dataset {DATASETS} \
                         --dataset_root {DATASETS_ROOT} \
                         --feature_root {FEATURES_ROOT} \
                         --task=feature_extraction \
-                        --model_key {key} \
+                        --mode={mode} \
+                        --model_key {' '.join(keys)} \
                         --models_config_file {MODELS_CONFIG} \
                         --batch_size=64 \
                         --train_split train \
@@ -38,7 +45,7 @@ if __name__ == "__main__":
         """
 
         run_job(
-            job_name=f"feat_extr_{key}",
+            job_name=job_name,
             job_cmd=job_cmd,
             partition='gpu-2d',
             log_dir=f'{FEATURES_ROOT}/logs',
@@ -7,9 +7,9 @@ import json
 import os
 
 import numpy as np
-import torch
 from tqdm import tqdm
 
+from sim_consistency.utils.feature_store import write_store
 from sim_consistency.utils.utils import load_features_targets
 from helper import load_models, format_path
 from project_location import FEATURES_ROOT, SUBSET_ROOT
@@ -50,8 +50,8 @@ def main(args):
             os.makedirs(feature_dir)
             print(f'Created directory {feature_dir}')
 
-        torch.save(features_subset, os.path.join(feature_dir, f'features_{args.split}.pt'))
-        torch.save(targets_subset, os.path.join(feature_dir, f'targets_{args.split}.pt'))
+        write_store(feature_dir, 'features', args.split, features_subset)
+        write_store(feature_dir, 'targets', args.split, targets_subset)
         print(f'Saved {args.split} features and targets  for model {model_id} to {feature_dir}')
         print()
 
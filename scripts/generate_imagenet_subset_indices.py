@@ -4,9 +4,9 @@ import os
 import random
 
 import numpy as np
-import torch
 from tqdm import tqdm
 
+from sim_consistency.utils.utils import has_array, load_targets
 from helper import format_path
 from project_location import FEATURES_ROOT, SUBSET_ROOT
 
@@ -14,13 +14,13 @@ from project_location import FEATURES_ROOT, SUBSET_ROOT
 def main(args):
     random.seed(args.seed)
 
-    targets_fn = os.path.join(args.imagenet_targets_root, f'targets_{args.split}.pt')
-    if not os.path.exists(targets_fn):
-        raise FileNotFoundError(f'Targets file not found at {targets_fn}. Please provide the path to the result of the'
-                                f' extraction process of any model on ImageNet1k (dataset `wds/imagenet1k`). The '
-                                f'targets of the extraction process are the same for all models, so you can use any '
-                                f'model\'s ')
-    targets = np.array(torch.load(targets_fn))
+    if not has_array(args.imagenet_targets_root, 'targets', args.split):
+        raise FileNotFoundError(f'Targets of the {args.split} split (targets_{args.split}.npy or '
+                                f'targets_{args.split}.pt) not found in {args.imagenet_targets_root}. Please provide '
+                                f'the feature directory of any model extracted on ImageNet1k (dataset '
+                                f'`wds/imagenet1k`). The targets of the extraction process are the same for all '
+                                f'models, so you can use any model\'s directory.')
+    targets = np.asarray(load_targets(args.imagenet_targets_root, split=args.split))
 
     unique_classes = np.unique(targets)
 
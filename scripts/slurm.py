@@ -10,7 +10,8 @@ def run_job(
         slurm_args=None,
         log_dir='./logs',
         num_jobs_in_array=1,
-        mem=32
+        mem=32,
+        depends_on=None
 ):
     if apptainer:
         raise NotImplementedError("No apptainer container available for now.")
@@ -54,4 +55,4 @@ def run_job(
     }
     slurm_options["time"] = time_mapping[time]
     s = Slurm(job_name, slurm_options)
-    s.run(submit_cmd)
+    return s.run(submit_cmd, depends_on=depends_on)
@@ -33,6 +33,9 @@ def get_parser_args() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
             "if it doesn't predefined.")
     aa('--wds_cache_dir', default=None, type=str,
        help="optional cache directory for webdataset only")
+    aa('--image_cache_root', default=None, type=str,
+       help="optional cache root for the decoded and resized images (uint8) of each dataset split. The images are "
+            "cached once per preprocessing, s.t. feature extraction runs only apply the normalization.")
 
     # FEATURES
     aa('--feature_root', default="features", type=str,
@@ -50,12 +53,13 @@ def get_parser_args() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
 
     # TASKS
     aa('--task', type=str, default="linear_probe",
-       choices=["feature_extraction", "linear_probe", "model_similarity"],
+       choices=["feature_extraction", "linear_probe", "model_similarity", "model_similarity_merge"],
        help="Task to evaluate on. With --task=auto, the task is automatically inferred from the "
             "dataset.")
     aa('--mode', type=str, default="single_model",
        choices=["single_model", "combined_models", "ensemble"],
-       help="Mode to use for linear probe task.")
+       help="Mode to use for linear probe task. For feature extraction, combined_models extracts the features of "
+            "all models with the same preprocessing from one pass over the data.")
     aa('--feature_combiner', type=str, default="concat",
        choices=['concat', 'concat_pca'], help="Feature combiner to use")
 
@@ -83,7 +87,8 @@ def get_parser_args() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
 
     ### Model similarity
     aa('--sim_method', type=str, default="cka",
-       choices=['cka', 'rsa'], help="Method to use for model similarity task.")
+       choices=['cka', 'rsa', 'gw', 'knn', 'svcca', 'pwcca', 'procrustes'],
+       help="Method to use for model similarity task.")
     aa('--sim_kernel', type=str, default="linear",
        choices=['linear', 'rbf'], help="Kernel used during CKA. Ignored if sim_method is rsa.")
     aa('--rsa_method', type=str, default="correlation",
@@ -92,9 +97,114 @@ def get_parser_args() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
     aa('--corr_method', type=str, default="spearman",
        choices=['pearson', 'spearman'],
        help="Kernel used during CKA. Ignored if sim_method is cka.")
-    aa('--sigma', type=float, default=None, help="sigma for CKA rbf kernel.")
+    aa('--sigma', type=float, default=None, nargs='+',
+       help="sigma(s) for CKA rbf kernel. Multiple values are computed in one pass and stored separately.")
+    aa('--rsa_engine', type=str, default="batched", choices=['batched', 'pairwise', 'blockwise'],
+       help="Engine used for RSA. 'batched' standardizes each RDM once and correlates all pairs via chunked matrix "
+            "products, 'pairwise' correlates the RDMs pair by pair. 'blockwise' is the out-of-core version of "
+            "'batched': RDMs are written, ranked and correlated in memory-mapped chunks sized by --memory_budget_gb.")
+    aa('--gw_solver', type=str, default="exact", choices=['exact', 'entropic', 'sampled'],
+       help="Solver used for Gromov-Wasserstein. 'entropic' uses projected gradients with Sinkhorn projections, "
+            "'sampled' estimates the gradients from sampled indices (for large numbers of samples).")
+    aa('--gw_cost_fun', type=str, default="euclidian", choices=['euclidian', 'cosine'],
+       help="Cost function of the (max-normalized) intra-model cost matrices used for Gromov-Wasserstein.")
+    aa('--gw_loss_fun', type=str, default="square_loss", choices=['square_loss', 'kl_loss'],
+       help="Loss function used for Gromov-Wasserstein.")
+    aa('--gw_epsilon', type=float, default=0.05,
+       help="Entropic regularization of the 'entropic' and 'sampled' Gromov-Wasserstein solvers, relative to the "
+            "product of the standard deviations of both cost matrices. Much larger values (e.g., 0.3) converge to "
+            "almost uniform couplings.")
+    aa('--gw_nb_samples_grad', type=int, default=100,
+       help="Number of sampled indices per gradient step of the 'sampled' Gromov-Wasserstein solver (at most the "
+            "number of samples).")
+    aa('--gw_fixed_coupling', action="store_true",
+       help="Evaluate the Gromov-Wasserstein loss of the identity coupling instead of optimizing the coupling.")
+    aa('--store_coupling', action="store_true",
+       help="Store the Gromov-Wasserstein couplings of all model pairs in one container per dataset "
+            "(gw_couplings.bin/.json next to the similarity matrices).")
+    aa('--coupling_top_k', type=int, default=32,
+       help="Number of largest entries per row that are stored for each coupling matrix (as float16).")
+    aa('--knn_k', type=int, default=[10], nargs='+',
+       help="Neighbourhood size(s) of the kNN similarity. All values share one kNN graph per model.")
+    aa('--knn_metric', type=str, default="cosine", choices=['cosine', 'euclidean'],
+       help="Distance used to build the kNN graphs.")
+    aa('--knn_index', type=str, default="exact", choices=['exact', 'faiss'],
+       help="Build the kNN graphs exactly (blockwise) or approximately with a faiss HNSW index (requires faiss).")
+    aa('--knn_measure', type=str, default="mutual_knn", choices=['mutual_knn', 'jaccard'],
+       help="Overlap of the k-neighbourhoods: fraction of shared neighbours or Jaccard index.")
+    aa('--svd_variance_threshold', type=float, default=0.99,
+       help="Fraction of the variance kept by the truncated SVD of each model for SVCCA, PWCCA and Procrustes.")
+    aa('--cache_root', type=str, default=None,
+       help="Directory for persistent on-disk caches of the similarity computation (e.g., RDMs), "
+            "which are reused across model pairs, runs, and metrics. No on-disk caching if not provided.")
+    aa('--sim_metric_config', type=str, default=None,
+       help="Path to a similarity metric config file (e.g., scripts/configs/similarity_metric_config_all.json). "
+            "If provided, all metrics of the file are computed in one sweep that reads each feature file once, "
+            "and --sim_method, --sim_kernel, --rsa_method, --corr_method, and --sigma are ignored.")
+    aa('--cka_engine', type=str, default="auto",
+       choices=['auto', 'gram', 'feature', 'batched', 'minibatch', 'rff', 'nystroem', 'blockwise'],
+       help="Engine used for CKA. 'gram' compares cached N x N gram matrices pair by pair, 'feature' compares "
+            "D x D cross-covariances pair by pair, and 'batched' computes all pairs from one blocked matrix product "
+            "over the stacked features ('feature' and 'batched' for the linear kernel only). 'auto' works in "
+            "feature space if the feature dimension is much smaller than the number of samples. 'minibatch' "
+            "averages the HSIC over random minibatches streamed from the feature files (bounded memory for very "
+            "large N, stored under a separate method slug). 'rff' and 'nystroem' approximate the rbf kernel by "
+            "random Fourier features or Nystroem landmarks and compare them like linear features (rbf kernel only, "
+            "stored under a separate method slug). 'blockwise' computes the exact CKA out-of-core from N x N "
+            "gram matrices in memory-mapped scratch files, in row blocks sized by --memory_budget_gb.")
+    aa('--approx_rank', type=int, default=2048,
+       help="Number of random Fourier features or Nystroem landmarks of the approximate rbf CKA engines.")
+    aa('--approx_validation_size', type=int, default=500,
+       help="Number of samples on which the approximate rbf CKA is compared to the exact one (0 to skip).")
+    aa('--minibatch_size', type=int, default=1024, help="Minibatch size of the minibatch CKA engine.")
+    aa('--n_minibatches', type=int, default=100,
+       help="Number of minibatches of the minibatch CKA engine. The minibatches are drawn with the first --seed.")
+    aa('--bootstrap', type=int, default=0,
+       help="Number of bootstrap resamples of the samples for confidence intervals of the similarity matrix (0 to "
+            "skip). Resamples index the gram matrices (CKA) or RDMs (RSA) of the full data, the intervals are stored "
+            "in bootstrap.pt next to the similarity matrix. Resamples are drawn with the first --seed.")
+    aa('--bootstrap_confidence', type=float, default=0.95,
+       help="Coverage of the bootstrap percentile intervals.")
+    aa('--curve_sizes', type=int, default=None, nargs='+',
+       help="Sample sizes of nested random subsets (e.g., 1000 5000 10000). If provided, the similarity of all model "
+            "pairs is computed for every size in one pass (CKA and RSA), with the statistics updated incrementally as "
+            "samples are added, and stored as a tidy table in similarity_curve.csv instead of the similarity matrix. "
+            "The subsets are drawn with the first --seed.")
+    aa('--sim_dtype', type=str, default="float32", choices=['float32', 'float64'],
+       help="Compute dtype of the similarity computation. Features are converted to it regardless of their stored "
+            "dtype, reductions (HSIC, centering, RDM correlations) are accumulated in float64.")
+    aa('--sim_storage_dtype', type=str, default=None, choices=['float32', 'float16', 'bfloat16'],
+       help="Storage dtype of cached gram matrices (CKA) and RDMs (RSA, float16 only). Half precision halves their "
+            "memory and bandwidth. Defaults to --sim_dtype.")
+    aa('--validate_precision', type=int, default=0,
+       help="Number of samples on which the similarity matrices computed with --sim_dtype and --sim_storage_dtype "
+            "are compared to a float64 reference before the computation (0 to skip).")
     aa('--biased_cka', action="store_false", dest="unbiased", help="use biased CKA")
     aa('--max_workers', type=int, default=4, help="Number of threads allowed during matrix computation.")
+    aa('--cache_size_gb', type=float, default=32.,
+       help="Memory budget (in GB) for caching per-model kernels during similarity computation. "
+            "Least recently used entries are evicted if the budget is exceeded.")
+    aa('--memory_budget_gb', type=float, default=None,
+       help="Memory budget (in GB) of the out-of-core 'blockwise' CKA and RSA engines, from which their block sizes "
+            "are derived. Defaults to --cache_size_gb.")
+    aa('--scratch_root', type=str, default=None,
+       help="Directory for the memory-mapped scratch files of the 'blockwise' engines (N x N float32 per model for "
+            "CKA), removed after the computation. Defaults to the system's temporary directory.")
+    aa('--recompute_sim', action="store_true",
+       help="Recompute all model pairs. Otherwise, pairs of existing similarity matrices in the output folder are "
+            "reused if their models, features, and metric are unchanged, and only the missing pairs are computed. "
+            "Recomputed pairs are journaled separately, a restarted recompute job (or the merge of its shards, also "
+            "run with --recompute_sim) only reuses these.")
+    aa('--checkpoint_interval', type=float, default=60.,
+       help="Interval (in seconds) in which computed model pairs are flushed to the journal in the output folder. "
+            "A restarted job resumes from the journal.")
+    aa('--num_shards', type=int, default=1,
+       help="Split the model pairs of each dataset into balanced shards. The array task with id t computes shard "
+            "t %% num_shards of dataset t // num_shards and journals its pairs in the output folder. Run "
+            "--task model_similarity_merge afterwards (one array task per dataset) to assemble the matrices.")
+    aa('--shard_index', type=int, default=None,
+       help="Compute only this shard of the dataset selected by SLURM_ARRAY_TASK_ID (e.g., for local workers), "
+            "instead of deriving the shard from the array task id.")
     aa('--use_ds_subset', action="store_true", help="Compute model similarities on precomputed subset of the dataset.")
     aa('--subset_root', type=str, help="Path to the root folder where the dataset subset indices are stored. "
                                        "Only used if use_ds_subset is True.")
@@ -1,3 +1,4 @@
+import json
 import os
 import random
 import sys
@@ -10,8 +11,11 @@ import torch
 from sim_consistency.argparser import get_parser_args, prepare_args, prepare_combined_args, load_model_configs_args
 from sim_consistency.data import (get_feature_combiner_cls)
 from sim_consistency.data.builder import get_dataset_class_filter
-from sim_consistency.data.data_utils import get_extraction_model_n_dataloader
-from sim_consistency.tasks import compute_sim_matrix
+from sim_consistency.data.data_utils import get_extraction_model_groups, get_extraction_model_n_dataloader
+from sim_consistency.models.featurizer import Featurizer, extract_features
+from sim_consistency.tasks import (compute_bootstrap_sim_matrices, compute_sim_matrices,
+                                   compute_sim_matrices_from_config, compute_similarity_curves, save_bootstrap_results,
+                                   save_similarity_curves, save_similarity_results, validate_sim_precision)
 from sim_consistency.tasks.linear_probe_evaluator import (SingleModelEvaluator, CombinedModelEvaluator,
                                                           EnsembleModelEvaluator)
 from sim_consistency.utils.path_maker import PathMaker
@@ -30,7 +34,7 @@ def main():
     base = load_model_configs_args(base)
 
     try:
-        if base.task == "model_similarity":
+        if base.task in ["model_similarity", "model_similarity_merge"]:
             main_model_sim(base)
         else:
             main_eval(base)
@@ -53,7 +57,21 @@ def main_model_sim(base):
     # Get list of data to evaluate on
     datasets = get_list_of_datasets(base)
 
-    dataset = datasets[int(os.environ["SLURM_ARRAY_TASK_ID"])]
+    task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    merge = base.task == "model_similarity_merge"
+    shard = None
+    if base.num_shards > 1 and not merge:
+        # Each dataset is split into `num_shards` array tasks, unless the shard is given explicitly
+        if base.shard_index is None:
+            task_id, shard_index = divmod(task_id, base.num_shards)
+        else:
+            shard_index = base.shard_index
+        shard = (shard_index, base.num_shards)
+        if base.bootstrap > 0 or base.curve_sizes is not None:
+            raise ValueError("Bootstrap intervals and similarity curves are computed for all model pairs at once, "
+                             "they are not supported with --num_shards > 1.")
+
+    dataset = datasets[task_id]
     dataset_name = prepare_ds_name(dataset)
 
     train_split = base.train_split
@@ -62,35 +80,146 @@ def main_model_sim(base):
 
     feature_root = os.path.join(base.feature_root, dataset_name)
     subset_root = os.path.join(base.subset_root, dataset_name) if base.use_ds_subset else None
+    # GW coupling matrices are stored next to the similarity matrices
+    coupling_root = os.path.join(base.output_root, dataset_name)
+    # Pairs of existing results are reused, s.t. only pairs of new (or changed) models are computed. Recomputed pairs
+    # are journaled there as well, s.t. a restarted recompute job resumes from its own journal.
+    results_root = coupling_root
+
+    # Options shared by all similarity metrics
+    sim_kwargs = dict(
+        subset_root=subset_root,
+        backend='torch',
+        device=base.device,
+        max_workers=base.max_workers,
+        cache_size_gb=base.cache_size_gb,
+        cka_engine=base.cka_engine,
+        cache_root=base.cache_root,
+        rsa_engine=base.rsa_engine,
+        store_coupling=base.store_coupling,
+        coupling_root=coupling_root,
+        coupling_top_k=base.coupling_top_k,
+        minibatch_size=base.minibatch_size,
+        n_minibatches=base.n_minibatches,
+        approx_rank=base.approx_rank,
+        approx_validation_size=base.approx_validation_size,
+        compute_dtype=base.sim_dtype,
+        storage_dtype=base.sim_storage_dtype,
+        memory_budget_gb=base.memory_budget_gb,
+        scratch_root=base.scratch_root,
+        seed=base.seed[0],
+    )
+    # Options of the incremental (and sharded) computation
+    run_kwargs = dict(
+        results_root=results_root,
+        checkpoint_interval=base.checkpoint_interval,
+        shard=shard,
+        merge=merge,
+        recompute=base.recompute_sim,
+    )
+
+    # Options of the metric if no similarity metric config is given
+    metric_kwargs = dict(
+        sim_method=base.sim_method,
+        kernel=base.sim_kernel,
+        rsa_method=base.rsa_method,
+        corr_method=base.corr_method,
+        unbiased=base.unbiased,
+        sigma=base.sigma,
+        gw_solver=base.gw_solver,
+        gw_cost_fun=base.gw_cost_fun,
+        gw_loss_fun=base.gw_loss_fun,
+        gw_epsilon=base.gw_epsilon,
+        gw_nb_samples_grad=base.gw_nb_samples_grad,
+        gw_fixed_coupling=base.gw_fixed_coupling,
+        knn_k=base.knn_k,
+        knn_metric=base.knn_metric,
+        knn_index=base.knn_index,
+        knn_measure=base.knn_measure,
+        svd_variance_threshold=base.svd_variance_threshold,
+    )
+
+    if base.sim_metric_config is not None and (base.bootstrap > 0 or base.curve_sizes is not None
+                                               or base.validate_precision > 0):
+        raise ValueError("Bootstrap intervals, similarity curves and precision validation are not supported for "
+                         "sweeps over a similarity metric config.")
+    if (base.bootstrap > 0 or base.curve_sizes is not None) and base.sim_method not in ['cka', 'rsa']:
+        raise ValueError(f"Bootstrap intervals and similarity curves are only available for CKA and RSA, not for "
+                         f"{base.sim_method}.")
+    if base.validate_precision > 0 and base.sim_method == 'gw':
+        raise ValueError("Precision validation is not available for GW, its compute precision is fixed by the solver.")
+
+    if base.validate_precision > 0 and not merge:
+        validate_sim_precision(feature_root=feature_root,
+                               model_ids=model_ids,
+                               split=train_split,
+                               n_samples=base.validate_precision,
+                               **metric_kwargs,
+                               **sim_kwargs)
+
+    if base.curve_sizes is not None:
+        # Similarity of nested subsets of all sizes in one pass, stored as one tidy table per metric
+        curves = compute_similarity_curves(feature_root=feature_root,
+                                           model_ids=model_ids,
+                                           split=train_split,
+                                           sizes=base.curve_sizes,
+                                           **metric_kwargs,
+                                           **sim_kwargs)
+        for method_slug, metric_curves in curves.groupby('metric', sort=False):
+            out_path = os.path.join(base.output_root, dataset_name, method_slug)
+            if base.verbose:
+                print(f"\nDump {method_slug} similarity curve to: {os.path.join(out_path, 'similarity_curve.csv')}\n")
+            save_similarity_curves(out_path, metric_curves)
+        return 0
 
-    # Compute CKA matrix
-    sim_matrix, model_ids, method_slug = compute_sim_matrix(sim_method=base.sim_method,
-                                                            feature_root=feature_root,
-                                                            model_ids=model_ids,
-                                                            split=train_split,
-                                                            subset_root=subset_root,
-                                                            kernel=base.sim_kernel,
-                                                            rsa_method=base.rsa_method,
-                                                            corr_method=base.corr_method,
-                                                            backend='torch',
-                                                            unbiased=base.unbiased,
-                                                            device=base.device,
-                                                            sigma=base.sigma,
-                                                            max_workers=base.max_workers)
-    # Save the similarity matrix
-    out_path = os.path.join(base.output_root, dataset_name, method_slug)
-    if not os.path.exists(out_path):
-        os.makedirs(out_path, exist_ok=True)
+    if base.sim_metric_config is not None:
+        # Compute all metrics of the config file in one sweep, s.t. each feature file is only read once
+        with open(base.sim_metric_config, "r") as f:
+            metric_configs = json.load(f)
+        sim_matrices, model_ids, pair_keys = compute_sim_matrices_from_config(metric_configs=metric_configs,
+                                                                              feature_root=feature_root,
+                                                                              model_ids=model_ids,
+                                                                              split=train_split,
+                                                                              verbose=base.verbose,
+                                                                              **sim_kwargs,
+                                                                              **run_kwargs)
+    else:
+        # Compute similarity matrices (several matrices if multiple sigmas are provided for the rbf kernel)
+        sim_matrices, model_ids, pair_keys = compute_sim_matrices(feature_root=feature_root,
+                                                                  model_ids=model_ids,
+                                                                  split=train_split,
+                                                                  **metric_kwargs,
+                                                                  **sim_kwargs,
+                                                                  **run_kwargs)
+    if shard is not None:
         if base.verbose:
-            print(f'\nCreated path ({out_path}), where results are to be stored ...\n')
+            print(f"\nFinished shard {shard[0]} of {shard[1]} for {dataset_name}. Merge the shards with "
+                  f"--task model_similarity_merge.\n")
+        return 0
 
-    out_res = os.path.join(out_path, f'similarity_matrix.pt')
-    if base.verbose:
-        print(f"\nDump {base.sim_method.upper()} matrix to: {out_res}\n")
-    torch.save(sim_matrix, out_res)
-    with open(os.path.join(out_path, f'model_ids.txt'), "w") as file:
-        for string in model_ids:
-            file.write(string + "\n")
+    for method_slug, sim_matrix in sim_matrices.items():
+        # Save the similarity matrix
+        out_path = os.path.join(base.output_root, dataset_name, method_slug)
+        if not os.path.exists(out_path) and base.verbose:
+            print(f'\nCreated path ({out_path}), where results are to be stored ...\n')
+        if base.verbose:
+            print(f"\nDump {method_slug} matrix to: {os.path.join(out_path, 'similarity_matrix.pt')}\n")
+        save_similarity_results(out_path, sim_matrix, model_ids, pair_keys[method_slug])
+
+    if base.bootstrap > 0 and not merge:
+        # Bootstrap intervals reuse the gram matrices / RDMs of each model and are stored next to the matrices
+        bootstrap, model_ids = compute_bootstrap_sim_matrices(feature_root=feature_root,
+                                                              model_ids=model_ids,
+                                                              split=train_split,
+                                                              n_resamples=base.bootstrap,
+                                                              confidence=base.bootstrap_confidence,
+                                                              **metric_kwargs,
+                                                              **sim_kwargs)
+        for method_slug, summary in bootstrap.items():
+            out_path = os.path.join(base.output_root, dataset_name, method_slug)
+            if base.verbose:
+                print(f"\nDump {method_slug} bootstrap intervals to: {os.path.join(out_path, 'bootstrap.pt')}\n")
+            save_bootstrap_results(out_path, summary, model_ids)
 
     return 0
 
@@ -198,7 +327,26 @@ def run(args):
 
     base_kwargs = get_base_evaluator_args(args, feature_dirs, model_dirs, results_dir)
 
-    if task == 'feature_extraction':
+    if task == 'feature_extraction' and mode == 'combined_models':
+        # Models with the same preprocessing share one decoded pass over the data
+        missing = [i for i, feature_dir in enumerate(feature_dirs)
+                   if not SingleModelEvaluator.check_feature_existence(feature_dir, verbose=args.verbose)]
+        if args.verbose:
+            print(f"\nExtracting features for {[model_ids[i] for i in missing]} on {dataset_name} ...\n")
+        if missing:
+            model_groups = get_extraction_model_groups(args, dataset_root, model_indices=missing)
+            for indices, models, train_dataloader, eval_dataloader in model_groups:
+                featurizers = [Featurizer(model=model, normalize=args.normalize).to(args.device) for model in models]
+                extract_features(featurizers=featurizers,
+                                 train_dataloader=train_dataloader,
+                                 eval_dataloader=eval_dataloader,
+                                 feature_dirs=[feature_dirs[i] for i in indices],
+                                 device=args.device)
+
+        if args.verbose:
+            print(f"\nFinished feature extraction for {model_ids} on {dataset_name} ...\n")
+
+    elif task == 'feature_extraction':
         model, train_dataloader, eval_dataloader = get_extraction_model_n_dataloader(args, dataset_root, task)
         evaluator = SingleModelEvaluator(
             model=model,
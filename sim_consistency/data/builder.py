@@ -1,3 +1,4 @@
+import itertools
 import os
 import re
 import warnings
@@ -125,6 +126,37 @@ def has_kaggle():
     return call("which kaggle", shell=True) == 0
 
 
+class SkipSamples:
+    """
+    Webdataset pipeline stage skipping the first `skips[worker]` samples read by each dataloader worker, e.g., to
+    resume an interrupted feature extraction. It is placed before the decoding, s.t. skipped samples are only read
+    from the shards. As the dataloader fetches batches round-robin starting at the first worker, the shards are split
+    across the workers (see `split_by_worker`) as if the worker `first_worker` were the first one. Set `skips` and
+    `first_worker` before the dataloader is iterated (None reads all samples).
+    """
+
+    def __init__(self):
+        self.skips = None
+        self.first_worker = 0
+
+    def _worker(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return 0, 1
+        first_worker = self.first_worker if self.skips else 0
+        return (worker_info.id + first_worker) % worker_info.num_workers, worker_info.num_workers
+
+    def split_by_worker(self, src):
+        worker, num_workers = self._worker()
+        yield from itertools.islice(src, worker, None, num_workers)
+
+    def __call__(self, src):
+        if not self.skips:
+            yield from src
+            return
+        yield from itertools.islice(src, self.skips[self._worker()[0]], None)
+
+
 def build_wds_dataset(transform, split="test", data_dir="root", cache_dir=None, selector_fn=None,
                       label_map=None):
     """
@@ -191,16 +223,21 @@ def build_wds_dataset(transform, split="test", data_dir="root", cache_dir=None,
     # Load webdataset (support WEBP, PNG, and JPG for now)
     if not cache_dir or not isinstance(cache_dir, str):
         cache_dir = None
+    skip_stage = SkipSamples()
     if selector_fn is None:
         dataset = (
-            wds.WebDataset(filepattern, cache_dir=cache_dir, nodesplitter=lambda src: src)
+            wds.WebDataset(filepattern, cache_dir=cache_dir, nodesplitter=lambda src: src,
+                          workersplitter=skip_stage.split_by_worker).compose(skip_stage)
             .decode(wds.autodecode.ImageHandler("pil", extensions=["webp", "png", "jpg", "jpeg"]))
         )
     else:
         dataset = (
-            wds.WebDataset(filepattern, cache_dir=cache_dir, nodesplitter=lambda src: src).select(selector_fn)
+            wds.WebDataset(filepattern, cache_dir=cache_dir, nodesplitter=lambda src: src,
+                          workersplitter=skip_stage.split_by_worker).select(selector_fn)
+            .compose(skip_stage)
             .decode(wds.autodecode.ImageHandler("pil", extensions=["webp", "png", "jpg", "jpeg"]))
         )
+    dataset.skip_stage = skip_stage
     # Load based on classification or retrieval task
     if dataset_type == "retrieval":
         dataset = (dataset
@@ -1,8 +1,11 @@
 import numpy as np
 import torch
-from torch.utils.data import Subset
+from torch.utils.data import Subset, default_collate
 
 from sim_consistency.data import build_dataset, get_dataset_collate_fn
+from sim_consistency.data.image_cache import (ImageCacheDataset, ToUint8Tensor, build_image_cache,
+                                              get_image_cache_dir, get_transform_key, has_image_cache,
+                                              split_transform)
 from sim_consistency.models import load_model
 
 
@@ -49,6 +52,56 @@ def get_extraction_model_n_dataloader(args, dataset_root, task):
         feature_alignment=args.feature_alignment,
         device=args.device
     )
+    train_dataloader, eval_dataloader = get_extraction_dataloaders(args, dataset_root, transform)
+    return model, train_dataloader, eval_dataloader
+
+
+def get_extraction_model_groups(args, dataset_root, model_indices=None):
+    """
+    Loads the models (all models of the combined args, or the ones of `model_indices`) and groups them by their
+    preprocessing (the `get_transformations` output), s.t. the images of each group are decoded once and fed through
+    all of its models. Models whose transform cannot be identified (see `get_transform_key`) get a group of their own.
+    Returns the model indices, the models and the dataloaders of each group.
+    """
+    if model_indices is None:
+        model_indices = list(range(len(args.model)))
+    groups = {}
+    for i in model_indices:
+        if args.verbose:
+            print(f"Load model {args.model_key[i]} and use "
+                  f"{'no' if args.feature_alignment[i] is None else args.feature_alignment[i]} feature alignment",
+                  flush=True)
+        model, transform = load_model(
+            model_name=args.model[i],
+            source=args.model_source[i],
+            model_parameters=args.model_parameters[i],
+            module_name=args.module_name[i],
+            feature_alignment=args.feature_alignment[i],
+            device=args.device
+        )
+        # Transforms with the same steps and parameters (e.g., resize, crop and normalization) have the same key. The
+        # repr is not sufficient, e.g., all Lambda steps are shown as Lambda().
+        key = get_transform_key(transform)
+        if key is None:
+            key = ('unidentified', i)
+        group = groups.setdefault(key, {'indices': [], 'models': [], 'transform': transform})
+        group['indices'].append(i)
+        group['models'].append(model)
+
+    model_groups = []
+    for group in groups.values():
+        if args.verbose:
+            print(f"Extract the features of {[args.model_key[i] for i in group['indices']]} from one data pass")
+        train_dataloader, eval_dataloader = get_extraction_dataloaders(args, dataset_root, group['transform'])
+        model_groups.append((group['indices'], group['models'], train_dataloader, eval_dataloader))
+    return model_groups
+
+
+def get_extraction_dataloaders(args, dataset_root, transform):
+    if getattr(args, "image_cache_root", None):
+        dataloaders = get_image_cache_dataloaders(args, dataset_root, transform)
+        if dataloaders is not None:
+            return dataloaders
 
     eval_dataset = build_dataset(
         dataset_name=args.dataset,
@@ -103,7 +156,50 @@ def get_extraction_model_n_dataloader(args, dataset_root, task):
     else:
         train_dataloader = None
 
-    return model, train_dataloader, eval_dataloader
+    return train_dataloader, eval_dataloader
+
+
+def get_image_cache_dataloaders(args, dataset_root, transform):
+    """
+    Dataloaders over the cached decoded images of the train and test split (see `build_image_cache`), s.t. only the
+    steps of the transform after ToTensor (e.g., Normalize) are applied. Splits that are not cached yet are decoded
+    and cached first. None if the images cannot be cached (transforms without ToTensor or with steps before it that
+    cannot be identified, datasets with captions).
+    """
+    steps = split_transform(transform)
+    if steps is None or get_dataset_collate_fn(args.dataset) is not default_collate:
+        if args.verbose:
+            print(f"The decoded images of {args.dataset} cannot be cached for the transform {transform}.")
+        return None
+    pre_steps, post_steps = steps
+    cache_dir = get_image_cache_dir(args.image_cache_root, args.dataset.replace("/", "_"), pre_steps)
+
+    dataloaders = []
+    for split, wds_cache_dir in [(args.train_split, None), (args.split, args.wds_cache_dir)]:
+        if not has_image_cache(cache_dir, split):
+            dataset = build_dataset(
+                dataset_name=args.dataset,
+                root=dataset_root,
+                transform=type(transform)(pre_steps + [ToUint8Tensor()]),
+                split=split,
+                download=True,
+                wds_cache_dir=wds_cache_dir,
+                verbose=args.verbose
+            )
+            if not dataset:
+                dataloaders.append(None)
+                continue
+            if args.verbose:
+                print(f"Cache the decoded {split} images of {args.dataset} in {cache_dir}")
+            build_image_cache(dataset, cache_dir, split, pre_steps, batch_size=args.batch_size,
+                              num_workers=args.num_workers, verbose=args.verbose)
+        dataset = ImageCacheDataset(cache_dir, split, transform=type(transform)(post_steps))
+        dataloaders.append(torch.utils.data.DataLoader(
+            dataset, batch_size=args.batch_size,
+            shuffle=False, num_workers=args.num_workers, pin_memory=True,
+        ))
+    train_dataloader, eval_dataloader = dataloaders
+    return train_dataloader, eval_dataloader
 
 
 class SubsetWithTargets(Subset):
@@ -0,0 +1,180 @@
+import functools
+import hashlib
+import json
+import os
+import types
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from tqdm import tqdm
+
+from sim_consistency.utils.feature_store import StoreWriter, has_store, load_store
+
+# The decoded images of a dataset split are cached as uint8 arrays of the feature store (images_{split}.npy and
+# targets_{split}.npy) in image_cache_root/dataset/<preprocessing hash>. The preprocessing is the part of the model
+# transform before ToTensor (e.g., Resize(256) and CenterCrop(224)), the rest (e.g., Normalize) is applied when
+# loading. Models with the same preprocessing share a cache, e.g., all models with 224x224 (or 256x256) crops.
+_TO_TENSOR_STEPS = ['ToTensor']
+
+
+def split_transform(transform: Any) -> Optional[Tuple[List[Callable], List[Callable]]]:
+    """
+    Steps of a (torchvision) Compose transform before and after ToTensor. None if the transform is no Compose with a
+    ToTensor step or if a step before ToTensor cannot be identified (see `_step_repr`), s.t. its decoded images cannot
+    be cached.
+    """
+    steps = getattr(transform, 'transforms', None)
+    if not steps:
+        return None
+    names = [type(step).__name__ for step in steps]
+    for i, name in enumerate(names):
+        if name in _TO_TENSOR_STEPS:
+            if any(_step_repr(step) is None for step in steps[:i]):
+                return None
+            return list(steps[:i]), list(steps[i + 1:])
+    return None
+
+
+def _code_repr(code: types.CodeType) -> str:
+    # Nested code objects (e.g., of a lambda defined in a function) are represented by their content, not their address
+    consts = [_code_repr(const) if isinstance(const, types.CodeType) else repr(const) for const in code.co_consts]
+    return repr((code.co_code, consts, code.co_names))
+
+
+def _object_repr(obj: Any) -> Optional[str]:
+    # Default object representations contain the memory address, which differs between runs and objects
+    obj_repr = repr(obj)
+    return None if ' at 0x' in obj_repr else obj_repr
+
+
+def _value_repr(value: Any) -> Optional[str]:
+    return _step_repr(value) if callable(value) else _object_repr(value)
+
+
+def _step_repr(step: Callable) -> Optional[str]:
+    """
+    Representation of a preprocessing step that identifies its behaviour across runs. Functions (incl. lambdas and
+    closures) are identified by their name, a hash of their code and the representation of their defaults and closure
+    variables, partials by their function and arguments, composed transforms by their steps and other steps by their
+    repr. None if the step cannot be identified, e.g., its repr or one of its arguments only contains the memory
+    address.
+    """
+    if isinstance(step, functools.partial):
+        values = [step.func] + list(step.args) + [value for _, value in sorted(step.keywords.items())]
+        value_reprs = [_value_repr(value) for value in values]
+        if any(value_repr is None for value_repr in value_reprs):
+            return None
+        return f"functools.partial({', '.join(value_reprs)}, keywords={sorted(step.keywords)})"
+    steps = getattr(step, 'transforms', None)
+    if isinstance(steps, (list, tuple)):
+        step_reprs = [_step_repr(s) for s in steps]
+        if any(step_repr is None for step_repr in step_reprs):
+            return None
+        return f"{type(step).__name__}([{', '.join(step_reprs)}])"
+    lambd = getattr(step, 'lambd', None)
+    if lambd is not None:
+        # torchvision's Lambda transform only shows its class name
+        lambd_repr = _step_repr(lambd)
+        return None if lambd_repr is None else f'{type(step).__name__}({lambd_repr})'
+    code = getattr(step, '__code__', None)
+    if isinstance(code, types.CodeType):
+        cells = [cell.cell_contents for cell in step.__closure__ or ()]
+        kwdefaults = [value for _, value in sorted((step.__kwdefaults__ or {}).items())]
+        values = list(step.__defaults__ or ()) + kwdefaults + cells
+        value_reprs = [_value_repr(value) for value in values]
+        if any(value_repr is None for value_repr in value_reprs):
+            return None
+        h = hashlib.sha1(_code_repr(code).encode())
+        h.update('\n'.join(value_reprs).encode())
+        return f'{step.__module__}.{step.__qualname__}[{h.hexdigest()[:16]}]'
+    if isinstance(step, type) or isinstance(step, types.BuiltinFunctionType):
+        return f'{step.__module__}.{step.__qualname__}'
+    return _object_repr(step)
+
+
+def get_preprocessing_key(steps: List[Callable]) -> str:
+    return '\n'.join(_step_repr(step) for step in steps)
+
+
+def get_transform_key(transform: Callable) -> Optional[str]:
+    """Key that identifies the behaviour of a (composed) transform across models, None if it cannot be identified."""
+    return _step_repr(transform)
+
+
+def get_image_cache_dir(image_cache_root: str, dataset_name: str, steps: List[Callable]) -> str:
+    key = hashlib.sha1(get_preprocessing_key(steps).encode()).hexdigest()[:16]
+    return os.path.join(image_cache_root, dataset_name, key)
+
+
+def has_image_cache(cache_dir: str, split: str) -> bool:
+    return has_store(cache_dir, 'images', split) and has_store(cache_dir, 'targets', split)
+
+
+class ToUint8Tensor:
+    """ToTensor without the scaling to [0, 1]: converts a PIL image to a uint8 CHW tensor."""
+
+    def __call__(self, image) -> torch.Tensor:
+        array = np.array(image, dtype=np.uint8, copy=True)
+        if array.ndim == 2:
+            array = array[:, :, None]
+        return torch.from_numpy(array).permute(2, 0, 1).contiguous()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}()'
+
+
+def build_image_cache(dataset: Dataset, cache_dir: str, split: str, steps: List[Callable], batch_size: int = 256,
+                      num_workers: int = 0, verbose: bool = False) -> None:
+    """
+    Writes the images of a dataset split, decoded and preprocessed once (`steps`, e.g., resize and crop), as uint8
+    arrays with the targets to the cache (streamed, see `StoreWriter`). The dataset is expected to apply the steps
+    followed by `ToUint8Tensor`.
+    """
+    if isinstance(dataset, IterableDataset):
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+        n_samples = None
+    else:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        n_samples = len(dataset)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'preprocessing.json'), 'w') as f:
+        json.dump({'preprocessing': get_preprocessing_key(steps)}, f, indent=2)
+    with StoreWriter(cache_dir, 'images', split, n_rows=n_samples) as image_writer, \
+            StoreWriter(cache_dir, 'targets', split, n_rows=n_samples) as target_writer:
+        for images, targets in tqdm(loader, desc=f"Caching the decoded {split} images", disable=not verbose):
+            image_writer.write(images)
+            target_writer.write(torch.as_tensor(targets))
+
+
+class ImageCacheDataset(Dataset):
+    """
+    Images and targets of a cached dataset split (see `build_image_cache`). The uint8 images are memory-mapped (opened
+    lazily, s.t. every dataloader worker maps the file itself), scaled to [0, 1] like ToTensor does and transformed
+    with the steps after ToTensor (e.g., Normalize).
+    """
+
+    def __init__(self, cache_dir: str, split: str, transform: Optional[Callable] = None) -> None:
+        self.cache_dir = cache_dir
+        self.split = split
+        self.transform = transform
+        self.targets = load_store(cache_dir, 'targets', split)
+        self._images = None
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, i: int):
+        if self._images is None:
+            self._images = load_store(self.cache_dir, 'images', self.split, mmap=True)
+        image = self._images[i].float().div(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[i]
+
+    def __getstate__(self):
+        # The memory map is not pickled (i.e., copied) when the dataset is sent to the dataloader workers
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
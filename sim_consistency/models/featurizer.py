@@ -1,10 +1,17 @@
-import os
+import contextlib
+import itertools
+import time
+import warnings
+from typing import Any, Dict, List, Optional
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset, SequentialSampler, Subset
 from tqdm import tqdm
 
+from sim_consistency.utils.extraction_manifest import ExtractionManifest
+from sim_consistency.utils.feature_store import StoreWriter, has_store
+
 
 class Featurizer(torch.nn.Module):
     def __init__(self, model, normalize=True):
@@ -22,57 +29,218 @@ class Featurizer(torch.nn.Module):
             self,
             train_dataloader: DataLoader,
             eval_dataloader: DataLoader,
-            feature_dir: str, device: str
+            feature_dir: str, device: str,
+            checkpoint_interval: float = 300.
     ):
         """
-        Extract features from the dataset using the featurizer model and store them in the feature_dir
+        Extract features from the dataset using the featurizer model and store them in the feature_dir. The features
+        and targets of each batch are streamed into the feature store (see `StoreWriter`), preallocated from the
+        dataset length if it is known, while the model computes the next batch.
+
+        Every `checkpoint_interval` seconds, the progress is recorded in a manifest (see `ExtractionManifest`). A rerun
+        of an interrupted extraction skips the splits that are complete and continues the others after their last
+        checkpoint.
         """
-        splits = ["_train", "_test"]
-        for save_str, loader in zip(splits, [train_dataloader, eval_dataloader]):
-            if loader is None:
-                continue
-            features = []
-            targets = []
-            num_batches_tracked = 0
-            num_cached = 0
-            with torch.no_grad():
-                for images, target in tqdm(loader):
-                    images = images.to(device)
-
-                    feature = self.forward(images)
-
-                    features.append(feature.cpu())
-                    targets.append(target)
-
-                    num_batches_tracked += 1
-                    if (num_batches_tracked % 100) == 0:
-                        features = torch.cat(features)
-                        targets = torch.cat(targets)
-
-                        torch.save(features, os.path.join(feature_dir, f'features{save_str}_cache_{num_cached}.pt'))
-                        torch.save(targets, os.path.join(feature_dir, f'targets{save_str}_cache_{num_cached}.pt'))
-                        num_cached += 1
-                        features = []
-                        targets = []
-
-            if len(features) > 0:
-                features = torch.cat(features)
-                targets = torch.cat(targets)
-                torch.save(features, os.path.join(feature_dir, f'features{save_str}_cache_{num_cached}.pt'))
-                torch.save(targets, os.path.join(feature_dir, f'targets{save_str}_cache_{num_cached}.pt'))
-                num_cached += 1
-
-            features = torch.load(os.path.join(feature_dir, f'features{save_str}_cache_0.pt'))
-            targets = torch.load(os.path.join(feature_dir, f'targets{save_str}_cache_0.pt'))
-            for k in range(1, num_cached):
-                next_features = torch.load(os.path.join(feature_dir, f'features{save_str}_cache_{k}.pt'))
-                next_targets = torch.load(os.path.join(feature_dir, f'targets{save_str}_cache_{k}.pt'))
-                features = torch.cat((features, next_features))
-                targets = torch.cat((targets, next_targets))
-
-            for k in range(num_cached):
-                os.remove(os.path.join(feature_dir, f'features{save_str}_cache_{k}.pt'))
-                os.remove(os.path.join(feature_dir, f'targets{save_str}_cache_{k}.pt'))
-
-            torch.save(features, os.path.join(feature_dir, f'features{save_str}.pt'))
-            torch.save(targets, os.path.join(feature_dir, f'targets{save_str}.pt'))
+        extract_features([self], train_dataloader, eval_dataloader, [feature_dir], device, checkpoint_interval)
+
+
+def extract_features(
+        featurizers: List[Featurizer],
+        train_dataloader: Optional[DataLoader],
+        eval_dataloader: Optional[DataLoader],
+        feature_dirs: List[str], device: str,
+        checkpoint_interval: float = 300.
+) -> None:
+    """
+    Extract the features of several models (sharing the preprocessing of the dataloaders) from one pass over each
+    split: every batch is decoded once and fed through all models, the features of each model are stored in its
+    feature_dir (see `Featurizer.feature_extraction`). Models whose features of a split are complete are skipped.
+    """
+    splits = ["train", "test"]
+    for split, loader in zip(splits, [train_dataloader, eval_dataloader]):
+        if loader is None:
+            continue
+        missing = [i for i, feature_dir in enumerate(feature_dirs)
+                   if not all(has_store(feature_dir, name, split) for name in ['features', 'targets'])]
+        if missing:
+            _extract_split([featurizers[i] for i in missing], loader, split, [feature_dirs[i] for i in missing],
+                           device, checkpoint_interval)
+
+
+def _extract_split(featurizers: List[Featurizer], loader: DataLoader, split: str, feature_dirs: List[str],
+                   device: str, checkpoint_interval: float) -> None:
+    n_samples = get_num_samples(loader)
+    manifests = [ExtractionManifest(feature_dir, split) for feature_dir in feature_dirs]
+    progresses = [manifest.read() for manifest in manifests]
+    progress = get_common_progress(progresses, n_samples, loader.num_workers)
+    writers = None
+    if progress is not None:
+        try:
+            writers = open_group_writers(feature_dirs, split, n_samples, [
+                {name: {'rows': progress['samples_done'], 'dtype': model_progress['arrays'][name]['dtype']}
+                 for name in ['features', 'targets']}
+                for model_progress in progresses
+            ])
+        except (OSError, ValueError) as e:
+            print(f"Could not resume the extraction of the {split} split ({e}), starting over.")
+    resumed_loader = get_resumed_loader(loader, progress) if writers is not None else None
+    if resumed_loader is None:
+        if writers is not None:
+            for writer in itertools.chain.from_iterable(writers):
+                writer.abort()
+        for manifest in manifests:
+            manifest.remove()
+        writers = open_group_writers(feature_dirs, split, n_samples)
+        progress = {'samples_done': 0, 'batches_done': 0, 'batch_rows': 0}
+    else:
+        print(f"Resuming the extraction of the {split} split after {progress['samples_done']} samples.")
+    samples_done, batches_done, batch_rows = progress['samples_done'], progress['batches_done'], progress['batch_rows']
+
+    loader_to_run = resumed_loader if resumed_loader is not None else loader
+    # Checkpoints are only written as long as all batches are full (see `is_resumable_position`)
+    full_batches = True
+    last_checkpoint = time.monotonic()
+    try:
+        with contextlib.ExitStack() as stack, torch.no_grad():
+            for writer in itertools.chain.from_iterable(writers):
+                stack.enter_context(writer)
+            iterator = iter(loader_to_run)
+            total = len(loader) if n_samples is not None else None
+            for images, target in tqdm(iterator, initial=batches_done, total=total):
+                images = images.to(device)
+
+                for featurizer, (feature_writer, target_writer) in zip(featurizers, writers):
+                    feature = featurizer(images)
+
+                    feature_writer.write(feature.cpu())
+                    target_writer.write(target)
+
+                batches_done += 1
+                samples_done += len(target)
+                full_batches = full_batches and (batch_rows == 0 or len(target) == batch_rows)
+                batch_rows = max(batch_rows, len(target))
+                if (time.monotonic() - last_checkpoint >= checkpoint_interval
+                        and is_resumable_position(loader_to_run, iterator, full_batches)):
+                    for manifest, (feature_writer, target_writer) in zip(manifests, writers):
+                        arrays = {'features': feature_writer.checkpoint(), 'targets': target_writer.checkpoint()}
+                        manifest.write({
+                            'split': split,
+                            'n_samples': n_samples,
+                            'num_workers': loader.num_workers,
+                            'samples_done': samples_done,
+                            'batches_done': batches_done,
+                            'batch_rows': batch_rows,
+                            'worker_offsets': get_worker_offsets(batches_done, loader.num_workers, batch_rows),
+                            'arrays': arrays,
+                        })
+                    last_checkpoint = time.monotonic()
+    finally:
+        skip_stage = getattr(loader.dataset, 'skip_stage', None)
+        if skip_stage is not None:
+            skip_stage.skips, skip_stage.first_worker = None, 0
+    for manifest in manifests:
+        manifest.remove()
+
+
+def get_common_progress(progresses: List[Optional[Dict[str, Any]]], n_samples: Optional[int],
+                        num_workers: int) -> Optional[Dict[str, Any]]:
+    """
+    Earliest checkpoint among the manifests of a group of models, from which the partial arrays of all models are
+    resumed (their synced rows cover it). None if a manifest is missing or recorded for another dataloader.
+    """
+    if any(progress is None or (progress['n_samples'], progress['num_workers']) != (n_samples, num_workers)
+           for progress in progresses):
+        return None
+    return min(progresses, key=lambda progress: progress['samples_done'])
+
+
+def open_group_writers(feature_dirs: List[str], split: str, n_samples: Optional[int],
+                       resume_from: Optional[List[Dict[str, Dict[str, Any]]]] = None) -> List[List[StoreWriter]]:
+    """Writers (see `open_store_writers`) of each model of a group."""
+    writers = []
+    try:
+        for i, feature_dir in enumerate(feature_dirs):
+            writers.append(open_store_writers(feature_dir, split, n_samples,
+                                              resume_from[i] if resume_from is not None else None))
+    except BaseException:
+        for writer in itertools.chain.from_iterable(writers):
+            writer.abort()
+        raise
+    return writers
+
+
+def open_store_writers(feature_dir: str, split: str, n_samples: Optional[int],
+                       resume_from: Optional[Dict[str, Dict[str, Any]]] = None) -> List[StoreWriter]:
+    """Resumable writers of the features and targets of a split, continuing the partial arrays of `resume_from`."""
+    writers = []
+    try:
+        for name in ['features', 'targets']:
+            writers.append(StoreWriter(feature_dir, name, split, n_rows=n_samples, resumable=True,
+                                       resume_from=resume_from[name] if resume_from is not None else None))
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    return writers
+
+
+def get_worker_offsets(batches_done: int, num_workers: int, batch_rows: int) -> List[int]:
+    """
+    Samples consumed from each worker after `batches_done` batches of an iterable dataset, whose dataloader fetches
+    full batches round-robin from its workers (as long as none of them is exhausted).
+    """
+    num_workers = max(num_workers, 1)
+    return [(batches_done // num_workers + int(w < batches_done % num_workers)) * batch_rows
+            for w in range(num_workers)]
+
+
+def is_resumable_position(loader: DataLoader, iterator, full_batches: bool) -> bool:
+    """
+    Whether the samples done determine the position of the dataloader (see `get_resumed_loader`). Once a worker of
+    an iterable dataset is exhausted, the round-robin order is broken (only the tail of the dataset is left). An
+    exhausted worker usually returns a partial batch first (`full_batches` is False from then on). Workers that end
+    with a full batch are only detected by the worker status of the dataloader iterator, if available.
+    """
+    if not isinstance(loader.dataset, IterableDataset) or loader.num_workers == 0:
+        return True
+    if not full_batches:
+        return False
+    workers_status = getattr(iterator, '_workers_status', None)
+    if workers_status is None:
+        warnings.warn("The dataloader does not expose the status of its workers, hence an exhausted worker is only "
+                      "detected by a partial batch.")
+        return True
+    return all(workers_status)
+
+
+def get_resumed_loader(loader: DataLoader, progress: Dict[str, Any]) -> Optional[DataLoader]:
+    """
+    Dataloader over the samples after the ones done in `progress` (see `ExtractionManifest`), None if the loader
+    cannot be resumed. Sequential map-style dataloaders continue on a subset of the dataset, webdatasets skip the
+    consumed samples of each worker before decoding (see `SkipSamples`).
+    """
+    if isinstance(loader.dataset, IterableDataset):
+        skip_stage = getattr(loader.dataset, 'skip_stage', None)
+        if skip_stage is None:
+            return None
+        skip_stage.skips = progress['worker_offsets']
+        skip_stage.first_worker = progress['batches_done'] % max(loader.num_workers, 1)
+        return loader
+    if not isinstance(loader.sampler, SequentialSampler) or loader.batch_size is None:
+        return None
+    dataset = Subset(loader.dataset, range(progress['samples_done'], len(loader.dataset)))
+    return DataLoader(dataset, batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers,
+                      collate_fn=loader.collate_fn, pin_memory=loader.pin_memory, drop_last=loader.drop_last)
+
+
+def get_num_samples(loader: DataLoader) -> Optional[int]:
+    """Number of samples of a map-style dataloader, None if unknown (e.g., for iterable webdatasets)."""
+    if isinstance(loader.dataset, IterableDataset) or loader.batch_size is None:
+        return None
+    try:
+        n_samples = len(loader.dataset)
+    except TypeError:
+        return None
+    if loader.drop_last:
+        n_samples -= n_samples % loader.batch_size
+    return n_samples
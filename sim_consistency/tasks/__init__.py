@@ -1,2 +1,4 @@
-from .model_similarity import compute_sim_matrix
-
+from .model_similarity import (compute_bootstrap_sim_matrices, compute_sim_matrix, compute_sim_matrices,
+                               compute_sim_matrices_from_config, compute_similarity_curves, load_similarity_results,
+                               save_bootstrap_results, save_similarity_curves, save_similarity_results,
+                               validate_sim_precision)
@@ -0,0 +1,25 @@
+from typing import Any, Dict
+
+import numpy as np
+
+
+def get_bootstrap_indices(n_samples: int, n_resamples: int, seed: int = 0) -> np.ndarray:
+    """Sample indices of `n_resamples` bootstrap resamples (n_resamples x n_samples, drawn with replacement)."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n_samples, size=(n_resamples, n_samples))
+
+
+def summarize_bootstrap(samples: np.ndarray, confidence: float = 0.95) -> Dict[str, Any]:
+    """
+    Mean, standard deviation and percentile interval (covering `confidence` of the resamples) of the similarity
+    matrices of all bootstrap resamples (n_resamples x M x M).
+    """
+    alpha = (1 - confidence) / 2
+    return {
+        'mean': samples.mean(axis=0),
+        'std': samples.std(axis=0),
+        'lower': np.percentile(samples, 100 * alpha, axis=0),
+        'upper': np.percentile(samples, 100 * (1 - alpha), axis=0),
+        'n_resamples': samples.shape[0],
+        'confidence': confidence,
+    }
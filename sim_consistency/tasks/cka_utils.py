@@ -0,0 +1,279 @@
+import math
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+
+def squared_distances(X: torch.Tensor) -> torch.Tensor:
+    """Pairwise squared euclidean distances between the rows of X."""
+    GX = X @ X.T
+    sq_norms = torch.diag(GX)
+    D = sq_norms[None, :] - GX
+    D += D.T.clone()
+    return D
+
+
+def median_sigma(D: torch.Tensor) -> torch.Tensor:
+    """Median heuristic for the width of the rbf kernel given the squared distances D."""
+    return torch.sqrt(torch.median(D[D != 0]))
+
+
+def squared_distances_between(X: torch.Tensor, Y: torch.Tensor) -> torch.Tensor:
+    """Squared euclidean distances between the rows of X and the rows of Y."""
+    D = X.square().sum(dim=1)[:, None] + Y.square().sum(dim=1)[None, :] - 2 * X @ Y.T
+    return D.clamp_(min=0.0)
+
+
+def _lower_triangle_values(D: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Nonzero entries of rows start, ..., stop - 1 of the (memory-mapped) matrix D below the diagonal."""
+    block = np.asarray(D[start:stop, :stop])
+    values = block[np.arange(stop)[None, :] < np.arange(start, stop)[:, None]]
+    return values[values != 0]
+
+
+def blockwise_median_sigma(D: np.ndarray, block_rows: int = 4096) -> float:
+    """
+    Median heuristic sigma (see `median_sigma`) of a (memory-mapped) float32 matrix of squared distances, computed in
+    two passes over row blocks of its lower triangle. The first pass counts the values per bucket of their leading 16
+    bits, which preserve the order of non-negative floats, the second one only gathers the bucket of the median.
+    """
+    n = D.shape[0]
+    counts = np.zeros(1 << 16, dtype=np.int64)
+    for start in range(0, n, block_rows):
+        values = _lower_triangle_values(D, start, min(start + block_rows, n))
+        counts += np.bincount(values.astype(np.float32).view(np.uint32) >> 16, minlength=1 << 16)
+    # Lower median, as torch.median (each pair appears once in the lower triangle, which keeps the median of D)
+    rank = (counts.sum() - 1) // 2
+    cumulative = np.cumsum(counts)
+    bucket = int(np.searchsorted(cumulative, rank, side='right'))
+    rank -= cumulative[bucket - 1] if bucket > 0 else 0
+    candidates = []
+    for start in range(0, n, block_rows):
+        values = _lower_triangle_values(D, start, min(start + block_rows, n)).astype(np.float32)
+        candidates.append(values[(values.view(np.uint32) >> 16) == bucket])
+    return float(np.sqrt(np.partition(np.concatenate(candidates), rank)[rank]))
+
+
+def sample_median_sigma(X: torch.Tensor, n_samples: int = 2000, seed: int = 0) -> torch.Tensor:
+    """Median heuristic sigma estimated from the distances between (at most) `n_samples` random rows of X."""
+    generator = torch.Generator().manual_seed(seed)
+    rows = torch.randperm(X.shape[0], generator=generator)[:n_samples].to(X.device)
+    return median_sigma(squared_distances(X[rows]))
+
+
+def random_fourier_features(X: torch.Tensor, sigma: float, rank: int, seed: int = 0) -> torch.Tensor:
+    """
+    Random Fourier features (Rahimi & Recht, 2007) of rank `rank`, s.t. Phi Phi^T approximates the rbf kernel with
+    width sigma.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    W = torch.randn(X.shape[1], rank, generator=generator).to(X) / sigma
+    b = 2 * math.pi * torch.rand(rank, generator=generator).to(X)
+    return torch.cos(X @ W + b) * math.sqrt(2. / rank)
+
+
+def nystroem_features(X: torch.Tensor, sigma: float, rank: int, seed: int = 0) -> torch.Tensor:
+    """
+    Nystroem features with `rank` random landmarks, i.e., Phi = K_nm K_mm^(-1/2), s.t. Phi Phi^T approximates the rbf
+    kernel with width sigma.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    landmarks = torch.randperm(X.shape[0], generator=generator)[:rank].to(X.device)
+    K_nm = rbf_kernel_from_distances(squared_distances_between(X, X[landmarks]), sigma)
+    eigvals, eigvecs = torch.linalg.eigh(K_nm[landmarks].double())
+    keep = eigvals > eigvals.max() * 1e-10
+    return (K_nm.double() @ (eigvecs[:, keep] / torch.sqrt(eigvals[keep]))).float()
+
+
+def linear_kernel(X: torch.Tensor) -> torch.Tensor:
+    return X @ X.T
+
+
+def rbf_kernel(X: torch.Tensor, sigma: Optional[float] = None) -> torch.Tensor:
+    """
+    Gram matrix of an rbf kernel with width sigma. If sigma is None, the median heuristic is used. Mirrors the rbf
+    kernel of thingsvision's CKA implementation.
+    """
+    return rbf_kernel_from_distances(squared_distances(X), sigma)
+
+
+def rbf_kernel_from_distances(D: torch.Tensor, sigma: Optional[float] = None, inplace: bool = True) -> torch.Tensor:
+    if sigma is None:
+        sigma = median_sigma(D)
+    K = D if inplace else D.clone()
+    K *= -0.5 / sigma ** 2
+    return K.exp_()
+
+
+def apply_kernel(X: torch.Tensor, kernel: str, sigma: Optional[float] = None) -> torch.Tensor:
+    if kernel == 'linear':
+        return linear_kernel(X)
+    elif kernel == 'rbf':
+        return rbf_kernel(X, sigma)
+    else:
+        raise ValueError(f"Unknown kernel: {kernel}")
+
+
+def center_kernel(K: torch.Tensor, unbiased: bool = True) -> torch.Tensor:
+    """
+    Centering of the (square) gram matrix K, performed in-place. The unbiased version uses the U-centering of
+    Szekely & Rizzo (2014), as in thingsvision's CKA implementation. The column means are accumulated in float64.
+    """
+    if unbiased:
+        n = K.shape[0]
+        K.fill_diagonal_(0.0)
+        means = K.sum(dim=0, dtype=torch.float64) / (n - 2)
+        means -= means.sum() / (2 * (n - 1))
+        means = means.to(K.dtype)
+        K -= means[:, None]
+        K -= means[None, :]
+        K.fill_diagonal_(0.0)
+    else:
+        means = K.mean(dim=0, dtype=torch.float64)
+        means -= means.mean() / 2
+        means = means.to(K.dtype)
+        K -= means[:, None]
+        K -= means[None, :]
+    return K
+
+
+def hsic(K_c: torch.Tensor, L_c: torch.Tensor, block_size: int = 4096) -> torch.Tensor:
+    """
+    HSIC (up to a constant factor) of two centered gram matrices, i.e., vec(K_c)^T vec(L_c). Row blocks are
+    multiplied in (at least) float32, s.t. gram matrices stored in half precision are upcast block by block, and
+    their products are accumulated in float64.
+    """
+    compute_dtype = torch.promote_types(torch.promote_types(K_c.dtype, L_c.dtype), torch.float32)
+    total = torch.zeros((), dtype=torch.float64, device=K_c.device)
+    for start in range(0, K_c.shape[0], block_size):
+        block = K_c[start:start + block_size].to(compute_dtype) * L_c[start:start + block_size].to(compute_dtype)
+        total += block.sum(dtype=torch.float64)
+    return total
+
+
+def linear_hsic_matrix(features: List[torch.Tensor], unbiased: bool = True, block_size: int = 8192) -> torch.Tensor:
+    """
+    Linear HSIC (up to a constant factor) between all pairs of feature matrices, computed from one blocked matrix
+    product over the stacked, centered features Z = [X_1, ..., X_M] (N x sum(D)). Only the cross-covariance norms
+    ||X_i^T X_j||_F^2 need the stacked product, the remaining terms of the unbiased estimator (Song et al., 2012) only
+    depend on the squared row norms of each X_i. Each column block of Z holds at most `block_size` columns (but at
+    least one model) and is multiplied with all preceding columns, s.t. only the upper triangle is computed.
+    """
+    n = features[0].shape[0]
+    n_models = len(features)
+    Z = torch.cat([X - X.mean(dim=0, keepdim=True) for X in features], dim=1)
+    offsets = np.cumsum([0] + [X.shape[1] for X in features])
+
+    cross = torch.zeros(n_models, n_models, dtype=torch.float64)
+    start = 0
+    while start < n_models:
+        end = start + 1
+        while end < n_models and offsets[end + 1] - offsets[start] <= block_size:
+            end += 1
+        P = Z[:, :offsets[end]].T @ Z[:, offsets[start]:offsets[end]]
+        for j in range(start, end):
+            cols = slice(offsets[j] - offsets[start], offsets[j + 1] - offsets[start])
+            for i in range(j + 1):
+                cross[i, j] = P[offsets[i]:offsets[i + 1], cols].double().square().sum().cpu()
+        start = end
+    cross = torch.triu(cross) + torch.triu(cross, diagonal=1).T
+
+    if not unbiased:
+        return cross
+
+    row_norms = torch.stack([Z[:, offsets[i]:offsets[i + 1]].double().square().sum(dim=1) for i in range(n_models)])
+    row_norms = row_norms.cpu()
+    return unbiased_linear_hsic(cross, row_norms, row_norms)
+
+
+def unbiased_linear_hsic(cross: torch.Tensor, sq_norms_x: torch.Tensor, sq_norms_y: torch.Tensor) -> torch.Tensor:
+    """
+    Unbiased linear HSIC (Song et al., 2012; up to a constant factor) of column-centered features given the
+    cross-covariance norms ||X^T Y||_F^2 and the squared row norms of X and Y (one row per model, one column per
+    sample). For column-centered features K~1 = -diag(K), hence all correction terms only need the row norms.
+    """
+    n = sq_norms_x.shape[1]
+    return (cross - (n / (n - 2)) * (sq_norms_x @ sq_norms_y.T)
+            + torch.outer(sq_norms_x.sum(dim=1), sq_norms_y.sum(dim=1)) / ((n - 1) * (n - 2)))
+
+
+def center_features(X: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Column-centered features and their squared row norms (in float64)."""
+    X_c = X - X.mean(dim=0, keepdim=True)
+    return X_c, X_c.double().square().sum(dim=1)
+
+
+def feature_space_linear_hsic(X_c: torch.Tensor, sq_norms_x: torch.Tensor, Y_c: torch.Tensor,
+                              sq_norms_y: torch.Tensor, unbiased: bool = True) -> torch.Tensor:
+    """
+    Linear HSIC of two column-centered feature matrices computed from their D_x x D_y cross-covariance, i.e.,
+    without materializing any N x N gram matrix.
+    """
+    cross = (X_c.T @ Y_c).double().square().sum().cpu()
+    if not unbiased:
+        return cross
+    return unbiased_linear_hsic(cross.reshape(1, 1), sq_norms_x[None].cpu(), sq_norms_y[None].cpu()).squeeze()
+
+
+class IncrementalHSIC:
+    """
+    Statistics of the HSIC between the gram matrices of M models on a growing (nested) set of samples. New samples are
+    added with the rows of the gram matrices that belong to them (their kernel values with all samples so far), s.t.
+    the statistics of the previous samples are only updated, never recomputed. The HSIC equals (up to the constant
+    factor of `hsic`) the one of the centered gram matrices of the current samples.
+    """
+
+    def __init__(self, n_models: int, n_samples: int, device: Union[str, torch.device] = 'cpu') -> None:
+        self.n = 0
+        # sum_{i != j} K_ij L_ij of all pairs of models, and per model the row sums (without diagonal) and diagonals
+        self.cross = torch.zeros(n_models, n_models, dtype=torch.float64)
+        self.row_sums = torch.zeros(n_models, n_samples, dtype=torch.float64, device=device)
+        self.diag = torch.zeros(n_models, n_samples, dtype=torch.float64, device=device)
+
+    def add_rows(self, blocks: List[torch.Tensor]) -> None:
+        """Adds samples n, ..., n + b - 1 given the b x (n + b) gram matrix rows of each model (modified in-place)."""
+        start = self.n
+        n_rows, stop = blocks[0].shape
+        assert stop == start + n_rows, "Gram matrix rows should cover all samples up to the added ones."
+        rows = torch.arange(n_rows, device=blocks[0].device)
+        stacked = torch.empty(len(blocks), n_rows * stop, device=blocks[0].device)
+        for m, K in enumerate(blocks):
+            self.diag[m, start:stop] = K[rows, start + rows].double()
+            K[rows, start + rows] = 0
+            self.row_sums[m, start:stop] += K.sum(dim=1).double()
+            # By symmetry, the new samples also contribute to the rows of the previous ones
+            self.row_sums[m, :start] += K[:, :start].sum(dim=0).double()
+            # Entries between new and previous samples appear twice in the full gram matrix
+            K[:, :start] *= math.sqrt(2)
+            stacked[m] = K.reshape(-1)
+        stacked = stacked.double()
+        self.cross += (stacked @ stacked.T).cpu()
+        self.n = stop
+
+    def hsic_matrix(self, unbiased: bool = True) -> torch.Tensor:
+        n = self.n
+        R = self.row_sums[:, :n].cpu()
+        if unbiased:
+            # Song et al. (2012) with K~ the gram matrix without diagonal
+            S = R.sum(dim=1)
+            return self.cross + torch.outer(S, S) / ((n - 1) * (n - 2)) - 2 / (n - 2) * (R @ R.T)
+        # tr(KHLH) with the full gram matrices
+        D = self.diag[:, :n].cpu()
+        R = R + D
+        S = R.sum(dim=1)
+        return self.cross + D @ D.T - 2 / n * (R @ R.T) + torch.outer(S, S) / n ** 2
+
+
+def get_minibatch_indices(n_samples: int, batch_size: int, n_batches: int, seed: int = 0) -> List[np.ndarray]:
+    """Fixed random minibatches (sorted sample indices, drawn without replacement within each batch)."""
+    rng = np.random.default_rng(seed)
+    batch_size = min(batch_size, n_samples)
+    return [np.sort(rng.choice(n_samples, size=batch_size, replace=False)) for _ in range(n_batches)]
+
+
+def cka_from_hsic_matrix(hsic_matrix: torch.Tensor) -> np.ndarray:
+    diag = torch.sqrt(torch.diagonal(hsic_matrix))
+    cka_matrix = hsic_matrix / torch.outer(diag, diag)
+    cka_matrix.fill_diagonal_(1.0)
+    return cka_matrix.numpy()
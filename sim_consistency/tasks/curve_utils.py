@@ -0,0 +1,71 @@
+from typing import Dict, List, Union
+
+import numpy as np
+
+from sim_consistency.tasks.rsa_utils import _normalized_rows
+
+
+def get_nested_order(n_samples: int, seed: int = 0) -> np.ndarray:
+    """Random order of the samples, s.t. the nested subsets of all sizes are prefixes of it."""
+    return np.random.default_rng(seed).permutation(n_samples)
+
+
+def nested_rdm_entries(F: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """
+    Entries of the condensed RDM (of the normalized rows F, see `write_condensed_rdm`) between samples start, ...,
+    stop - 1 and all preceding samples. The entries are ordered by the later sample of each pair, s.t. the condensed
+    RDM of the first n samples is a prefix of the one of all samples.
+    """
+    block = 1 - (F[start:stop] @ F[:stop].T).clip(min=-1.0, max=1.0)
+    return block[np.arange(stop)[None, :] < np.arange(start, stop)[:, None]]
+
+
+def nested_normalized_rows(X: np.ndarray, rsa_method: str) -> np.ndarray:
+    if rsa_method not in ['correlation', 'cosine']:
+        raise ValueError(f"Similarity curves are only available for correlation and cosine RDMs, got {rsa_method}.")
+    return _normalized_rows(X, rsa_method)
+
+
+class IncrementalCorrelation:
+    """
+    Pearson correlation between M growing vectors (e.g., nested condensed RDMs), updated with the new entries of all
+    vectors. The entries are shifted by the mean of the first update, which keeps the one-pass formula numerically
+    stable for long vectors.
+    """
+
+    def __init__(self, n_models: int) -> None:
+        self.n = 0
+        self.shift = None
+        self.sums = np.zeros(n_models)
+        self.products = np.zeros((n_models, n_models))
+
+    def add(self, values: np.ndarray) -> None:
+        values = values.astype(np.float64)
+        if self.shift is None:
+            self.shift = values.mean(axis=1, keepdims=True)
+        values -= self.shift
+        self.sums += values.sum(axis=1)
+        self.products += values @ values.T
+        self.n += values.shape[1]
+
+    def correlation_matrix(self) -> np.ndarray:
+        cov = self.products - np.outer(self.sums, self.sums) / self.n
+        std = np.sqrt(np.diag(cov))
+        corr = cov / np.outer(std, std)
+        np.fill_diagonal(corr, 1.0)
+        return corr
+
+
+def get_block_rows(max_bytes: int, n_models: int, n_cols: int, bytes_per_entry: int = 12) -> int:
+    """Number of rows per update, s.t. the (stacked) rows of all models fit into the memory budget."""
+    return max(1, max_bytes // (bytes_per_entry * n_models * n_cols))
+
+
+def get_curve_rows(metric: str, n_samples: int, sim_matrix: np.ndarray,
+                   model_ids: List[str]) -> List[Dict[str, Union[str, int, float]]]:
+    """Rows of the tidy similarity curve table (one per model pair) for one metric and sample size."""
+    return [
+        {'metric': metric, 'model1': model_ids[i], 'model2': model_ids[j], 'n_samples': n_samples,
+         'similarity': float(sim_matrix[i, j])}
+        for i in range(len(model_ids)) for j in range(i + 1, len(model_ids))
+    ]
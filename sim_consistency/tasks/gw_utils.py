@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import ot
+from scipy.spatial.distance import cdist
+
+from sim_consistency.utils.coupling_store import compress_coupling
+
+# Cost function names used in the method slugs and their scipy equivalents
+CDIST_METRICS = {'euclidian': 'euclidean', 'cosine': 'cosine'}
+
+
+def _square_loss(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (a - b) ** 2
+
+
+def _kl_loss(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return a * np.log(a + 1e-15) - a * np.log(b + 1e-15) - a + b
+
+
+LOSS_FUNCTIONS = {'square_loss': _square_loss, 'kl_loss': _kl_loss}
+
+
+def write_cost_matrix(X: np.ndarray, cost_fun: str, out: np.ndarray, block_size: int = 1024) -> np.ndarray:
+    """
+    Writes the pairwise cost matrix of the rows of X, normalized by its maximum, into `out`. The matrix is computed in
+    row blocks, s.t. only `out` (e.g., a memory-mapped file) holds the full N x N matrix.
+    """
+    n = X.shape[0]
+    max_cost = 0.
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = cdist(X[start:stop], X, metric=CDIST_METRICS[cost_fun])
+        out[start:stop] = block
+        max_cost = max(max_cost, block.max())
+    if max_cost > 0:
+        for start in range(0, n, block_size):
+            out[start:start + block_size] /= max_cost
+    return out
+
+
+def get_cost_matrix_cache_key(feature_hash: str, subset_indices: Optional[List[int]], cost_fun: str) -> str:
+    """Content-addressed key of a cost matrix: the hash of the feature file, the subset indices and the cost."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(feature_hash.encode())
+    h.update(json.dumps(subset_indices).encode())
+    h.update(f'gw_{cost_fun}'.encode())
+    return h.hexdigest()
+
+
+def load_or_create_cost_matrix(cache_dir: str, key: str, X_fn, cost_fun: str) -> str:
+    """
+    Returns the path of the normalized cost matrix (float32 .npy) stored under `key` in `cache_dir`. If it does not
+    exist yet, it is computed from the features returned by `X_fn` and written to disk first.
+    """
+    cost_fn = os.path.join(cache_dir, f'{key}.npy')
+    if not os.path.exists(cost_fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        X = X_fn()
+        # Write to a temporary file first, s.t. concurrent jobs never read partially written cost matrices
+        tmp_fn = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npy')
+        out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.float32, shape=(X.shape[0], X.shape[0]))
+        write_cost_matrix(X, cost_fun, out)
+        out.flush()
+        del out
+        os.replace(tmp_fn, cost_fn)
+    return cost_fn
+
+
+def fixed_coupling_gw_distance(C1: np.ndarray, C2: np.ndarray, loss_fun: str = 'square_loss',
+                               block_size: int = 1024) -> float:
+    """
+    GW loss of the identity coupling (T = I / N, i.e., sample i of one model is matched to sample i of the other),
+    which reduces to the mean elementwise loss between the cost matrices. Computed in float32 row blocks, whose
+    losses are accumulated in float64.
+    """
+    n = C1.shape[0]
+    loss = 0.
+    for start in range(0, n, block_size):
+        block_1 = np.asarray(C1[start:start + block_size], dtype=np.float32)
+        block_2 = np.asarray(C2[start:start + block_size], dtype=np.float32)
+        loss += LOSS_FUNCTIONS[loss_fun](block_1, block_2).sum(dtype=np.float64)
+    return loss / n ** 2
+
+
+# Dense N x N arrays (in the dtype of the cost matrices) a worker of the GW solvers holds at its peak: the coupling,
+# its initialization, the gradient and POT's intermediate products. The cost matrices themselves are memory-mapped.
+GW_WORKER_MATRICES = 16
+
+
+def get_gw_dtype(solver: str) -> np.dtype:
+    return np.dtype(np.float32) if solver == 'exact' else np.dtype(np.float64)
+
+
+def get_gw_max_workers(n_samples: int, solver: str, memory_budget: int, max_workers: int) -> int:
+    """Number of GW worker processes (at most `max_workers`) whose dense N x N arrays fit into the memory budget."""
+    per_worker = GW_WORKER_MATRICES * n_samples ** 2 * get_gw_dtype(solver).itemsize
+    return int(max(1, min(max_workers, memory_budget // per_worker)))
+
+
+def compute_gw_distance(
+        C1: np.ndarray,
+        C2: np.ndarray,
+        solver: str = 'exact',
+        loss_fun: str = 'square_loss',
+        epsilon: float = 0.05,
+        nb_samples_grad: int = 100,
+        seed: Optional[int] = None,
+) -> Tuple[float, np.ndarray]:
+    """
+    GW distance of two (normalized) cost matrices with uniform marginals and the learned coupling. Solvers: 'exact'
+    (conditional gradient), 'entropic' (projected gradient with Sinkhorn projections) and 'sampled' (stochastic
+    gradients with (at most N) `nb_samples_grad` sampled indices per step, Kerdoncuff et al., 2021), all from
+    `ot.gromov`. All solvers report the GW loss of their coupling (without entropic term), s.t. the distances of
+    different solvers are comparable.
+
+    The regularization of the entropic and sampled solvers is `epsilon` relative to the scale of the GW gradient
+    (the product of the standard deviations of both cost matrices), s.t. the same value yields a similarly sharp
+    coupling for any pair of cost matrices. Much larger values (e.g., 0.3) converge to almost uniform couplings.
+
+    The samples of both models are paired, hence the exact and entropic solvers start from the identity coupling
+    instead of POT's default, the independent coupling p q^T. The solvers are local, i.e., they find a coupling near
+    the pairing of the samples. Only the exact solver (a descent method) is guaranteed not to end up worse than the
+    fixed coupling.
+
+    The exact solver runs in the dtype of the cost matrices (float32), s.t. the memory-mapped matrices are not copied
+    and its dense N x N arrays take half the memory. The Sinkhorn iterations of the other solvers stop at a tolerance
+    below float32 precision, hence they run in float64.
+    """
+    dtype = get_gw_dtype(solver)
+    C1 = np.asarray(C1, dtype=dtype)
+    C2 = np.asarray(C2, dtype=dtype)
+    n = C1.shape[0]
+    p = ot.utils.unif(n, type_as=C1)
+    q = ot.utils.unif(n, type_as=C2)
+    if solver != 'exact':
+        epsilon = epsilon * float(C1.std() * C2.std())
+    if solver == 'exact':
+        G0 = np.eye(n, dtype=C1.dtype) / n
+        gw_dist, log_gw = ot.gromov.gromov_wasserstein2(C1, C2, p, q, loss_fun=loss_fun, symmetric=True, log=True,
+                                                        G0=G0)
+        return float(gw_dist), log_gw['T']
+    elif solver == 'entropic':
+        G0 = np.eye(n, dtype=C1.dtype) / n
+        gw_dist, log_gw = ot.gromov.entropic_gromov_wasserstein2(C1, C2, p, q, loss_fun=loss_fun, epsilon=epsilon,
+                                                                 symmetric=True, G0=G0, solver='PGD', log=True)
+        return float(gw_dist), log_gw['T']
+    elif solver == 'sampled':
+        # POT samples the gradient indices without replacement from the non-zero entries of the marginals
+        T, log_gw = ot.gromov.sampled_gromov_wasserstein(C1, C2, p, q, loss_fun=LOSS_FUNCTIONS[loss_fun],
+                                                         nb_samples_grad=min(nb_samples_grad, n), epsilon=epsilon,
+                                                         log=True, random_state=seed)
+        # The estimated distance of the sampled gradients is not comparable to the other solvers, hence the GW loss of
+        # the returned coupling is evaluated
+        constC, hC1, hC2 = ot.gromov.init_matrix(C1, C2, p, q, loss_fun=loss_fun)
+        return float(ot.gromov.gwloss(constC, hC1, hC2, T)), T
+    else:
+        raise ValueError(f"Unknown GW solver: {solver}")
+
+
+def gw_distance_from_files(cost_fn_1: str, cost_fn_2: str, fixed_coupling: bool = False,
+                           coupling_top_k: Optional[int] = None, **kwargs) -> Tuple[float, Optional[Tuple]]:
+    """
+    Worker function for process pools: reads the cost matrices of both models from disk (memory-mapped), s.t. only
+    the file names need to be sent to the worker processes. If `coupling_top_k` is set, the coupling is compressed
+    in the worker (see `compress_coupling`), s.t. no dense N x N matrix is sent back.
+    """
+    C1 = np.load(cost_fn_1, mmap_mode='r')
+    C2 = np.load(cost_fn_2, mmap_mode='r')
+    assert C1.shape == C2.shape, "Number of samples should be equal for both models."
+    if fixed_coupling:
+        return fixed_coupling_gw_distance(C1, C2, loss_fun=kwargs.get('loss_fun', 'square_loss')), None
+    gw_dist, T = compute_gw_distance(C1, C2, **kwargs)
+    return gw_dist, compress_coupling(T, coupling_top_k) if coupling_top_k is not None else None
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+
+def compute_knn_graph(X: torch.Tensor, k: int, metric: str = 'cosine', block_size: int = 4096) -> np.ndarray:
+    """
+    Exact k nearest neighbours (excluding the sample itself) of each row of X, sorted by increasing distance
+    (int32, N x k). Computed in row blocks, s.t. only a block_size x N similarity matrix is held in memory.
+    """
+    if metric == 'cosine':
+        X = X / X.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    elif metric != 'euclidean':
+        raise ValueError(f"Unknown kNN metric: {metric}")
+    sq_norms = X.square().sum(dim=1)
+    n = X.shape[0]
+    graph = np.empty((n, k), dtype=np.int32)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        scores = X[start:stop] @ X.T
+        if metric == 'euclidean':
+            # Ranking by -||x - y||^2 = 2 x^T y - ||y||^2 - ||x||^2, where the last term is constant per row
+            scores = 2 * scores - sq_norms[None, :]
+        scores[torch.arange(stop - start), torch.arange(start, stop)] = -float('inf')
+        graph[start:stop] = scores.topk(k, dim=1).indices.cpu().numpy()
+    return graph
+
+
+def compute_knn_graph_faiss(X: np.ndarray, k: int, metric: str = 'cosine', hnsw_m: int = 32) -> np.ndarray:
+    """Approximate k nearest neighbours (excluding the sample itself) using a faiss HNSW index."""
+    try:
+        import faiss
+    except ImportError:
+        raise ImportError("The approximate kNN index requires faiss (e.g., `pip install faiss-cpu`).")
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if metric == 'cosine':
+        faiss.normalize_L2(X)
+        index = faiss.IndexHNSWFlat(X.shape[1], hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    elif metric == 'euclidean':
+        index = faiss.IndexHNSWFlat(X.shape[1], hnsw_m, faiss.METRIC_L2)
+    else:
+        raise ValueError(f"Unknown kNN metric: {metric}")
+    index.add(X)
+    _, neighbours = index.search(X, k + 1)
+    # Drop the sample itself (or the last neighbour if the search missed it)
+    is_self = neighbours == np.arange(X.shape[0])[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    return neighbours[~is_self].reshape(X.shape[0], k).astype(np.int32)
+
+
+def get_knn_cache_key(feature_hash: str, subset_indices: Optional[List[int]], k: int, metric: str,
+                      index: str) -> str:
+    """Content-addressed key of a kNN graph: the hash of the feature file, the subset indices and the graph options."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(feature_hash.encode())
+    h.update(json.dumps(subset_indices).encode())
+    h.update(f'knn_{k}_{metric}_{index}'.encode())
+    return h.hexdigest()
+
+
+def load_or_create_knn_graph(cache_dir: str, key: str, graph_fn) -> np.memmap:
+    """Memory-mapped kNN graph stored under `key`. Computed by `graph_fn` and written to disk first if missing."""
+    fn = os.path.join(cache_dir, f'{key}.npy')
+    if not os.path.exists(fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, s.t. concurrent jobs never read partially written graphs
+        tmp_fn = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npy')
+        np.save(tmp_fn, graph_fn())
+        os.replace(tmp_fn, fn)
+    return np.load(fn, mmap_mode='r')
+
+
+def knn_overlaps(graph_1: np.ndarray, graph_2: np.ndarray, ks: List[int], measure: str = 'mutual_knn') -> List[float]:
+    """
+    Mean overlap of the k-neighbourhoods of each sample in two kNN graphs for each k: the fraction of shared
+    neighbours ('mutual_knn') or the Jaccard index of the neighbour sets ('jaccard'). Since the neighbours of a
+    sample are unique within a graph, the intersection size is the number of duplicates in the joint sorted list.
+    """
+    overlaps = []
+    for k in ks:
+        joint = np.sort(np.concatenate([graph_1[:, :k], graph_2[:, :k]], axis=1), axis=1)
+        n_shared = (joint[:, 1:] == joint[:, :-1]).sum(axis=1)
+        if measure == 'mutual_knn':
+            overlaps.append(float(np.mean(n_shared / k)))
+        elif measure == 'jaccard':
+            overlaps.append(float(np.mean(n_shared / (2 * k - n_shared))))
+        else:
+            raise ValueError(f"Unknown kNN measure: {measure}")
+    return overlaps
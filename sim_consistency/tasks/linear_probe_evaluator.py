@@ -14,6 +14,7 @@ from sim_consistency.eval.metrics import compute_metrics
 from sim_consistency.models.featurizer import Featurizer
 from sim_consistency.tasks.hyperparameter_tuner import HyperparameterTuner
 from sim_consistency.tasks.linear_probe import LinearProbe
+from sim_consistency.utils.utils import has_array
 
 
 class BaseEvaluator:
@@ -74,15 +75,15 @@ class BaseEvaluator:
             if verbose:
                 print(f'Create path to store features: {feature_dir}')
             return False
-        filenames_to_check = ['features_test.pt', 'targets_test.pt']
+        arrays_to_check = [('features', 'test'), ('targets', 'test')]
         if check_train:
-            filenames_to_check += ['features_train.pt', 'targets_train.pt']
+            arrays_to_check += [('features', 'train'), ('targets', 'train')]
         all_exist = True
-        for filename in filenames_to_check:
-            if not os.path.exists(os.path.join(feature_dir, filename)):
+        for name, split in arrays_to_check:
+            if not has_array(feature_dir, name, split):
                 all_exist = False
                 if verbose:
-                    print(f"File {filename} is missing in {feature_dir}.")
+                    print(f"File {name}_{split} (.pt or .npy) is missing in {feature_dir}.")
                 break
         return all_exist
 
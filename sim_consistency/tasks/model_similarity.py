@@ -1,32 +1,108 @@
+import copy
+import glob
+import hashlib
 import json
 import os
+import tempfile
 import warnings
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
-from typing import Tuple, List, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import Tuple, List, Optional, Dict, Set, Union
 
 import numpy as np
-import ot
-from scipy.spatial.distance import cdist
-from thingsvision.core.cka import get_cka
-from thingsvision.core.rsa import compute_rdm, correlate_rdms
+import pandas as pd
+import torch
 from tqdm import tqdm
 
-from sim_consistency.utils.utils import load_features, check_models
+from sim_consistency.tasks.bootstrap_utils import get_bootstrap_indices, summarize_bootstrap
+from sim_consistency.tasks.cka_utils import (apply_kernel, center_kernel, hsic, linear_hsic_matrix,
+                                             cka_from_hsic_matrix, center_features, feature_space_linear_hsic,
+                                             squared_distances, median_sigma, rbf_kernel_from_distances,
+                                             linear_kernel, get_minibatch_indices, rbf_kernel, sample_median_sigma,
+                                             random_fourier_features, nystroem_features, squared_distances_between,
+                                             IncrementalHSIC, blockwise_median_sigma)
+from sim_consistency.tasks.curve_utils import (IncrementalCorrelation, get_block_rows, get_curve_rows,
+                                               get_nested_order, nested_normalized_rows, nested_rdm_entries)
+from sim_consistency.tasks.gw_utils import (get_cost_matrix_cache_key, get_gw_max_workers, gw_distance_from_files,
+                                            load_or_create_cost_matrix)
+from sim_consistency.tasks.knn_utils import (compute_knn_graph, compute_knn_graph_faiss, get_knn_cache_key,
+                                             load_or_create_knn_graph, knn_overlaps)
+from sim_consistency.tasks.rsa_utils import (compute_condensed_rdm, correlate_condensed_rdms, get_rdm_cache_key,
+                                             load_or_create_condensed_rdm, load_or_create_standardized_rdm, n_condensed,
+                                             resample_condensed_indices, rsa_correlation_matrix, standardize_rdm)
+from sim_consistency.tasks.sharding import get_shard_pairs
+from sim_consistency.tasks.svd_utils import (SVD_METHODS, get_svd_cache_key, load_or_create_svd, svd_similarities,
+                                             truncated_svd)
+from sim_consistency.utils.cache import LRUCache
+from sim_consistency.utils.coupling_store import CouplingStore
+from sim_consistency.utils.journal import PairJournal
+from sim_consistency.utils.precision import get_numpy_dtype, get_torch_dtype, to_storage
+from sim_consistency.utils.utils import load_features, check_models, get_feature_shape, get_feature_hash
+
+
+# Journal of the pairs computed by an unfinished job (or by the shards of a sharded job), stored next to the
+# similarity matrix. Jobs that recompute all pairs write (and resume from) separate journals.
+JOURNAL_FN = 'pair_journal.jsonl'
+RECOMPUTE_JOURNAL_FN = 'pair_journal_recompute.jsonl'
+
+
+def get_journal_fn(shard: Optional[Tuple[int, int]] = None, recompute: bool = False) -> str:
+    journal_fn = RECOMPUTE_JOURNAL_FN if recompute else JOURNAL_FN
+    if shard is None:
+        return journal_fn
+    return journal_fn.replace('.jsonl', f'_shard_{shard[0]}_of_{shard[1]}.jsonl')
+
+
+def read_journals(results_path: str, recompute: bool = False) -> Dict[Tuple[str, str], Tuple[str, float]]:
+    """
+    Pair keys and values of all journals (of unsharded and sharded runs) in `results_path`. With `recompute`, only the
+    journals of runs that recompute all pairs are read.
+    """
+    pattern = 'pair_journal_recompute*.jsonl' if recompute else 'pair_journal*.jsonl'
+    entries = {}
+    for journal_fn in sorted(glob.glob(os.path.join(results_path, pattern))):
+        entries.update(PairJournal(journal_fn).read())
+    return entries
 
 
 class BaseModelSimilarity:
     def __init__(self, feature_root: str, subset_root: Optional[str], split: str = 'train', device: str = 'cuda',
-                 max_workers: int = 4) -> None:
+                 max_workers: int = 4, cache_size_gb: float = 32., cache: Optional[LRUCache] = None,
+                 feature_cache: Optional[LRUCache] = None, cache_root: Optional[str] = None,
+                 compute_dtype: str = 'float32', storage_dtype: Optional[str] = None,
+                 memory_budget_gb: Optional[float] = None, scratch_root: Optional[str] = None) -> None:
         self.feature_root = feature_root
         self.split = split
         self.device = device
         self.model_ids = []
         self.max_workers = max_workers
         self.subset_indices = self._load_subset_indices(subset_root)
+        # Cache for derived per-model quantities (kernels, RDMs, ...). It can be shared between several metrics.
+        self.cache = cache if cache is not None else LRUCache(max_bytes=int(cache_size_gb * 1024 ** 3))
+        # Optional cache for the raw features, s.t. several metrics only read each feature file once.
+        self.feature_cache = feature_cache
+        # Optional directory for persistent on-disk caches that are reused across runs.
+        self.cache_root = cache_root
+        # Pairs (idx1 < idx2) that need to be computed. All pairs if None (see `update_similarity_matrices`).
+        self.pairs = None
+        # Precision policy: features are converted to the compute dtype (reductions are accumulated in float64), cached
+        # kernels and RDMs are stored in the storage dtype (e.g., float16 to halve their memory and bandwidth)
+        self.compute_dtype = compute_dtype
+        self.storage_dtype = storage_dtype or compute_dtype
+        get_torch_dtype(self.compute_dtype)
+        get_torch_dtype(self.storage_dtype)
+        # Memory budget of the out-of-core (blockwise) engines, which tile N x N kernels and RDMs over memory-mapped
+        # scratch files in a temporary directory under `scratch_root` (the system default if None)
+        self.memory_budget = self.cache.max_bytes if memory_budget_gb is None else int(memory_budget_gb * 1024 ** 3)
+        self.scratch_root = scratch_root
+        # Journals of the computed pairs per method slug and the corresponding pair keys (only set during
+        # `update_similarity_matrices`)
+        self.journals = None
+        self.pair_keys = None
         self.name = 'Base'
 
     def _load_subset_indices(self, subset_root) -> Optional[List[int]]:
+        if subset_root is None:
+            return None
         subset_path = os.path.join(subset_root, f'subset_indices_{self.split}.json')
         if not os.path.exists(subset_path):
             warnings.warn(
@@ -45,6 +121,38 @@ class BaseModelSimilarity:
     def _prepare_sim_matrix(self) -> np.ndarray:
         return np.ones((len(self.model_ids_with_idx), len(self.model_ids_with_idx)))
 
+    def _needs_pair(self, idx1: int, idx2: int) -> bool:
+        return self.pairs is None or (min(idx1, idx2), max(idx1, idx2)) in self.pairs
+
+    def _record_pair(self, method_slug: str, idx1: int, idx2: int, value: float) -> None:
+        if self.journals is None:
+            return
+        model1, model2 = self.model_ids[min(idx1, idx2)], self.model_ids[max(idx1, idx2)]
+        self.journals[method_slug].append(model1, model2, self.pair_keys[method_slug][(model1, model2)], value)
+
+    def _record_matrix(self, method_slug: str, sim_matrix: np.ndarray) -> None:
+        for idx1 in range(len(self.model_ids)):
+            for idx2 in range(idx1 + 1, len(self.model_ids)):
+                if self._needs_pair(idx1, idx2):
+                    self._record_pair(method_slug, idx1, idx2, sim_matrix[idx1, idx2])
+
+    def _get_active_indices(self) -> List[int]:
+        """Indices of the models that are part of at least one pair that needs to be computed."""
+        if self.pairs is None:
+            return list(range(len(self.model_ids)))
+        return sorted(set(idx for pair in self.pairs for idx in pair))
+
+    def _get_features(self, model_id: str) -> torch.Tensor:
+        """Features of the model (of the subset of samples) in the compute dtype, regardless of the stored dtype."""
+        def load():
+            features = load_features(self.feature_root, model_id, self.split, self.subset_indices)
+            return features.to(get_torch_dtype(self.compute_dtype))
+
+        if self.feature_cache is None:
+            return load()
+        key = ('features', self.feature_root, self.split, model_id)
+        return self.feature_cache.get_or_compute(key, load)
+
     def _load_feature(self, model_id: str) -> np.ndarray:
         raise NotImplementedError()
 
@@ -64,11 +172,13 @@ class BaseModelSimilarity:
         sim_matrix = self._prepare_sim_matrix()
         max_workers = self.max_workers
         for idx1, model1 in tqdm(self.model_ids_with_idx, desc=f"Computing {self.name} matrix"):
+            if not any(self._needs_pair(idx1, idx2) for idx2 in range(idx1 + 1, len(self.model_ids))):
+                continue
             features_1 = self._load_feature(model_id=model1)
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 futures = {}
                 for idx2, model2 in self.model_ids_with_idx:
-                    if idx1 < idx2:
+                    if idx1 < idx2 and self._needs_pair(idx1, idx2):
                         future = executor.submit(self.compute_pairwise_similarity, features_1, model2)
                         futures[future] = (idx1, idx2)
 
@@ -76,79 +186,769 @@ class BaseModelSimilarity:
                     cidx1, cidx2 = futures[future]
                     rho = future.result()
                     sim_matrix[cidx1, cidx2] = rho
+                    self._record_pair(self.get_name(), cidx1, cidx2, rho)
         upper_tri = np.triu(sim_matrix)
         sim_matrix = upper_tri + upper_tri.T - np.diag(np.diag(sim_matrix))
         return sim_matrix
 
+    def compute_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        """Similarity matrices of all metric variants computed by this instance, indexed by their method slug."""
+        return {self.get_name(): self.compute_similarity_matrix()}
+
+    def validate_precision(self, n_samples: int = 1000, seed: int = 0) -> Dict[str, float]:
+        """
+        Maximum absolute deviation of the similarity matrices computed with the configured compute and storage dtypes
+        from a float64 reference on a random sample of (at most) `n_samples` samples, indexed by the method slug. Both
+        runs use separate in-memory caches and no on-disk caches, s.t. nothing of the validation is reused later.
+        """
+        n_total = get_feature_shape(self.feature_root, self.model_ids[0], self.split, self.subset_indices)[0]
+        rows = get_minibatch_indices(n_total, n_samples, 1, seed=seed)[0]
+        subset_indices = [self.subset_indices[i] for i in rows] if self.subset_indices else rows.tolist()
+        sim_matrices = []
+        for compute_dtype, storage_dtype in [(self.compute_dtype, self.storage_dtype), ('float64', 'float64')]:
+            model_similarity = copy.copy(self)
+            model_similarity.subset_indices = subset_indices
+            model_similarity.compute_dtype, model_similarity.storage_dtype = compute_dtype, storage_dtype
+            model_similarity.cache = LRUCache(max_bytes=self.cache.max_bytes)
+            model_similarity.feature_cache = None
+            model_similarity.cache_root = None
+            model_similarity.pairs, model_similarity.journals, model_similarity.pair_keys = None, None, None
+            sim_matrices.append(model_similarity.compute_similarity_matrices())
+
+        deviations = {}
+        for name, sim_matrix in sim_matrices[0].items():
+            deviations[name] = float(np.abs(sim_matrix - sim_matrices[1][name]).max())
+            print(f"Max. absolute deviation of {name} ({self.compute_dtype} compute, {self.storage_dtype} storage) "
+                  f"from float64 on {len(rows)} samples: {deviations[name]:.2e}")
+        return deviations
+
+    def compute_bootstrap_matrices(self, n_resamples: int, seed: int = 0,
+                                   confidence: float = 0.95) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Mean, standard deviation and percentile interval of each entry of the similarity matrices over `n_resamples`
+        bootstrap resamples of the samples, indexed by the method slug (see `summarize_bootstrap`).
+        """
+        raise ValueError(f"Bootstrap intervals are only available for CKA and RSA, not for {self.name}.")
+
+    def compute_similarity_curves(self, sizes: List[int], seed: int = 0) -> List[Dict[str, Union[str, int, float]]]:
+        """
+        Similarity of all model pairs on nested random subsets of the samples (prefixes of one random order) of the
+        given sizes, as rows of a tidy table (metric, model1, model2, n_samples, similarity).
+        """
+        raise ValueError(f"Similarity curves are only available for CKA and RSA, not for {self.name}.")
+
+    def _get_curve_order(self, sizes: List[int], seed: int) -> np.ndarray:
+        n_samples = get_feature_shape(self.feature_root, self.model_ids[0], self.split, self.subset_indices)[0]
+        assert max(sizes) <= n_samples, f"Subset sizes should not exceed the number of samples ({n_samples})."
+        return get_nested_order(n_samples, seed)[:max(sizes)]
+
+    def get_model_fingerprint(self, model_id: str) -> str:
+        """Hash of the model id, its feature file, and the subset of samples used for the similarity computation."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(model_id.encode())
+        h.update(get_feature_hash(self.feature_root, model_id, self.split).encode())
+        h.update(json.dumps(self.subset_indices).encode())
+        return h.hexdigest()
+
+    def get_pair_keys(self, method_slug: str) -> Dict[Tuple[str, str], str]:
+        """
+        Keys of all model pairs (in the order of the model ids) for the metric `method_slug`. A key changes whenever
+        one of the models, its features, or the metric changes, s.t. stale entries of previous results are detected.
+        """
+        fingerprints = [self.get_model_fingerprint(model_id) for model_id in self.model_ids]
+        pair_keys = {}
+        for idx1, model1 in self.model_ids_with_idx:
+            for idx2 in range(idx1 + 1, len(self.model_ids)):
+                h = hashlib.blake2b(digest_size=20)
+                h.update(f"{fingerprints[idx1]}/{fingerprints[idx2]}/{method_slug}".encode())
+                pair_keys[(model1, self.model_ids[idx2])] = h.hexdigest()
+        return pair_keys
+
+    def get_shard_pairs(self, num_shards: int, shard_index: int) -> Set[Tuple[int, int]]:
+        """Pairs of models assigned to shard `shard_index`, balanced by the number of samples and feature dims."""
+        shapes = [get_feature_shape(self.feature_root, model_id, self.split, self.subset_indices)
+                  for model_id in self.model_ids]
+        return get_shard_pairs(shapes[0][0], [dim for _, dim in shapes], num_shards, shard_index)
+
+    def update_similarity_matrices(
+            self,
+            results_root: str,
+            checkpoint_interval: float = 60.,
+            shard: Optional[Tuple[int, int]] = None,
+            compute_missing: bool = True,
+            recompute: bool = False,
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, Dict[Tuple[str, str], str]]]:
+        """
+        Incremental version of `compute_similarity_matrices`: pairs of previous results stored under
+        `results_root/<method_slug>` are reused if their pair key is unchanged, only the remaining pairs are computed.
+        Models that are not part of the current model ids are dropped. Computed pairs are checkpointed to an
+        append-only journal in the same folder (flushed every `checkpoint_interval` seconds), s.t. a restarted job
+        skips the pairs finished before. Returns the matrices (in the order of the current model ids) and the pair
+        keys of each metric.
+
+        If `shard` = (shard_index, num_shards) is given, only the missing pairs of this shard are computed and
+        journaled in a separate journal per shard. With `compute_missing=False`, nothing is computed (merge of the
+        shard journals), and missing pairs raise an error.
+
+        With `recompute=True`, previous results and the journals of other runs are ignored, i.e., all pairs are
+        computed. The pairs are still journaled (in separate recompute journals), s.t. a restarted recompute job (or
+        the merge of its shards) only reuses the pairs computed by the recompute job itself.
+        """
+        names = self.get_names()
+        index = {model_id: idx for idx, model_id in self.model_ids_with_idx}
+        all_pair_keys = {name: self.get_pair_keys(name) for name in names}
+        journal_fn = get_journal_fn(shard, recompute)
+        journals = {name: PairJournal(os.path.join(results_root, name, journal_fn), flush_interval=checkpoint_interval)
+                    for name in names}
+        reused = {name: {} for name in names}
+        missing = set()
+        for name in names:
+            previous = None if recompute else load_similarity_results(os.path.join(results_root, name))
+            prev_matrix, prev_ids, prev_keys = previous if previous is not None else (None, [], {})
+            prev_index = {model_id: idx for idx, model_id in enumerate(prev_ids)}
+            journaled = read_journals(os.path.join(results_root, name), recompute=recompute)
+            for (model1, model2), key in all_pair_keys[name].items():
+                pair = (index[model1], index[model2])
+                if prev_keys.get((model1, model2)) == key:
+                    reused[name][pair] = prev_matrix[prev_index[model1], prev_index[model2]]
+                elif journaled.get((model1, model2), (None,))[0] == key:
+                    reused[name][pair] = journaled[(model1, model2)][1]
+                else:
+                    missing.add(pair)
+
+        n_reused = len(all_pair_keys[names[0]]) - len(missing)
+        if shard is not None:
+            missing &= self.get_shard_pairs(num_shards=shard[1], shard_index=shard[0])
+        print(f"Reusing {n_reused} model pairs of previous results, computing {len(missing)} model pairs.")
+        if missing and not compute_missing:
+            raise RuntimeError(f"{len(missing)} model pairs are neither part of previous results nor of any journal "
+                               f"in {results_root}.")
+        if missing:
+            self.pairs, self.journals, self.pair_keys = missing, journals, all_pair_keys
+            try:
+                sim_matrices = self.compute_similarity_matrices()
+            finally:
+                for journal in journals.values():
+                    journal.flush()
+                self.pairs, self.journals, self.pair_keys = None, None, None
+        else:
+            sim_matrices = {name: self._prepare_sim_matrix() for name in names}
+
+        for name in names:
+            for (idx1, idx2), value in reused[name].items():
+                sim_matrices[name][idx1, idx2] = value
+                sim_matrices[name][idx2, idx1] = value
+        return sim_matrices, all_pair_keys
+
+    def get_name(self) -> str:
+        raise NotImplementedError()
+
+    def get_names(self) -> List[str]:
+        return [self.get_name()]
+
     def get_model_ids(self) -> List[str]:
         return self.model_ids
 
 
 class CKAModelSimilarity(BaseModelSimilarity):
     def __init__(self, feature_root: str, subset_root: Optional[str], split: str = 'train', device: str = 'cuda',
-                 kernel: str = 'linear', backend: str = 'torch', unbiased: bool = True, sigma: Optional[float] = None,
-                 max_workers: int = 4) -> None:
+                 kernel: str = 'linear', backend: str = 'torch', unbiased: bool = True,
+                 sigma: Optional[Union[float, List[float]]] = None, max_workers: int = 4, cache_size_gb: float = 32.,
+                 engine: str = 'auto', block_size: int = 8192, feature_space_ratio: float = 4.,
+                 cache: Optional[LRUCache] = None, feature_cache: Optional[LRUCache] = None,
+                 minibatch_size: int = 1024, n_minibatches: int = 100, seed: int = 0, approx_rank: int = 2048,
+                 approx_validation_size: int = 500, compute_dtype: str = 'float32',
+                 storage_dtype: Optional[str] = None, memory_budget_gb: Optional[float] = None,
+                 scratch_root: Optional[str] = None) -> None:
         super().__init__(feature_root=feature_root, subset_root=subset_root, split=split, device=device,
-                         max_workers=max_workers)
+                         max_workers=max_workers, cache_size_gb=cache_size_gb, cache=cache,
+                         feature_cache=feature_cache, compute_dtype=compute_dtype, storage_dtype=storage_dtype,
+                         memory_budget_gb=memory_budget_gb, scratch_root=scratch_root)
         self.kernel = kernel
         self.backend = backend
         self.unbiased = unbiased
-        self.sigma = sigma
+        # Several sigmas share the squared distances of each model and are computed in one pass.
+        self.sigmas = list(sigma) if isinstance(sigma, (list, tuple)) else [sigma]
+        if kernel != 'rbf':
+            self.sigmas = self.sigmas[:1]
+        self.sigma = self.sigmas[0]
+        self.name = 'CKA'
 
-    # def _load_feature(self, model_id:str) -> np.ndarray:
-    #     features = load_features(self.feature_root, model_id, self.split, self.subset_indices)
-    #     return features
+        if engine not in ['auto', 'gram', 'feature', 'batched', 'minibatch', 'rff', 'nystroem', 'blockwise']:
+            raise ValueError(f"Unknown CKA engine: {engine}")
+        if engine in ['feature', 'batched'] and kernel != 'linear':
+            raise ValueError(f"The {engine} CKA engine is only available for the linear kernel.")
+        if engine in ['rff', 'nystroem'] and kernel != 'rbf':
+            raise ValueError(f"The {engine} CKA engine is only available for the rbf kernel.")
+        self.engine = engine
+        self.block_size = block_size
+        self.feature_space_ratio = feature_space_ratio
+        # Minibatch CKA (Nguyen et al., 2021) averages the HSIC over fixed random minibatches of samples
+        self.minibatch_size = minibatch_size
+        self.n_minibatches = n_minibatches
+        self.seed = seed
+        # Rank of the random Fourier features / number of Nystroem landmarks approximating the rbf kernel, and the
+        # number of samples used to report the approximation error (0 to skip)
+        self.approx_rank = approx_rank
+        self.approx_validation_size = approx_validation_size
+        self.approx_errors = {}
 
-    # def _compute_similarity(self, feat1: np.ndarray, feat2: np.ndarray) -> float:
-    #     m = feat1.shape[0]
-    #     cka = get_cka(backend=self.backend, m=m, kernel=self.kernel, unbiased=self.unbiased, device=self.device,
-    #                     sigma=self.sigma)
-    #     rho = cka.compare(X=feat1, Y=feat2)
-    #     return rho
+    def _select_engine(self) -> str:
+        """
+        In 'auto' mode, linear CKA is computed in feature space (D x D cross-covariances) whenever the feature
+        dimension is much smaller than the number of samples. If the stacked features of all models (in the compute
+        dtype) fit into the cache budget, all pairs are computed at once ('batched'), otherwise pair by pair
+        ('feature').
+        """
+        if self.engine != 'auto':
+            return self.engine
+        if self.kernel != 'linear':
+            return 'gram'
+        shapes = [get_feature_shape(self.feature_root, model_id, self.split, self.subset_indices)
+                  for model_id in self.model_ids]
+        n_samples = shapes[0][0]
+        if max(dim for _, dim in shapes) * self.feature_space_ratio > n_samples:
+            return 'gram'
+        stacked_bytes = n_samples * sum(dim for _, dim in shapes) * np.dtype(self.compute_dtype).itemsize
+        return 'batched' if stacked_bytes <= self.cache.max_bytes else 'feature'
 
-    def compute_similarity_matrix(self) -> np.ndarray:
+    def _load_feature(self, model_id: str) -> torch.Tensor:
+        return self._get_features(model_id).to(self.device)
+
+    def _compute_sq_distances(self, model_id: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        D = squared_distances(self._load_feature(model_id))
+        return D, median_sigma(D)
+
+    def _get_sq_distances(self, model_id: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Squared distances between samples and the median heuristic sigma, shared by all rbf kernel widths."""
+        key = ('sq_distances', model_id)
+        return self.cache.get_or_compute(key, lambda: self._compute_sq_distances(model_id))
+
+    def _compute_kernel(self, model_id: str, sigma: Optional[float]) -> torch.Tensor:
+        if self.kernel == 'rbf':
+            D, sigma_median = self._get_sq_distances(model_id)
+            return rbf_kernel_from_distances(D, sigma_median if sigma is None else sigma, inplace=False)
+        return apply_kernel(self._load_feature(model_id), kernel=self.kernel)
+
+    def _get_kernel(self, model_id: str, sigma: Optional[float]) -> torch.Tensor:
+        """Uncentered gram matrix (in the storage dtype), shared by all bootstrap resamples."""
+        key = ('kernel', model_id, self.kernel, sigma)
+        return self.cache.get_or_compute(key, lambda: to_storage(self._compute_kernel(model_id, sigma),
+                                                                 self.storage_dtype))
+
+    def _compute_centered_kernel(self, model_id: str, sigma: Optional[float]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Centered in the compute dtype, half precision storage is rescaled (CKA is invariant to the scale of K_c)
+        K_c = center_kernel(self._compute_kernel(model_id, sigma), unbiased=self.unbiased)
+        K_c = to_storage(K_c, self.storage_dtype)
+        return K_c, hsic(K_c, K_c)
+
+    def _get_centered_kernel(self, model_id: str, sigma: Optional[float]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Centered gram matrix and its self-HSIC. Computed once per model and kept in the LRU cache."""
+        key = ('centered_kernel', model_id, self.kernel, sigma, self.unbiased)
+        return self.cache.get_or_compute(key, lambda: self._compute_centered_kernel(model_id, sigma))
+
+    def _compute_centered_features(self, model_id: str) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        X_c, sq_norms = center_features(self._load_feature(model_id))
+        return X_c, sq_norms, feature_space_linear_hsic(X_c, sq_norms, X_c, sq_norms, unbiased=self.unbiased)
+
+    def _get_centered_features(self, model_id: str) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Column-centered features, their squared row norms and their self-HSIC (linear kernel only)."""
+        key = ('centered_features', model_id, self.unbiased)
+        return self.cache.get_or_compute(key, lambda: self._compute_centered_features(model_id))
+
+    def _compute_rbf_features(self, X: torch.Tensor, sigma: Optional[float], rank: int) -> torch.Tensor:
+        if sigma is None:
+            sigma = sample_median_sigma(X, seed=self.seed)
+        if self.engine == 'rff':
+            return random_fourier_features(X, sigma, rank, seed=self.seed)
+        return nystroem_features(X, sigma, rank, seed=self.seed)
+
+    def _compute_centered_rbf_features(self, model_id: str,
+                                       sigma: Optional[float]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        Phi_c, sq_norms = center_features(self._compute_rbf_features(self._load_feature(model_id), sigma,
+                                                                     self.approx_rank))
+        return Phi_c, sq_norms, feature_space_linear_hsic(Phi_c, sq_norms, Phi_c, sq_norms, unbiased=self.unbiased)
+
+    def _get_centered_rbf_features(self, model_id: str,
+                                   sigma: Optional[float]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Column-centered low-rank features approximating the rbf kernel (random Fourier features or Nystroem), their
+        squared row norms and their self-HSIC. With sigma None, the median heuristic is estimated from a sample.
+        """
+        key = ('centered_rbf_features', model_id, self.engine, sigma, self.approx_rank, self.seed, self.unbiased)
+        return self.cache.get_or_compute(key, lambda: self._compute_centered_rbf_features(model_id, sigma))
+
+    def _report_approximation_error(self) -> None:
+        """
+        Compares the approximate and the exact rbf CKA of all models on a random sample of the data and reports the
+        maximum absolute deviation per sigma (also kept in `self.approx_errors`). The number of Nystroem landmarks is
+        capped at half the sample size, s.t. the approximation does not become exact on the sample.
+        """
+        active = self._get_active_indices()
+        n_samples = len(self.subset_indices) if self.subset_indices else \
+            get_feature_shape(self.feature_root, self.model_ids[active[0]], self.split)[0]
+        rows = get_minibatch_indices(n_samples, self.approx_validation_size, 1, seed=self.seed)[0]
+        rank = self.approx_rank if self.engine == 'rff' else min(self.approx_rank, len(rows) // 2)
+        for name, sigma in zip(self.get_names(), self.sigmas):
+            exact_hsic = torch.zeros(len(active), len(active), dtype=torch.float64)
+            approx_hsic = torch.zeros(len(active), len(active), dtype=torch.float64)
+            kernels, approx_features = [], []
+            for idx in active:
+                X = self._load_feature(self.model_ids[idx])[torch.from_numpy(rows).to(self.device)].float()
+                kernels.append(center_kernel(rbf_kernel(X, sigma), unbiased=self.unbiased))
+                approx_features.append(center_features(self._compute_rbf_features(X, sigma, rank)))
+            for i in range(len(active)):
+                for j in range(i, len(active)):
+                    exact_hsic[i, j] = exact_hsic[j, i] = hsic(kernels[i], kernels[j]).double().cpu()
+                    approx_hsic[i, j] = approx_hsic[j, i] = feature_space_linear_hsic(
+                        *approx_features[i], *approx_features[j], unbiased=self.unbiased)
+            error = np.abs(cka_from_hsic_matrix(approx_hsic) - cka_from_hsic_matrix(exact_hsic)).max()
+            self.approx_errors[name] = float(error)
+            print(f"Max. absolute deviation of {self.engine} (rank {rank}) from exact rbf CKA on {len(rows)} "
+                  f"samples for sigma {sigma}: {error:.4f}")
+
+    def _compute_batched_similarity_matrix(self) -> np.ndarray:
+        active = self._get_active_indices()
+        features = [self._load_feature(self.model_ids[idx]) for idx in tqdm(active, desc="Loading features")]
+        assert len(set(feat.shape[0] for feat in features)) == 1, \
+            f"Number of features should be equal for CKA computation. (feature_root: {self.feature_root})"
+        hsic_matrix = linear_hsic_matrix(features, unbiased=self.unbiased, block_size=self.block_size)
         sim_matrix = self._prepare_sim_matrix()
+        sim_matrix[np.ix_(active, active)] = cka_from_hsic_matrix(hsic_matrix)
+        self._record_matrix(self.get_name(), sim_matrix)
+        return sim_matrix
+
+    def _compute_minibatch_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        """
+        CKA from the HSIC averaged over fixed random minibatches. The features are memory-mapped and only the rows
+        of the current minibatch are read, hence the memory only depends on the minibatch size and the number of
+        models. For each minibatch, the flattened centered gram matrices of all models are stacked, s.t. the HSIC of
+        all pairs is one matrix product.
+        """
+        active = self._get_active_indices()
+        features = [load_features(self.feature_root, self.model_ids[idx], self.split, mmap=True) for idx in active]
+        assert len(set(feat.shape[0] for feat in features)) == 1, \
+            f"Number of features should be equal for CKA computation. (feature_root: {self.feature_root})"
+        sample_indices = np.asarray(self.subset_indices) if self.subset_indices else np.arange(features[0].shape[0])
+        batches = get_minibatch_indices(len(sample_indices), self.minibatch_size, self.n_minibatches, self.seed)
+
+        hsic_matrices = [torch.zeros(len(active), len(active), dtype=torch.float64) for _ in self.sigmas]
+        for batch in tqdm(batches, desc="Computing minibatch CKA"):
+            rows = torch.from_numpy(sample_indices[batch])
+            stacked = [torch.empty(len(active), len(batch) ** 2, device=self.device) for _ in self.sigmas]
+            for i, X in enumerate(features):
+                X_b = X[rows].to(self.device, get_torch_dtype(self.compute_dtype))
+                if self.kernel == 'rbf':
+                    D = squared_distances(X_b)
+                    kernels = [rbf_kernel_from_distances(D, sigma, inplace=False) for sigma in self.sigmas]
+                else:
+                    kernels = [linear_kernel(X_b)]
+                for S, K in zip(stacked, kernels):
+                    S[i] = center_kernel(K, unbiased=self.unbiased).reshape(-1)
+            for hsic_matrix, S in zip(hsic_matrices, stacked):
+                hsic_matrix += (S.double() @ S.double().T).cpu()
+
+        sim_matrices = {}
+        for name, hsic_matrix in zip(self.get_names(), hsic_matrices):
+            sim_matrices[name] = self._prepare_sim_matrix()
+            sim_matrices[name][np.ix_(active, active)] = cka_from_hsic_matrix(hsic_matrix / len(batches))
+            self._record_matrix(name, sim_matrices[name])
+        return sim_matrices
+
+    def _write_scratch_kernel(self, model_id: str, fn: str) -> np.memmap:
+        """
+        Writes the gram matrix (linear kernel) or the squared distances (rbf kernel, with an exact zero diagonal) of the
+        model to a memory-mapped float32 scratch file, in row blocks that fit into the memory budget.
+        """
+        X = self._load_feature(model_id)
+        n = X.shape[0]
+        out = np.lib.format.open_memmap(fn, mode='w+', dtype=np.float32, shape=(n, n))
+        block_rows = get_block_rows(self.memory_budget, 1, n, bytes_per_entry=16)
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            if self.kernel == 'rbf':
+                block = squared_distances_between(X[start:stop], X)
+                rows = torch.arange(stop - start, device=block.device)
+                block[rows, start + rows] = 0
+            else:
+                block = X[start:stop] @ X.T
+            out[start:stop] = block.float().cpu().numpy()
+        out.flush()
+        return out
+
+    def _compute_blockwise_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        """
+        Out-of-core CKA for sample sizes whose gram matrices do not fit into memory. The gram matrix (linear kernel) or
+        the squared distances (rbf kernel) of each model are written to a memory-mapped scratch file, and the HSIC
+        statistics of all pairs are accumulated from row blocks of the lower triangles of all scratch files (see
+        `IncrementalHSIC`), whose centering only needs the row sums. The number of rows per block is derived from the
+        memory budget. With the median heuristic, sigma is computed exactly from the scratch files.
+        """
+        active = self._get_active_indices()
+        with tempfile.TemporaryDirectory(dir=self.scratch_root) as scratch_dir:
+            kernels = [self._write_scratch_kernel(self.model_ids[idx], os.path.join(scratch_dir, f'{idx}.npy'))
+                       for idx in tqdm(active, desc="Writing scratch kernels")]
+            assert len(set(K.shape[0] for K in kernels)) == 1, \
+                f"Number of features should be equal for CKA computation. (feature_root: {self.feature_root})"
+            n = kernels[0].shape[0]
+            if self.kernel == 'rbf':
+                median_block_rows = get_block_rows(self.memory_budget, 1, n, bytes_per_entry=16)
+                medians = [blockwise_median_sigma(D, median_block_rows) if None in self.sigmas else None
+                           for D in tqdm(kernels, desc="Computing median heuristic")]
+                sigmas = [[median if sigma is None else sigma for median in medians] for sigma in self.sigmas]
+            else:
+                sigmas = [[None] * len(kernels)]
+            stats = [IncrementalHSIC(len(kernels), n, device=self.device) for _ in self.sigmas]
+
+            # Per entry: the scratch rows, the kernel rows and their stacked float32 and float64 copies
+            block_rows = get_block_rows(self.memory_budget, len(kernels), n, bytes_per_entry=20)
+            for start in tqdm(range(0, n, block_rows), desc="Computing blockwise CKA"):
+                stop = min(start + block_rows, n)
+                rows = [torch.from_numpy(np.array(K[start:stop, :stop])).to(self.device) for K in kernels]
+                for model_sigmas, model_stats in zip(sigmas, stats):
+                    if self.kernel == 'rbf':
+                        blocks = [rbf_kernel_from_distances(D, sigma, inplace=False)
+                                  for D, sigma in zip(rows, model_sigmas)]
+                    else:
+                        blocks = rows
+                    model_stats.add_rows(blocks)
+
+        sim_matrices = {}
+        for name, model_stats in zip(self.get_names(), stats):
+            sim_matrices[name] = self._prepare_sim_matrix()
+            sim_matrices[name][np.ix_(active, active)] = cka_from_hsic_matrix(
+                model_stats.hsic_matrix(unbiased=self.unbiased))
+            self._record_matrix(name, sim_matrices[name])
+        return sim_matrices
+
+    def compute_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        engine = self._select_engine()
+        if engine == 'batched':
+            return {self.get_name(): self._compute_batched_similarity_matrix()}
+        if engine == 'minibatch':
+            return self._compute_minibatch_similarity_matrices()
+        if engine == 'blockwise':
+            return self._compute_blockwise_similarity_matrices()
+
+        if engine in ['rff', 'nystroem'] and self.approx_validation_size > 0:
+            self._report_approximation_error()
+
+        if engine in ['feature', 'rff', 'nystroem']:
+            # The approximations of the rbf kernel are low-rank features, which are compared like linear features
+            def get_stats(model_id, sigma):
+                if engine == 'feature':
+                    X_c, sq_norms, self_hsic = self._get_centered_features(model_id)
+                else:
+                    X_c, sq_norms, self_hsic = self._get_centered_rbf_features(model_id, sigma)
+                return (X_c, sq_norms), self_hsic
+
+            def pair_hsic(stats1, stats2):
+                return feature_space_linear_hsic(*stats1, *stats2, unbiased=self.unbiased)
+        else:
+            def get_stats(model_id, sigma):
+                K_c, self_hsic = self._get_centered_kernel(model_id, sigma)
+                return (K_c,), self_hsic
+
+            def pair_hsic(stats1, stats2):
+                return hsic(*stats1, *stats2)
+
+        names = self.get_names()
+        sim_matrices = {name: self._prepare_sim_matrix() for name in names}
+        n_models = len(self.model_ids_with_idx)
         for idx1, model1 in tqdm(self.model_ids_with_idx, desc=f"Computing CKA matrix"):
-            features_i = load_features(self.feature_root, model1, self.split, self.subset_indices)
-            for idx2, model2 in self.model_ids_with_idx:
-                if idx1 >= idx2:
-                    continue
-                features_j = load_features(self.feature_root, model2, self.split, self.subset_indices)
-                assert features_i.shape[0] == features_j.shape[0], \
-                    f"Number of features should be equal for CKA computation. (model1: {model1}, model2: {model2})"
-
-                m = features_i.shape[0]
-                cka = get_cka(backend=self.backend, m=m, kernel=self.kernel, unbiased=self.unbiased, device=self.device,
-                              sigma=self.sigma)
-                rho = cka.compare(X=features_i, Y=features_j)
-                sim_matrix[idx1, idx2] = rho
-                sim_matrix[idx2, idx1] = rho
+            if not any(self._needs_pair(idx1, idx2) for idx2 in range(idx1 + 1, n_models)):
+                continue
+            all_stats1 = [get_stats(model1, sigma) for sigma in self.sigmas]
+            inner_indices = [idx2 for idx2 in range(idx1 + 1, n_models) if self._needs_pair(idx1, idx2)]
+            # Alternate the scan direction, s.t. the entries used last are the first ones needed in the next row.
+            # This keeps the LRU cache effective if not all models fit into the memory budget.
+            if idx1 % 2 == 1:
+                inner_indices = reversed(inner_indices)
+            for idx2 in inner_indices:
+                model2 = self.model_ids[idx2]
+                for name, sigma, (stats1, hsic_xx) in zip(names, self.sigmas, all_stats1):
+                    stats2, hsic_yy = get_stats(model2, sigma)
+                    assert stats1[0].shape[0] == stats2[0].shape[0], \
+                        f"Number of features should be equal for CKA computation. (model1: {model1}, model2: {model2})"
 
-        return sim_matrix
+                    rho = (pair_hsic(stats1, stats2) / torch.sqrt(hsic_xx * hsic_yy)).item()
+                    sim_matrices[name][idx1, idx2] = rho
+                    sim_matrices[name][idx2, idx1] = rho
+                    self._record_pair(name, idx1, idx2, rho)
 
-    def get_name(self) -> str:
+        return sim_matrices
+
+    def compute_similarity_matrix(self) -> np.ndarray:
+        return self.compute_similarity_matrices()[self.get_name()]
+
+    def compute_bootstrap_matrices(self, n_resamples: int, seed: int = 0,
+                                   confidence: float = 0.95) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        The gram matrix of each model is computed once on the full data (and kept in the LRU cache), each resample
+        only indexes its rows and columns and centers it again, once per model (the centered kernels and their self
+        HSIC of the current resample share the LRU cache). Sigma of the median heuristic is estimated on the full
+        data. Duplicated samples of a resample are treated as distinct samples.
+        """
+        engine = self._select_engine()
+        if engine in ['minibatch', 'rff', 'nystroem']:
+            raise ValueError(f"Bootstrap intervals are not available for the {engine} CKA engine.")
+        n_models = len(self.model_ids)
+        n_samples = get_feature_shape(self.feature_root, self.model_ids[0], self.split, self.subset_indices)[0]
+        resamples = torch.from_numpy(get_bootstrap_indices(n_samples, n_resamples, seed)).to(self.device)
+        compute_dtype = get_torch_dtype(self.compute_dtype)
+        bootstrap = {}
+        for name, sigma in zip(self.get_names(), self.sigmas):
+            samples = np.ones((n_resamples, n_models, n_models))
+            for b, rows in enumerate(tqdm(resamples, desc=f"Bootstrapping {name}")):
+                def get_centered(model_id):
+                    def compute():
+                        K = self._get_kernel(model_id, sigma)
+                        K_c = center_kernel(K[rows[:, None], rows[None, :]].to(compute_dtype), unbiased=self.unbiased)
+                        return K_c, hsic(K_c, K_c)
+
+                    return self.cache.get_or_compute(('bootstrap_centered_kernel', model_id, sigma, b), compute)
+
+                for idx1, model1 in self.model_ids_with_idx:
+                    K_c, hsic_xx = get_centered(model1)
+                    inner_indices = list(range(idx1 + 1, n_models))
+                    # Alternate the scan direction to keep the LRU cache effective (see `compute_similarity_matrices`)
+                    if idx1 % 2 == 1:
+                        inner_indices = reversed(inner_indices)
+                    for idx2 in inner_indices:
+                        L_c, hsic_yy = get_centered(self.model_ids[idx2])
+                        rho = hsic(K_c, L_c) / torch.sqrt(hsic_xx * hsic_yy)
+                        samples[b, idx1, idx2] = samples[b, idx2, idx1] = rho.item()
+            bootstrap[name] = dict(summarize_bootstrap(samples, confidence), seed=seed)
+        return bootstrap
+
+    def compute_similarity_curves(self, sizes: List[int], seed: int = 0) -> List[Dict[str, Union[str, int, float]]]:
+        """
+        The HSIC statistics are updated with the gram matrix rows of the added samples only (see `IncrementalHSIC`),
+        in row blocks that fit into the cache budget, s.t. the largest size costs as much as a single gram engine run
+        and all smaller sizes come for free. With the median heuristic, sigma is estimated once on the largest subset.
+        """
+        engine = self._select_engine()
+        if engine in ['minibatch', 'rff', 'nystroem']:
+            raise ValueError(f"Similarity curves are not available for the {engine} CKA engine.")
+        sizes = sorted(set(sizes))
+        if sizes[0] < 4:
+            raise ValueError("CKA needs at least 4 samples.")
+        order = torch.from_numpy(self._get_curve_order(sizes, seed)).to(self.device)
+        features = [self._load_feature(model_id)[order]
+                    for model_id in tqdm(self.model_ids, desc="Loading features")]
+        if self.kernel == 'rbf':
+            sigmas = [[sample_median_sigma(X, seed=self.seed) if sigma is None else sigma for X in features]
+                      for sigma in self.sigmas]
+        else:
+            sigmas = [[None] * len(features)]
+        stats = [IncrementalHSIC(len(features), sizes[-1], device=self.device) for _ in self.sigmas]
+
+        curves = []
+        for size in tqdm(sizes, desc="Computing CKA curves"):
+            while stats[0].n < size:
+                start = stats[0].n
+                stop = min(size, start + get_block_rows(self.cache.max_bytes, len(features), size))
+                for model_sigmas, model_stats in zip(sigmas, stats):
+                    blocks = []
+                    for X, sigma in zip(features, model_sigmas):
+                        if self.kernel == 'rbf':
+                            blocks.append(rbf_kernel_from_distances(squared_distances_between(X[start:stop], X[:stop]),
+                                                                    sigma))
+                        else:
+                            blocks.append(X[start:stop] @ X[:stop].T)
+                    model_stats.add_rows(blocks)
+            for name, model_stats in zip(self.get_names(), stats):
+                cka_matrix = cka_from_hsic_matrix(model_stats.hsic_matrix(unbiased=self.unbiased))
+                curves.extend(get_curve_rows(name, size, cka_matrix, self.model_ids))
+        return curves
+
+    def _get_name(self, sigma: Optional[float]) -> str:
         method_name = f"cka_kernel_{self.kernel}{'_unbiased' if self.unbiased else '_biased'}"
         if self.kernel == 'rbf':
-            method_name += f"_sigma_{self.sigma}"
+            method_name += f"_sigma_{sigma}"
+        if self.engine == 'minibatch':
+            # Minibatch CKA is a different estimator, hence it must not overwrite the results of the full CKA
+            method_name += f"_minibatch_{self.minibatch_size}x{self.n_minibatches}_seed_{self.seed}"
+        elif self.engine in ['rff', 'nystroem']:
+            method_name += f"_{self.engine}_rank_{self.approx_rank}_seed_{self.seed}"
         return method_name
 
+    def get_name(self) -> str:
+        return self._get_name(self.sigma)
+
+    def get_names(self) -> List[str]:
+        return [self._get_name(sigma) for sigma in self.sigmas]
+
 
 class RSAModelSimilarity(BaseModelSimilarity):
     def __init__(self, feature_root: str, subset_root: Optional[str], split: str = 'train', device: str = 'cuda',
-                 rsa_method: str = 'correlation', corr_method: str = 'spearman', max_workers: int = 4) -> None:
+                 rsa_method: str = 'correlation', corr_method: str = 'spearman', max_workers: int = 4,
+                 cache_size_gb: float = 32., cache: Optional[LRUCache] = None,
+                 feature_cache: Optional[LRUCache] = None, cache_root: Optional[str] = None,
+                 engine: str = 'batched', chunk_size: int = 1 << 22, compute_dtype: str = 'float32',
+                 storage_dtype: Optional[str] = None, memory_budget_gb: Optional[float] = None,
+                 scratch_root: Optional[str] = None) -> None:
         super().__init__(feature_root=feature_root, subset_root=subset_root, split=split, device=device,
-                         max_workers=max_workers)
+                         max_workers=max_workers, cache_size_gb=cache_size_gb, cache=cache,
+                         feature_cache=feature_cache, cache_root=cache_root, compute_dtype=compute_dtype,
+                         storage_dtype=storage_dtype, memory_budget_gb=memory_budget_gb, scratch_root=scratch_root)
+        # RDMs are numpy arrays, hence bfloat16 storage is not available
+        self.rdm_dtype = get_numpy_dtype(self.storage_dtype)
         self.rsa_method = rsa_method
         self.corr_method = corr_method
         self.name = 'RSA'
 
+        if engine not in ['batched', 'pairwise', 'blockwise']:
+            raise ValueError(f"Unknown RSA engine: {engine}")
+        self.engine = engine
+        self.chunk_size = chunk_size
+
+    def _get_rdm_key(self, model_id: str) -> str:
+        return get_rdm_cache_key(get_feature_hash(self.feature_root, model_id, self.split), self.subset_indices,
+                                 self.rsa_method, self.rdm_dtype)
+
+    def _compute_rdm(self, model_id: str) -> np.ndarray:
+        """
+        Condensed RDM (float32 upper triangle). If a cache root is set, RDMs are stored as memory-mapped .npy files,
+        keyed by the hash of the feature file, the subset indices and the RSA method, and reused across runs.
+        """
+        if self.cache_root is None:
+            return compute_condensed_rdm(self._get_features(model_id).numpy(), self.rsa_method, self.rdm_dtype)
+        return load_or_create_condensed_rdm(os.path.join(self.cache_root, 'rdms'), self._get_rdm_key(model_id),
+                                            lambda: self._get_features(model_id).numpy(), self.rsa_method,
+                                            self.rdm_dtype)
+
     def _load_feature(self, model_id: str) -> np.ndarray:
-        features = load_features(self.feature_root, model_id, self.split, self.subset_indices).numpy()
-        rdm_features = compute_rdm(features, method=self.rsa_method)
-        return rdm_features
+        # The RDM does not depend on the correlation method, hence it is shared between pearson and spearman RSA.
+        key = ('rdm', model_id, self.rsa_method, self.rdm_dtype.name)
+        return self.cache.get_or_compute(key, lambda: self._compute_rdm(model_id))
 
     def _compute_similarity(self, feat1: np.ndarray, feat2: np.ndarray) -> float:
-        return correlate_rdms(feat1, feat2, correlation=self.corr_method)
+        return correlate_condensed_rdms(feat1, feat2, correlation=self.corr_method)
+
+    def _compute_batched_similarity_matrix(self, cache_dir: str) -> np.ndarray:
+        active = self._get_active_indices()
+        standardized_rdms = [
+            load_or_create_standardized_rdm(cache_dir, self._get_rdm_key(self.model_ids[idx]),
+                                            lambda: self._load_feature(self.model_ids[idx]), self.corr_method)
+            for idx in tqdm(active, desc="Standardizing RDMs")
+        ]
+        sim_matrix = self._prepare_sim_matrix()
+        sim_matrix[np.ix_(active, active)] = rsa_correlation_matrix(standardized_rdms, chunk_size=self.chunk_size)
+        self._record_matrix(self.get_name(), sim_matrix)
+        return sim_matrix
+
+    def _create_rdm_file(self, model_id: str, rdm_dir: str) -> np.memmap:
+        # Row blocks of the RDM (and the features) that fit into the memory budget
+        n = get_feature_shape(self.feature_root, model_id, self.split, self.subset_indices)[0]
+        return load_or_create_condensed_rdm(rdm_dir, self._get_rdm_key(model_id),
+                                            lambda: self._get_features(model_id).numpy(), self.rsa_method,
+                                            self.rdm_dtype,
+                                            block_size=get_block_rows(self.memory_budget, 1, n, bytes_per_entry=8))
+
+    def _compute_blockwise_similarity_matrix(self, scratch_dir: str) -> np.ndarray:
+        """
+        Out-of-core version of the batched engine. The RDMs bypass the LRU cache: they are written to memory-mapped
+        files (in the cache root, or in the scratch directory) in row blocks, standardized in chunks (see
+        `write_standardized_rdm`) and correlated in chunks, all sized by the memory budget. Only correlation and
+        cosine RDMs are computed blockwise, other RSA methods still compute the full RDM in memory.
+        """
+        active = self._get_active_indices()
+        rdm_dir = os.path.join(self.cache_root, 'rdms') if self.cache_root is not None else scratch_dir
+        # Ranking a chunk holds its values, sort buckets, mask, gathered positions and ranks (~40 bytes per entry)
+        standardize_chunk_size = max(1, self.memory_budget // 40)
+        standardized_rdms = [
+            load_or_create_standardized_rdm(rdm_dir, self._get_rdm_key(self.model_ids[idx]),
+                                            lambda: self._create_rdm_file(self.model_ids[idx], rdm_dir),
+                                            self.corr_method, chunk_size=standardize_chunk_size)
+            for idx in tqdm(active, desc="Standardizing RDMs")
+        ]
+        sim_matrix = self._prepare_sim_matrix()
+        sim_matrix[np.ix_(active, active)] = rsa_correlation_matrix(
+            standardized_rdms, chunk_size=max(1, self.memory_budget // (8 * len(active))))
+        self._record_matrix(self.get_name(), sim_matrix)
+        return sim_matrix
+
+    def compute_similarity_matrix(self) -> np.ndarray:
+        """
+        The batched engine ranks (spearman) and z-scores each RDM once and computes the full correlation matrix from
+        chunked matrix products over the stacked RDMs. The standardized RDMs are memory-mapped from the cache root,
+        or from a temporary directory if no cache root is set. The blockwise engine does the same out-of-core.
+        """
+        if self.engine == 'pairwise':
+            return super().compute_similarity_matrix()
+        if self.engine == 'blockwise':
+            with tempfile.TemporaryDirectory(dir=self.scratch_root) as scratch_dir:
+                return self._compute_blockwise_similarity_matrix(scratch_dir)
+        if self.cache_root is not None:
+            return self._compute_batched_similarity_matrix(os.path.join(self.cache_root, 'rdms'))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return self._compute_batched_similarity_matrix(tmp_dir)
+
+    def compute_similarity_curves(self, sizes: List[int], seed: int = 0) -> List[Dict[str, Union[str, int, float]]]:
+        """
+        The RDM entries of the added samples are computed in row blocks that fit into the cache budget. Pearson RSA is
+        updated from running sums over the new entries (see `IncrementalCorrelation`). The ranks of spearman RSA
+        change with every added entry, hence the nested RDMs are kept memory-mapped in a temporary directory and only
+        their ranks are recomputed for each size.
+        """
+        sizes = sorted(set(sizes))
+        order = self._get_curve_order(sizes, seed)
+        features = [nested_normalized_rows(self._get_features(model_id).numpy()[order], self.rsa_method)
+                    for model_id in tqdm(self.model_ids, desc="Loading features")]
+        correlation = IncrementalCorrelation(len(features))
+        n = 0
+        curves = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if self.corr_method == 'spearman':
+                rdms = [np.lib.format.open_memmap(os.path.join(tmp_dir, f'{i}.npy'), mode='w+', dtype=np.float32,
+                                                  shape=(n_condensed(sizes[-1]),)) for i in range(len(features))]
+            for size in tqdm(sizes, desc="Computing RSA curves"):
+                while n < size:
+                    stop = min(size, n + get_block_rows(self.cache.max_bytes, len(features), size))
+                    entries = np.stack([nested_rdm_entries(F, n, stop) for F in features])
+                    if self.corr_method == 'spearman':
+                        for rdm, rdm_entries in zip(rdms, entries):
+                            rdm[n_condensed(n):n_condensed(stop)] = rdm_entries
+                    else:
+                        correlation.add(entries)
+                    n = stop
+                if self.corr_method == 'spearman':
+                    standardized_rdms = []
+                    for i, rdm in enumerate(rdms):
+                        z_fn = os.path.join(tmp_dir, f'{i}_z.npy')
+                        np.save(z_fn, standardize_rdm(rdm[:n_condensed(size)], self.corr_method))
+                        standardized_rdms.append(np.load(z_fn, mmap_mode='r'))
+                    sim_matrix = rsa_correlation_matrix(standardized_rdms, chunk_size=self.chunk_size)
+                    del standardized_rdms
+                else:
+                    sim_matrix = correlation.correlation_matrix()
+                curves.extend(get_curve_rows(self.get_name(), size, sim_matrix, self.model_ids))
+        return curves
+
+    def compute_bootstrap_matrices(self, n_resamples: int, seed: int = 0,
+                                   confidence: float = 0.95) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        The RDM of each resample is gathered from the (cached) condensed RDM of each model on the full data, with
+        zero dissimilarity between duplicated samples. The gathered RDMs are standardized into a temporary directory
+        and correlated at once (see `rsa_correlation_matrix`).
+        """
+        n_samples = get_feature_shape(self.feature_root, self.model_ids[0], self.split, self.subset_indices)[0]
+        rdms = [self._load_feature(model_id) for model_id in tqdm(self.model_ids, desc="Loading RDMs")]
+        samples = np.empty((n_resamples, len(rdms), len(rdms)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for b, rows in enumerate(tqdm(get_bootstrap_indices(n_samples, n_resamples, seed),
+                                          desc=f"Bootstrapping {self.get_name()}")):
+                indices, is_self = resample_condensed_indices(n_samples, rows)
+                standardized_rdms = []
+                for i, rdm in enumerate(rdms):
+                    resampled = rdm[indices]
+                    resampled[is_self] = 0
+                    z_fn = os.path.join(tmp_dir, f'{i}.npy')
+                    np.save(z_fn, standardize_rdm(resampled, self.corr_method))
+                    standardized_rdms.append(np.load(z_fn, mmap_mode='r'))
+                samples[b] = rsa_correlation_matrix(standardized_rdms, chunk_size=self.chunk_size)
+        return {self.get_name(): dict(summarize_bootstrap(samples, confidence), seed=seed)}
 
     def get_name(self):
         if self.rsa_method == 'correlation':
@@ -170,18 +970,29 @@ class GWModelSimilarity(BaseModelSimilarity):
             max_workers: int = 4,
             store_coupling: bool = False,
             output_root: Optional[str] = None,
+            coupling_top_k: int = 32,
+            solver: str = 'exact',
+            epsilon: float = 0.05,
+            nb_samples_grad: int = 100,
+            seed: Optional[int] = 0,
+            cache_root: Optional[str] = None,
+            feature_cache: Optional[LRUCache] = None,
+            cache_size_gb: float = 32.,
+            memory_budget_gb: Optional[float] = None,
     ) -> None:
         super().__init__(feature_root=feature_root, subset_root=subset_root, split=split, device=device,
-                         max_workers=max_workers)
+                         max_workers=max_workers, cache_size_gb=cache_size_gb, feature_cache=feature_cache,
+                         cache_root=cache_root, memory_budget_gb=memory_budget_gb)
+        self.name = 'GW'
 
-        self.output_root = None
+        self.coupling_store = None
 
         if store_coupling:
             assert output_root is not None, "Output root should be provided for storing coupling matrices"
-            self.output_root = Path(output_root)
-            assert self.output_root.exists(), "Output root path does not exist"
+            self.coupling_store = CouplingStore(output_root)
 
         self.store_coupling = store_coupling
+        self.coupling_top_k = coupling_top_k
 
         if cost_fun not in ['euclidian', 'cosine']:
             raise ValueError(f"Unknown cost function: {cost_fun}")
@@ -193,81 +1004,270 @@ class GWModelSimilarity(BaseModelSimilarity):
         else:
             self.loss_fun = loss_fun
 
+        if solver not in ['exact', 'entropic', 'sampled']:
+            raise ValueError(f"Unknown GW solver: {solver}")
+        else:
+            self.solver = solver
+
         self.fixed_coupling = fixed_coupling
+        self.epsilon = epsilon
+        self.nb_samples_grad = nb_samples_grad
+        self.seed = seed
 
     def _prepare_sim_matrix(self) -> np.ndarray:
         return np.zeros((len(self.model_ids_with_idx), len(self.model_ids_with_idx)))
 
     def _load_feature(self, model_id: str) -> np.ndarray:
-        features = load_features(self.feature_root, model_id, self.split, self.subset_indices).numpy()
-        C_mat = cdist(features.numpy(), features, metric=self.cost_fun)
-        C_mat /= C_mat.max()
-        return C_mat
+        return self._get_features(model_id).numpy()
+
+    def _get_cost_matrix_fn(self, model_id: str, cache_dir: str) -> str:
+        key = get_cost_matrix_cache_key(get_feature_hash(self.feature_root, model_id, self.split),
+                                        self.subset_indices, self.cost_fun)
+        return load_or_create_cost_matrix(cache_dir, key, lambda: self._load_feature(model_id), self.cost_fun)
 
     def get_name(self):
-        return f"gw_sim_cost_{'fixed_coupling' if self.fixed_coupling else 'learned_coupling'}_fun_{self.cost_fun}_loss_fun_{self.loss_fun}"
+        name = (f"gw_sim_cost_{'fixed_coupling' if self.fixed_coupling else 'learned_coupling'}_fun_{self.cost_fun}"
+                f"_loss_fun_{self.loss_fun}")
+        if not self.fixed_coupling and self.solver != 'exact':
+            name += f"_solver_{self.solver}_eps_rel_{self.epsilon}"
+        if not self.fixed_coupling and self.solver == 'sampled':
+            name += f"_grad_samples_{self.nb_samples_grad}"
+        return name
+
+    def validate_precision(self, n_samples: int = 1000, seed: int = 0) -> Dict[str, float]:
+        raise ValueError("Precision validation is not available for GW, its compute precision is fixed by the solver "
+                         "(float32 for the exact solver, float64 otherwise).")
+
+    def get_coupling_key(self, model1: str, model2: str) -> str:
+        return f"{self.get_name()}/{model1}/{model2}"
 
-    def store_coupling_matrix(self, model1: str, model2: str, coupling_matrix: np.ndarray) -> None:
+    def store_coupling_matrix(self, model1: str, model2: str, compressed_coupling: Tuple) -> None:
+        """Stores the top-k entries per row and the summary statistics of a coupling (see `compress_coupling`)."""
         if self.store_coupling:
-            output_path = self.output_root / f"{model1}_{model2}_coupling.npy"
-            np.save(output_path, coupling_matrix)
-
-    def _comput_gromov_distance(self, C1: np.ndarray, C2: np.ndarray, T: np.ndarray) -> float:
-        # simple get_backend as the full one will be handled in gromov_wasserstein
-        nx = ot.backend.get_backend(C1, C2)
-
-        # init marginals if set as None
-        p = ot.utils.unif(C1.shape[0], type_as=C1)
-        q = ot.utils.unif(C2.shape[0], type_as=C1)
-
-        if self.loss_fun == "square_loss":
-            gC1 = 2 * C1 * nx.outer(p, p) - 2 * nx.dot(T, nx.dot(C2, T.T))
-            gC2 = 2 * C2 * nx.outer(q, q) - 2 * nx.dot(T.T, nx.dot(C1, T))
-        elif self.loss_fun == "kl_loss":
-            gC1 = nx.log(C1 + 1e-15) * nx.outer(p, p) - nx.dot(
-                T, nx.dot(nx.log(C2 + 1e-15), T.T)
-            )
-            gC2 = -nx.dot(T.T, nx.dot(C1, T)) / (C2 + 1e-15) + nx.outer(q, q)
-
-        gw = nx.set_gradients(
-            gw,
-            (p, q, C1, C2),
-            (
-                log_gw["u"] - nx.mean(log_gw["u"]),
-                log_gw["v"] - nx.mean(log_gw["v"]),
-                gC1,
-                gC2,
-            ),
-        )
+            indices, values, stats = compressed_coupling
+            self.coupling_store.put(self.get_coupling_key(model1, model2), indices, values, stats)
 
-    def compute_similarity_matrix(self) -> np.ndarray:
+    def _compute_distance_matrix(self, cache_dir: str) -> np.ndarray:
+        cost_fns = {self.model_ids[idx]: self._get_cost_matrix_fn(self.model_ids[idx], cache_dir)
+                    for idx in tqdm(self._get_active_indices(), desc="Computing cost matrices")}
         dist_matrix = self._prepare_sim_matrix()
-        for idx1, model1 in tqdm(self.model_ids_with_idx, desc=f"Computing CKA matrix"):
-            C_i = load_features(self.feature_root, model1, self.split, self.subset_indices)
-            for idx2, model2 in self.model_ids_with_idx:
-                if idx1 >= idx2:
-                    continue
-                C_j = load_features(self.feature_root, model2, self.split, self.subset_indices)
+        kwargs = dict(loss_fun=self.loss_fun)
+        if not self.fixed_coupling:
+            kwargs.update(solver=self.solver, epsilon=self.epsilon, nb_samples_grad=self.nb_samples_grad,
+                          seed=self.seed)
+        # GW solvers are CPU-bound python loops, hence the pairs are distributed over processes. Workers only
+        # receive the file names of the cost matrices and memory-map them. Each worker of a learned coupling holds
+        # several dense N x N arrays, hence the number of workers is bounded by the memory budget.
+        max_workers = self.max_workers
+        if not self.fixed_coupling and cost_fns:
+            n_samples = np.load(next(iter(cost_fns.values())), mmap_mode='r').shape[0]
+            max_workers = get_gw_max_workers(n_samples, self.solver, self.memory_budget, self.max_workers)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for idx1, model1 in self.model_ids_with_idx:
+                for idx2, model2 in self.model_ids_with_idx:
+                    if idx1 < idx2 and self._needs_pair(idx1, idx2):
+                        future = executor.submit(gw_distance_from_files, cost_fns[model1], cost_fns[model2],
+                                                 fixed_coupling=self.fixed_coupling,
+                                                 coupling_top_k=self.coupling_top_k if self.store_coupling else None,
+                                                 **kwargs)
+                        futures[future] = (idx1, model1, idx2, model2)
 
-                assert C_i.shape[0] == C_j.shape[0], \
-                    (f"Number of samples should be equal for both models. (model1: {model1}, model2: {model2},"
-                     f"feature_root: {self.feature_root})")
+            try:
+                for future in tqdm(as_completed(futures), total=len(futures), desc=f"Computing {self.name} matrix"):
+                    idx1, model1, idx2, model2 = futures[future]
+                    gw_dist, compressed_coupling = future.result()
+                    if compressed_coupling is not None:
+                        self.store_coupling_matrix(model1, model2, compressed_coupling)
+                    dist_matrix[idx1, idx2] = gw_dist
+                    dist_matrix[idx2, idx1] = gw_dist
+                    self._record_pair(self.get_name(), idx1, idx2, gw_dist)
+            finally:
+                if self.coupling_store is not None:
+                    self.coupling_store.flush()
+        return dist_matrix
 
-                if self.fixed_coupling:
-                    T = np.eye(C_i.shape[0])
+    def compute_similarity_matrix(self) -> np.ndarray:
+        """
+        Matrix of GW distances between all pairs of models. The normalized cost matrix of each model is computed
+        once and stored as float32 .npy file under the cache root (or a temporary directory if no cache root is set).
+        """
+        if self.cache_root is not None:
+            return self._compute_distance_matrix(os.path.join(self.cache_root, 'gw_costs'))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return self._compute_distance_matrix(tmp_dir)
 
-                else:
-                    gw_dist, log_gw = ot.gromov.gromov_wasserstein2(C_i, C_j, loss_fun=self.loss_fun, log=True)
 
-                self.store_coupling_matrix(model1, model2, log_gw['T'])
-                dist_matrix[idx1, idx2] = gw_dist
-                dist_matrix[idx2, idx1] = gw_dist
+class KNNModelSimilarity(BaseModelSimilarity):
+    def __init__(
+            self,
+            feature_root: str,
+            subset_root: Optional[str],
+            split: str = 'train',
+            device: str = 'cuda',
+            k: Union[int, List[int]] = 10,
+            metric: str = 'cosine',
+            index: str = 'exact',
+            measure: str = 'mutual_knn',
+            max_workers: int = 4,
+            cache_size_gb: float = 32.,
+            cache: Optional[LRUCache] = None,
+            feature_cache: Optional[LRUCache] = None,
+            cache_root: Optional[str] = None,
+    ) -> None:
+        super().__init__(feature_root=feature_root, subset_root=subset_root, split=split, device=device,
+                         max_workers=max_workers, cache_size_gb=cache_size_gb, cache=cache,
+                         feature_cache=feature_cache, cache_root=cache_root)
+        self.name = 'kNN'
+        # Several neighbourhood sizes share the graph with the largest k
+        self.ks = sorted(k) if isinstance(k, (list, tuple)) else [k]
 
+        if metric not in ['cosine', 'euclidean']:
+            raise ValueError(f"Unknown kNN metric: {metric}")
+        if index not in ['exact', 'faiss']:
+            raise ValueError(f"Unknown kNN index: {index}")
+        if measure not in ['mutual_knn', 'jaccard']:
+            raise ValueError(f"Unknown kNN measure: {measure}")
+        self.metric = metric
+        self.index = index
+        self.measure = measure
 
-def compute_sim_matrix(
+    def _compute_knn_graph(self, model_id: str) -> np.ndarray:
+        features = self._get_features(model_id)
+        if self.index == 'faiss':
+            return compute_knn_graph_faiss(features.numpy(), max(self.ks), metric=self.metric)
+        return compute_knn_graph(features.to(self.device).float(), max(self.ks), metric=self.metric)
+
+    def _load_feature(self, model_id: str) -> np.ndarray:
+        """
+        kNN graph (int32, N x max(k)) of the model. If a cache root is set, graphs are stored as memory-mapped .npy
+        files, keyed by the hash of the feature file, the subset indices and the graph options.
+        """
+        if self.cache_root is None:
+            key = ('knn_graph', model_id, max(self.ks), self.metric, self.index)
+            return self.cache.get_or_compute(key, lambda: self._compute_knn_graph(model_id))
+        key = get_knn_cache_key(get_feature_hash(self.feature_root, model_id, self.split), self.subset_indices,
+                                max(self.ks), self.metric, self.index)
+        return load_or_create_knn_graph(os.path.join(self.cache_root, 'knn_graphs'), key,
+                                        lambda: self._compute_knn_graph(model_id))
+
+    def compute_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        """All pairs are compared via set intersections of the (per model) cached neighbour lists."""
+        names = self.get_names()
+        sim_matrices = {name: self._prepare_sim_matrix() for name in names}
+        graphs = {idx: self._load_feature(self.model_ids[idx])
+                  for idx in tqdm(self._get_active_indices(), desc="Computing kNN graphs")}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for idx1 in graphs:
+                for idx2 in graphs:
+                    if idx1 < idx2 and self._needs_pair(idx1, idx2):
+                        future = executor.submit(knn_overlaps, graphs[idx1], graphs[idx2], self.ks, self.measure)
+                        futures[future] = (idx1, idx2)
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Computing {self.name} matrix"):
+                idx1, idx2 = futures[future]
+                for name, overlap in zip(names, future.result()):
+                    sim_matrices[name][idx1, idx2] = overlap
+                    sim_matrices[name][idx2, idx1] = overlap
+                    self._record_pair(name, idx1, idx2, overlap)
+        return sim_matrices
+
+    def compute_similarity_matrix(self) -> np.ndarray:
+        return self.compute_similarity_matrices()[self.get_name()]
+
+    def _get_name(self, k: int) -> str:
+        return f"knn_{self.measure}_k_{k}_metric_{self.metric}{'_faiss' if self.index == 'faiss' else ''}"
+
+    def get_name(self) -> str:
+        return self._get_name(self.ks[0])
+
+    def get_names(self) -> List[str]:
+        return [self._get_name(k) for k in self.ks]
+
+
+class SVDModelSimilarity(BaseModelSimilarity):
+    def __init__(
+            self,
+            feature_root: str,
+            subset_root: Optional[str],
+            split: str = 'train',
+            device: str = 'cuda',
+            methods: Union[str, List[str]] = 'svcca',
+            variance_threshold: float = 0.99,
+            max_workers: int = 4,
+            cache_size_gb: float = 32.,
+            cache: Optional[LRUCache] = None,
+            feature_cache: Optional[LRUCache] = None,
+            cache_root: Optional[str] = None,
+    ) -> None:
+        super().__init__(feature_root=feature_root, subset_root=subset_root, split=split, device=device,
+                         max_workers=max_workers, cache_size_gb=cache_size_gb, cache=cache,
+                         feature_cache=feature_cache, cache_root=cache_root)
+        self.name = 'SVD'
+        # SVCCA, PWCCA and Procrustes share the truncated SVD of each model and are computed in one pass
+        self.methods = [methods] if isinstance(methods, str) else list(methods)
+        for method in self.methods:
+            if method not in SVD_METHODS:
+                raise ValueError(f"Unknown SVD-based similarity method: {method}")
+        if not 0 < variance_threshold <= 1:
+            raise ValueError(f"Variance threshold should be in (0, 1], got {variance_threshold}.")
+        self.variance_threshold = variance_threshold
+
+    def _compute_svd(self, model_id: str) -> Dict[str, np.ndarray]:
+        return truncated_svd(self._get_features(model_id).to(self.device), self.variance_threshold)
+
+    def _load_feature(self, model_id: str) -> Dict[str, np.ndarray]:
+        """
+        Truncated SVD of the centered features of the model. If a cache root is set, SVDs are stored as .npz files,
+        keyed by the hash of the feature file, the subset indices and the variance threshold.
+        """
+        def load():
+            if self.cache_root is None:
+                return self._compute_svd(model_id)
+            key = get_svd_cache_key(get_feature_hash(self.feature_root, model_id, self.split), self.subset_indices,
+                                    self.variance_threshold)
+            return load_or_create_svd(os.path.join(self.cache_root, 'svds'), key, lambda: self._compute_svd(model_id))
+        return self.cache.get_or_compute(('svd', model_id, self.variance_threshold), load)
+
+    def compute_similarity_matrices(self) -> Dict[str, np.ndarray]:
+        """Each pair only needs the product of the truncated left singular vectors (see `svd_similarities`)."""
+        names = self.get_names()
+        sim_matrices = {name: self._prepare_sim_matrix() for name in names}
+        svds = {idx: self._load_feature(self.model_ids[idx])
+                for idx in tqdm(self._get_active_indices(), desc="Computing truncated SVDs")}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for idx1 in svds:
+                for idx2 in svds:
+                    if idx1 < idx2 and self._needs_pair(idx1, idx2):
+                        future = executor.submit(svd_similarities, svds[idx1], svds[idx2], self.methods)
+                        futures[future] = (idx1, idx2)
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Computing {self.name} matrices"):
+                idx1, idx2 = futures[future]
+                for name, sim in zip(names, future.result()):
+                    sim_matrices[name][idx1, idx2] = sim
+                    sim_matrices[name][idx2, idx1] = sim
+                    self._record_pair(name, idx1, idx2, sim)
+        return sim_matrices
+
+    def compute_similarity_matrix(self) -> np.ndarray:
+        return self.compute_similarity_matrices()[self.get_name()]
+
+    def _get_name(self, method: str) -> str:
+        return f"{method}_var_{self.variance_threshold}"
+
+    def get_name(self) -> str:
+        return self._get_name(self.methods[0])
+
+    def get_names(self) -> List[str]:
+        return [self._get_name(method) for method in self.methods]
+
+
+def get_model_similarity(
         sim_method: str,
         feature_root: str,
-        model_ids: List[str],
         split: str,
         subset_root: Optional[str] = None,
         kernel: str = 'linear',
@@ -276,9 +1276,39 @@ def compute_sim_matrix(
         backend: str = 'torch',
         unbiased: bool = True,
         device: str = 'cuda',
-        sigma: Optional[float] = None,
+        sigma: Optional[Union[float, List[float]]] = None,
         max_workers: int = 4,
-) -> Tuple[np.ndarray, List[str], str]:
+        cache_size_gb: float = 32.,
+        cka_engine: str = 'auto',
+        cache: Optional[LRUCache] = None,
+        feature_cache: Optional[LRUCache] = None,
+        cache_root: Optional[str] = None,
+        rsa_engine: str = 'batched',
+        gw_solver: str = 'exact',
+        gw_cost_fun: str = 'euclidian',
+        gw_loss_fun: str = 'square_loss',
+        gw_epsilon: float = 0.05,
+        gw_nb_samples_grad: int = 100,
+        gw_fixed_coupling: bool = False,
+        store_coupling: bool = False,
+        coupling_root: Optional[str] = None,
+        coupling_top_k: int = 32,
+        seed: Optional[int] = 0,
+        minibatch_size: int = 1024,
+        n_minibatches: int = 100,
+        approx_rank: int = 2048,
+        approx_validation_size: int = 500,
+        knn_k: Union[int, List[int]] = 10,
+        knn_metric: str = 'cosine',
+        knn_index: str = 'exact',
+        knn_measure: str = 'mutual_knn',
+        svd_methods: Optional[List[str]] = None,
+        svd_variance_threshold: float = 0.99,
+        compute_dtype: str = 'float32',
+        storage_dtype: Optional[str] = None,
+        memory_budget_gb: Optional[float] = None,
+        scratch_root: Optional[str] = None,
+) -> BaseModelSimilarity:
     if sim_method == 'cka':
         model_similarity = CKAModelSimilarity(
             feature_root=feature_root,
@@ -289,7 +1319,20 @@ def compute_sim_matrix(
             backend=backend,
             unbiased=unbiased,
             sigma=sigma,
-            max_workers=max_workers
+            max_workers=max_workers,
+            cache_size_gb=cache_size_gb,
+            engine=cka_engine,
+            cache=cache,
+            feature_cache=feature_cache,
+            minibatch_size=minibatch_size,
+            n_minibatches=n_minibatches,
+            seed=seed,
+            approx_rank=approx_rank,
+            approx_validation_size=approx_validation_size,
+            compute_dtype=compute_dtype,
+            storage_dtype=storage_dtype,
+            memory_budget_gb=memory_budget_gb,
+            scratch_root=scratch_root,
         )
     elif sim_method == 'rsa':
         model_similarity = RSAModelSimilarity(
@@ -299,11 +1342,352 @@ def compute_sim_matrix(
             device=device,
             rsa_method=rsa_method,
             corr_method=corr_method,
-            max_workers=max_workers
+            max_workers=max_workers,
+            cache_size_gb=cache_size_gb,
+            cache=cache,
+            feature_cache=feature_cache,
+            cache_root=cache_root,
+            engine=rsa_engine,
+            compute_dtype=compute_dtype,
+            storage_dtype=storage_dtype,
+            memory_budget_gb=memory_budget_gb,
+            scratch_root=scratch_root,
+        )
+    elif sim_method == 'gw':
+        model_similarity = GWModelSimilarity(
+            feature_root=feature_root,
+            subset_root=subset_root,
+            split=split,
+            device=device,
+            cost_fun=gw_cost_fun,
+            fixed_coupling=gw_fixed_coupling,
+            loss_fun=gw_loss_fun,
+            max_workers=max_workers,
+            store_coupling=store_coupling,
+            output_root=coupling_root,
+            coupling_top_k=coupling_top_k,
+            solver=gw_solver,
+            epsilon=gw_epsilon,
+            nb_samples_grad=gw_nb_samples_grad,
+            seed=seed,
+            cache_root=cache_root,
+            feature_cache=feature_cache,
+            cache_size_gb=cache_size_gb,
+            memory_budget_gb=memory_budget_gb,
+        )
+    elif sim_method == 'knn':
+        model_similarity = KNNModelSimilarity(
+            feature_root=feature_root,
+            subset_root=subset_root,
+            split=split,
+            device=device,
+            k=knn_k,
+            metric=knn_metric,
+            index=knn_index,
+            measure=knn_measure,
+            max_workers=max_workers,
+            cache_size_gb=cache_size_gb,
+            cache=cache,
+            feature_cache=feature_cache,
+            cache_root=cache_root,
+        )
+    elif sim_method in SVD_METHODS or sim_method == 'svd':
+        # 'svd' computes all `svd_methods` from shared SVDs (see `group_metric_configs`)
+        model_similarity = SVDModelSimilarity(
+            feature_root=feature_root,
+            subset_root=subset_root,
+            split=split,
+            device=device,
+            methods=svd_methods if sim_method == 'svd' else sim_method,
+            variance_threshold=svd_variance_threshold,
+            max_workers=max_workers,
+            cache_size_gb=cache_size_gb,
+            cache=cache,
+            feature_cache=feature_cache,
+            cache_root=cache_root,
         )
     else:
         raise ValueError(f"Unknown similarity method: {sim_method}")
+    return model_similarity
+
+
+def load_similarity_results(
+        results_path: str
+) -> Optional[Tuple[np.ndarray, List[str], Dict[Tuple[str, str], str]]]:
+    """
+    Similarity matrix, model ids and pair keys stored in `results_path`. Returns None if any of them is missing
+    (e.g., results written before pair keys were stored), in which case all pairs are recomputed.
+    """
+    fns = [os.path.join(results_path, fn) for fn in ['similarity_matrix.pt', 'model_ids.txt', 'pair_keys.json']]
+    if not all(os.path.exists(fn) for fn in fns):
+        return None
+    sim_matrix = torch.load(fns[0], weights_only=False)
+    with open(fns[1], 'r') as f:
+        model_ids = [line.strip() for line in f if line.strip()]
+    with open(fns[2], 'r') as f:
+        pair_keys = {(model1, model2): key for model1, model2, key in json.load(f)}
+    return np.asarray(sim_matrix), model_ids, pair_keys
+
+
+def save_similarity_results(results_path: str, sim_matrix: np.ndarray, model_ids: List[str],
+                            pair_keys: Dict[Tuple[str, str], str]) -> None:
+    os.makedirs(results_path, exist_ok=True)
+    torch.save(sim_matrix, os.path.join(results_path, 'similarity_matrix.pt'))
+    with open(os.path.join(results_path, 'model_ids.txt'), "w") as file:
+        for string in model_ids:
+            file.write(string + "\n")
+    with open(os.path.join(results_path, 'pair_keys.json'), "w") as file:
+        json.dump([[model1, model2, key] for (model1, model2), key in pair_keys.items()], file)
+    # All journaled pairs are part of the stored results now
+    for journal_fn in glob.glob(os.path.join(results_path, 'pair_journal*.jsonl')):
+        os.remove(journal_fn)
+
 
+def save_bootstrap_results(results_path: str, bootstrap: Dict[str, np.ndarray], model_ids: List[str]) -> None:
+    """Stores the bootstrap summary of a similarity matrix (and its model ids) as bootstrap.pt."""
+    os.makedirs(results_path, exist_ok=True)
+    torch.save(dict(bootstrap, model_ids=model_ids), os.path.join(results_path, 'bootstrap.pt'))
+
+
+def save_similarity_curves(results_path: str, curves: pd.DataFrame) -> None:
+    """Stores the tidy similarity curve table of one metric as similarity_curve.csv."""
+    os.makedirs(results_path, exist_ok=True)
+    curves.to_csv(os.path.join(results_path, 'similarity_curve.csv'), index=False)
+
+
+def _run_model_similarity(
+        model_similarity: BaseModelSimilarity, results_root: Optional[str], checkpoint_interval: float = 60.,
+        shard: Optional[Tuple[int, int]] = None, merge: bool = False, recompute: bool = False,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, Dict[Tuple[str, str], str]]]:
+    if results_root is not None:
+        return model_similarity.update_similarity_matrices(results_root, checkpoint_interval=checkpoint_interval,
+                                                           shard=shard, compute_missing=not merge, recompute=recompute)
+    assert shard is None and not merge, "Sharded runs and merges require a results root."
+    sim_mats = model_similarity.compute_similarity_matrices()
+    return sim_mats, {name: model_similarity.get_pair_keys(name) for name in sim_mats}
+
+
+def compute_sim_matrices(
+        sim_method: str,
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        results_root: Optional[str] = None,
+        checkpoint_interval: float = 60.,
+        shard: Optional[Tuple[int, int]] = None,
+        merge: bool = False,
+        recompute: bool = False,
+        **kwargs
+) -> Tuple[Dict[str, np.ndarray], List[str], Dict[str, Dict[Tuple[str, str], str]]]:
+    """
+    Computes all similarity matrices of the given configuration in one pass (e.g., one matrix per sigma of the rbf
+    kernel). Returns the matrices and pair keys indexed by their method slug and the (sorted) model ids. If
+    `results_root` is given, the pairs of previous results (and of the journals of unfinished runs) stored there are
+    reused (see `update_similarity_matrices`). With `shard` = (shard_index, num_shards), only the pairs of this shard
+    are computed (and journaled), `merge` assembles the matrices from the journals of all shards. With `recompute`,
+    all pairs are computed but still journaled in `results_root`.
+    """
+    model_similarity = get_model_similarity(sim_method=sim_method, feature_root=feature_root, split=split, **kwargs)
+    model_similarity.load_model_ids(model_ids)
+    model_ids = model_similarity.get_model_ids()
+    sim_mats, pair_keys = _run_model_similarity(model_similarity, results_root, checkpoint_interval, shard, merge,
+                                                recompute)
+    return sim_mats, model_ids, pair_keys
+
+
+def compute_bootstrap_sim_matrices(
+        sim_method: str,
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        n_resamples: int = 1000,
+        confidence: float = 0.95,
+        seed: int = 0,
+        **kwargs
+) -> Tuple[Dict[str, Dict[str, np.ndarray]], List[str]]:
+    """
+    Bootstrap intervals of all similarity matrices of the given configuration (CKA and RSA), indexed by their method
+    slug, and the (sorted) model ids. See `compute_bootstrap_matrices`.
+    """
+    model_similarity = get_model_similarity(sim_method=sim_method, feature_root=feature_root, split=split, seed=seed,
+                                            **kwargs)
+    model_similarity.load_model_ids(model_ids)
+    bootstrap = model_similarity.compute_bootstrap_matrices(n_resamples, seed=seed, confidence=confidence)
+    return bootstrap, model_similarity.get_model_ids()
+
+
+def compute_similarity_curves(
+        sim_method: str,
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        sizes: List[int],
+        seed: int = 0,
+        **kwargs
+) -> pd.DataFrame:
+    """
+    Tidy table (metric, model1, model2, n_samples, similarity) of the similarity of all model pairs on nested random
+    subsets of the given sizes, for all metrics of the given configuration (CKA and RSA) computed in one pass.
+    """
+    model_similarity = get_model_similarity(sim_method=sim_method, feature_root=feature_root, split=split, seed=seed,
+                                            **kwargs)
+    model_similarity.load_model_ids(model_ids)
+    return pd.DataFrame(model_similarity.compute_similarity_curves(sizes, seed=seed))
+
+
+def validate_sim_precision(
+        sim_method: str,
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        n_samples: int = 1000,
+        seed: int = 0,
+        **kwargs
+) -> Dict[str, float]:
+    """
+    Maximum absolute deviation of the similarity matrices of the given configuration (computed with its compute and
+    storage dtypes) from a float64 reference on a random sample of the samples. See `validate_precision`.
+    """
+    model_similarity = get_model_similarity(sim_method=sim_method, feature_root=feature_root, split=split, seed=seed,
+                                            **kwargs)
+    model_similarity.load_model_ids(model_ids)
+    return model_similarity.validate_precision(n_samples, seed=seed)
+
+
+def group_metric_configs(metric_configs: List[Dict]) -> List[Dict]:
+    """
+    Translates entries of a similarity metric config file (see `scripts/configs/similarity_metric_config_all.json`)
+    into keyword arguments of `get_model_similarity`. Rbf CKA configs that only differ in sigma are merged, as are
+    SVCCA, PWCCA and Procrustes configs with the same variance threshold.
+    """
+    grouped_configs = []
+    rbf_configs = {}
+    svd_configs = {}
+    for exp_dict in metric_configs:
+        sim_method = exp_dict['sim_method']
+        if sim_method == 'cka':
+            config = dict(sim_method=sim_method, kernel=exp_dict.get('sim_kernel', 'linear'),
+                          unbiased=exp_dict.get('unbiased', True), sigma=exp_dict.get('sigma'))
+            if config['kernel'] == 'rbf':
+                key = (config['kernel'], config['unbiased'])
+                if key not in rbf_configs:
+                    rbf_configs[key] = dict(config, sigma=[])
+                    grouped_configs.append(rbf_configs[key])
+                rbf_configs[key]['sigma'].append(config['sigma'])
+                continue
+        elif sim_method == 'rsa':
+            config = dict(sim_method=sim_method, rsa_method=exp_dict.get('rsa_method', 'correlation'),
+                          corr_method=exp_dict.get('corr_method', 'spearman'))
+        elif sim_method == 'gw':
+            config = dict(sim_method=sim_method, **{k: v for k, v in exp_dict.items() if k.startswith('gw_')})
+        elif sim_method == 'knn':
+            config = dict(sim_method=sim_method, **{k: v for k, v in exp_dict.items() if k.startswith('knn_')})
+        elif sim_method in SVD_METHODS:
+            threshold = exp_dict.get('svd_variance_threshold', 0.99)
+            if threshold not in svd_configs:
+                svd_configs[threshold] = dict(sim_method='svd', svd_methods=[], svd_variance_threshold=threshold)
+                grouped_configs.append(svd_configs[threshold])
+            svd_configs[threshold]['svd_methods'].append(sim_method)
+            continue
+        else:
+            config = dict(exp_dict)
+        grouped_configs.append(config)
+    return grouped_configs
+
+
+def compute_sim_matrices_from_config(
+        metric_configs: List[Dict],
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        cache_size_gb: float = 32.,
+        verbose: bool = False,
+        results_root: Optional[str] = None,
+        checkpoint_interval: float = 60.,
+        shard: Optional[Tuple[int, int]] = None,
+        merge: bool = False,
+        recompute: bool = False,
+        **kwargs
+) -> Tuple[Dict[str, np.ndarray], List[str], Dict[str, Dict[Tuple[str, str], str]]]:
+    """
+    Sweep over several similarity metrics that share one pipeline: all metrics read the features through a shared
+    feature cache (each feature file is deserialized once if the budget allows) and share derived quantities like the
+    RDMs of pearson and spearman RSA. Returns the matrices and pair keys of all metrics indexed by their method slug.
+    """
+    cache = LRUCache(max_bytes=int(cache_size_gb * 1024 ** 3))
+    feature_cache = LRUCache(max_bytes=int(cache_size_gb * 1024 ** 3))
+    sim_mats, pair_keys = {}, {}
+    for config in group_metric_configs(metric_configs):
+        if verbose:
+            print(f"Computing model similarity matrices with config: {config}")
+        model_similarity = get_model_similarity(feature_root=feature_root, split=split, cache_size_gb=cache_size_gb,
+                                                cache=cache, feature_cache=feature_cache, **config, **kwargs)
+        model_similarity.load_model_ids(model_ids)
+        model_ids = model_similarity.get_model_ids()
+        config_sim_mats, config_pair_keys = _run_model_similarity(model_similarity, results_root, checkpoint_interval,
+                                                                  shard, merge, recompute)
+        sim_mats.update(config_sim_mats)
+        pair_keys.update(config_pair_keys)
+    return sim_mats, model_ids, pair_keys
+
+
+def compute_sim_matrix(
+        sim_method: str,
+        feature_root: str,
+        model_ids: List[str],
+        split: str,
+        subset_root: Optional[str] = None,
+        kernel: str = 'linear',
+        rsa_method: str = 'correlation',
+        corr_method: str = 'spearman',
+        backend: str = 'torch',
+        unbiased: bool = True,
+        device: str = 'cuda',
+        sigma: Optional[float] = None,
+        max_workers: int = 4,
+        cache_size_gb: float = 32.,
+        cka_engine: str = 'auto',
+        cache_root: Optional[str] = None,
+        rsa_engine: str = 'batched',
+        gw_solver: str = 'exact',
+        gw_cost_fun: str = 'euclidian',
+        gw_loss_fun: str = 'square_loss',
+        gw_epsilon: float = 0.05,
+        gw_nb_samples_grad: int = 100,
+        gw_fixed_coupling: bool = False,
+        compute_dtype: str = 'float32',
+        storage_dtype: Optional[str] = None,
+        memory_budget_gb: Optional[float] = None,
+        scratch_root: Optional[str] = None,
+) -> Tuple[np.ndarray, List[str], str]:
+    model_similarity = get_model_similarity(
+        sim_method=sim_method,
+        feature_root=feature_root,
+        split=split,
+        subset_root=subset_root,
+        kernel=kernel,
+        rsa_method=rsa_method,
+        corr_method=corr_method,
+        backend=backend,
+        unbiased=unbiased,
+        device=device,
+        sigma=sigma,
+        max_workers=max_workers,
+        cache_size_gb=cache_size_gb,
+        cka_engine=cka_engine,
+        cache_root=cache_root,
+        rsa_engine=rsa_engine,
+        gw_solver=gw_solver,
+        gw_cost_fun=gw_cost_fun,
+        gw_loss_fun=gw_loss_fun,
+        gw_epsilon=gw_epsilon,
+        gw_nb_samples_grad=gw_nb_samples_grad,
+        gw_fixed_coupling=gw_fixed_coupling,
+        compute_dtype=compute_dtype,
+        storage_dtype=storage_dtype,
+        memory_budget_gb=memory_budget_gb,
+        scratch_root=scratch_root,
+    )
     model_similarity.load_model_ids(model_ids)
     model_ids = model_similarity.get_model_ids()
     sim_mat = model_similarity.compute_similarity_matrix()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import scipy.stats
+from thingsvision.core.rsa import compute_rdm
+from tqdm import tqdm
+
+
+def n_condensed(n_samples: int) -> int:
+    return n_samples * (n_samples - 1) // 2
+
+
+def _normalized_rows(X: np.ndarray, rsa_method: str) -> np.ndarray:
+    if rsa_method == 'correlation':
+        X = X - X.mean(axis=1)[:, np.newaxis]
+    return X / np.linalg.norm(X, axis=1)[:, np.newaxis]
+
+
+def write_condensed_rdm(X: np.ndarray, rsa_method: str, out: np.ndarray, block_size: int = 1024) -> np.ndarray:
+    """
+    Writes the upper triangle (without diagonal, in row-major order as `scipy.spatial.distance.squareform`) of the
+    RDM of X into `out`. Correlation and cosine RDMs are computed in row blocks, s.t. the N x N matrix is never
+    materialized. Other methods fall back to thingsvision's `compute_rdm`.
+    """
+    n = X.shape[0]
+    if rsa_method not in ['correlation', 'cosine']:
+        rdm = compute_rdm(X, method=rsa_method)[np.triu_indices(n, k=1)]
+        if out.dtype == np.float16:
+            # Unbounded dissimilarities may overflow in float16, correlations of RDMs are scale-invariant
+            rdm = rdm / max(np.abs(rdm).max(), 1e-12)
+        out[:] = rdm
+        return out
+
+    F = _normalized_rows(X, rsa_method)
+    offset = 0
+    for start in range(0, n - 1, block_size):
+        stop = min(start + block_size, n - 1)
+        block = 1 - (F[start:stop] @ F[start + 1:].T).clip(min=-1.0, max=1.0)
+        for i in range(start, stop):
+            row = block[i - start, i - start:]
+            out[offset:offset + row.shape[0]] = row
+            offset += row.shape[0]
+    return out
+
+
+def compute_condensed_rdm(X: np.ndarray, rsa_method: str, dtype: np.dtype = np.float32) -> np.ndarray:
+    out = np.empty(n_condensed(X.shape[0]), dtype=dtype)
+    return write_condensed_rdm(X, rsa_method, out)
+
+
+def get_rdm_cache_key(feature_hash: str, subset_indices: Optional[List[int]], rsa_method: str,
+                      dtype: np.dtype = np.float32) -> str:
+    """
+    Content-addressed key of an RDM: the hash of the feature file, the subset indices, the RSA method and the storage
+    dtype (if not float32).
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(feature_hash.encode())
+    h.update(json.dumps(subset_indices).encode())
+    h.update(rsa_method.encode())
+    if np.dtype(dtype) != np.float32:
+        h.update(np.dtype(dtype).name.encode())
+    return h.hexdigest()
+
+
+def _atomic_save(fn: str, array: np.ndarray) -> None:
+    # Write to a temporary file first, s.t. concurrent jobs never read partially written files
+    tmp_fn = f"{fn[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    np.save(tmp_fn, array)
+    os.replace(tmp_fn, fn)
+
+
+def load_or_create_condensed_rdm(cache_dir: str, key: str, X_fn, rsa_method: str,
+                                 dtype: np.dtype = np.float32, block_size: int = 1024) -> np.memmap:
+    """
+    Returns the memory-mapped condensed RDM (float32 or the given storage dtype) stored under `key` in `cache_dir`. If
+    it does not exist yet, it is computed from the features returned by `X_fn` and written to disk first.
+    """
+    rdm_fn = os.path.join(cache_dir, f'{key}.npy')
+    if not os.path.exists(rdm_fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        X = X_fn()
+        # Write to a temporary file first, s.t. concurrent jobs never read partially written RDMs
+        tmp_fn = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npy')
+        out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=dtype, shape=(n_condensed(X.shape[0]),))
+        write_condensed_rdm(X, rsa_method, out, block_size=block_size)
+        out.flush()
+        del out
+        os.replace(tmp_fn, rdm_fn)
+    return np.load(rdm_fn, mmap_mode='r')
+
+
+def correlate_condensed_rdms(rdm_1: np.ndarray, rdm_2: np.ndarray, correlation: str = 'pearson',
+                             chunk_size: int = 1 << 20) -> float:
+    """
+    Correlation coefficient (spearman or pearson) of two condensed RDMs: the mean product of the standardized RDMs
+    (see `standardize_rdm`), computed in float32 chunks whose dot products are accumulated in float64.
+    """
+    z_1 = standardize_rdm(rdm_1, correlation)
+    z_2 = standardize_rdm(rdm_2, correlation)
+    total = 0.
+    for start in range(0, z_1.shape[0], chunk_size):
+        total += float(np.dot(z_1[start:start + chunk_size], z_2[start:start + chunk_size]))
+    return total / z_1.shape[0]
+
+
+def standardize_rdm(rdm: np.ndarray, correlation: str = 'pearson') -> np.ndarray:
+    """
+    Z-scored condensed RDM (float32). For spearman correlation, the RDM is rank-transformed first (in float64, since
+    float32 cannot represent all ranks of large RDMs), s.t. the correlation of two RDMs is the mean of the product of
+    their standardized vectors. Pearson RDMs are standardized in float32 with mean and variance accumulated in
+    float64.
+    """
+    if correlation == 'spearman':
+        values = scipy.stats.rankdata(rdm)
+    elif correlation == 'pearson':
+        values = np.array(rdm, dtype=np.float32)
+    else:
+        raise ValueError(f"Unknown correlation method: {correlation}")
+    values -= values.mean(dtype=np.float64)
+    values /= np.sqrt(np.square(values).mean(dtype=np.float64))
+    return values.astype(np.float32)
+
+
+def _sort_buckets(values: np.ndarray) -> np.ndarray:
+    # Leading 16 bits of the float bit patterns, with the sign handled s.t. the buckets preserve the order of the values
+    bits = values.dtype.itemsize * 8
+    uint = np.dtype(f'uint{bits}').type
+    keys = (values + values.dtype.type(0)).view(uint)  # -0.0 + 0.0 = 0.0, s.t. zeros share one bucket
+    sign = uint(1) << uint(bits - 1)
+    keys = np.where(keys & sign, ~keys, keys | sign)
+    return (keys >> uint(bits - 16)).astype(np.int64)
+
+
+def write_standardized_rdm(rdm: np.ndarray, out: np.ndarray, correlation: str = 'pearson',
+                           chunk_size: int = 1 << 24) -> np.ndarray:
+    """
+    Out-of-core version of `standardize_rdm` for (memory-mapped) RDMs that do not fit into memory, which holds at most
+    `chunk_size` entries at a time. Pearson RDMs are standardized in two passes over the chunks. Spearman ranks are
+    exact: the entries are counted per bucket of the leading 16 bits of their values (see `_sort_buckets`), and
+    consecutive buckets with at most `chunk_size` entries in total are gathered in one pass each, ranked in memory and
+    offset by the number of entries in all preceding buckets.
+    """
+    n = rdm.shape[0]
+    chunks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    if correlation == 'pearson':
+        def get_chunk(start, stop):
+            return np.asarray(rdm[start:stop], dtype=np.float32)
+
+        mean = sum(float(get_chunk(start, stop).sum(dtype=np.float64)) for start, stop in chunks) / n
+        var = sum(float(np.square(get_chunk(start, stop) - mean).sum(dtype=np.float64)) for start, stop in chunks) / n
+        for start, stop in chunks:
+            out[start:stop] = (get_chunk(start, stop) - mean) / np.sqrt(var)
+        return out
+    if correlation != 'spearman':
+        raise ValueError(f"Unknown correlation method: {correlation}")
+
+    counts = np.zeros(1 << 16, dtype=np.int64)
+    for start, stop in chunks:
+        counts += np.bincount(_sort_buckets(rdm[start:stop]), minlength=1 << 16)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    mean_rank = (n + 1) / 2
+    sq_sum = 0.
+    first = 0
+    while offsets[first] < n:
+        last = max(first + 1, int(np.searchsorted(offsets, offsets[first] + chunk_size, side='right')) - 1)
+        positions, values = [], []
+        for start, stop in chunks:
+            chunk = np.asarray(rdm[start:stop])
+            buckets = _sort_buckets(chunk)
+            mask = (buckets >= first) & (buckets < last)
+            positions.append(np.flatnonzero(mask) + start)
+            values.append(chunk[mask])
+        ranks = scipy.stats.rankdata(np.concatenate(values)) + (offsets[first] - mean_rank)
+        out[np.concatenate(positions)] = ranks
+        sq_sum += float(np.square(ranks).sum())
+        first = last
+    std = np.sqrt(sq_sum / n)
+    for start, stop in chunks:
+        out[start:stop] /= std
+    return out
+
+
+def load_or_create_standardized_rdm(cache_dir: str, key: str, rdm_fn, correlation: str,
+                                    chunk_size: Optional[int] = None) -> np.memmap:
+    """
+    Memory-mapped standardized RDM stored under `key`. Computed from the RDM returned by `rdm_fn` if missing. If
+    `chunk_size` is given, larger RDMs are standardized out-of-core (see `write_standardized_rdm`).
+    """
+    z_fn = os.path.join(cache_dir, f'{key}_{correlation}_z.npy')
+    if not os.path.exists(z_fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        rdm = rdm_fn()
+        if chunk_size is None or rdm.shape[0] <= chunk_size:
+            _atomic_save(z_fn, standardize_rdm(rdm, correlation))
+        else:
+            tmp_fn = os.path.join(cache_dir, f'{key}_{correlation}_z.{os.getpid()}.tmp.npy')
+            out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.float32, shape=rdm.shape)
+            write_standardized_rdm(rdm, out, correlation, chunk_size=chunk_size)
+            out.flush()
+            del out
+            os.replace(tmp_fn, z_fn)
+    return np.load(z_fn, mmap_mode='r')
+
+
+def rsa_correlation_matrix(standardized_rdms: List[np.ndarray], chunk_size: int = 1 << 22) -> np.ndarray:
+    """
+    Pearson (or spearman, given rank-transformed inputs) correlation between all pairs of standardized condensed
+    RDMs. The M x M matrix is accumulated from one matrix product per chunk of the N(N-1)/2 dimension, s.t. the peak
+    memory only depends on the number of models and the chunk size. Chunks are multiplied in float32, their products
+    are accumulated in float64.
+    """
+    n_models = len(standardized_rdms)
+    n_values = standardized_rdms[0].shape[0]
+    assert all(rdm.shape[0] == n_values for rdm in standardized_rdms), \
+        "RDMs of all models should have the same size."
+    sim_matrix = np.zeros((n_models, n_models))
+    chunk = np.empty((n_models, min(chunk_size, n_values)), dtype=np.float32)
+    for start in tqdm(range(0, n_values, chunk_size), desc="Correlating RDM chunks"):
+        stop = min(start + chunk_size, n_values)
+        for i, rdm in enumerate(standardized_rdms):
+            chunk[i, :stop - start] = rdm[start:stop]
+        block = chunk[:, :stop - start]
+        sim_matrix += block @ block.T
+    sim_matrix /= n_values
+    np.fill_diagonal(sim_matrix, 1.0)
+    return sim_matrix
+
+
+def resample_condensed_indices(n_samples: int, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions in the condensed RDM of n_samples samples that form the condensed RDM of the samples `rows` (e.g., a
+    bootstrap resample), and a mask of the pairs of a sample with itself (duplicates), whose dissimilarity is zero.
+    """
+    i, j = np.triu_indices(len(rows), k=1)
+    lo = np.minimum(rows[i], rows[j]).astype(np.int64)
+    hi = np.maximum(rows[i], rows[j]).astype(np.int64)
+    is_self = lo == hi
+    indices = n_samples * lo - lo * (lo + 1) // 2 + hi - lo - 1
+    indices[is_self] = 0
+    return indices, is_self
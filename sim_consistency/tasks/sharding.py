@@ -0,0 +1,54 @@
+import heapq
+import math
+from typing import List, Set, Tuple
+
+
+def estimate_pair_cost(n_samples: int, dim_1: int, dim_2: int) -> float:
+    """
+    Relative cost of comparing two models: the cross-covariance of the features (N x D_1 x D_2) plus the comparison
+    of two N x N matrices (gram matrices, RDMs, cost matrices).
+    """
+    return n_samples * dim_1 * dim_2 + n_samples ** 2
+
+
+def get_tiles(n_models: int, n_groups: int) -> List[List[Tuple[int, int]]]:
+    """
+    Splits the upper triangle (idx1 < idx2) of an M x M matrix into tiles: the models are split into `n_groups`
+    contiguous groups, and each tile holds the pairs between two groups, s.t. a tile only needs the models of (at
+    most) two groups.
+    """
+    bounds = [round(g * n_models / n_groups) for g in range(n_groups + 1)]
+    tiles = []
+    for g1 in range(n_groups):
+        for g2 in range(g1, n_groups):
+            tile = [(idx1, idx2)
+                    for idx1 in range(bounds[g1], bounds[g1 + 1])
+                    for idx2 in range(max(bounds[g2], idx1 + 1), bounds[g2 + 1])]
+            if tile:
+                tiles.append(tile)
+    return tiles
+
+
+def get_shard_pairs(n_samples: int, dims: List[int], num_shards: int, shard_index: int,
+                    tiles_per_shard: int = 4) -> Set[Tuple[int, int]]:
+    """
+    Pairs of models computed by shard `shard_index` out of `num_shards`. The upper triangle is split into about
+    `tiles_per_shard` tiles per shard, which are assigned to the shards by the longest-processing-time-first
+    heuristic (largest tile to the least loaded shard) using the cost model of `estimate_pair_cost`. The assignment is
+    deterministic, s.t. all shards agree on it without communication.
+    """
+    assert 0 <= shard_index < num_shards, f"Shard index {shard_index} out of range for {num_shards} shards."
+    n_models = len(dims)
+    # n_groups * (n_groups + 1) / 2 tiles
+    n_groups = min(n_models, math.ceil((math.sqrt(1 + 8 * tiles_per_shard * num_shards) - 1) / 2))
+    tiles = get_tiles(n_models, n_groups)
+    costs = [sum(estimate_pair_cost(n_samples, dims[idx1], dims[idx2]) for idx1, idx2 in tile) for tile in tiles]
+
+    loads = [(0., shard) for shard in range(num_shards)]
+    shard_pairs = set()
+    for tile_idx in sorted(range(len(tiles)), key=lambda t: (-costs[t], t)):
+        load, shard = heapq.heappop(loads)
+        if shard == shard_index:
+            shard_pairs.update(tiles[tile_idx])
+        heapq.heappush(loads, (load + costs[tile_idx], shard))
+    return shard_pairs
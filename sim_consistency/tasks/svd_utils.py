@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+SVD_METHODS = ['svcca', 'pwcca', 'procrustes']
+
+
+def truncated_svd(X: torch.Tensor, variance_threshold: float = 0.99, rtol: float = 1e-10) -> Dict[str, np.ndarray]:
+    """
+    Truncated SVD X_c = U S V^T of the column-centered features, keeping the smallest number of components that
+    explain `variance_threshold` of the total variance (components below `rtol` of the largest one are dropped).
+    Computed in float64 from the eigendecomposition of the smaller of the two gram matrices (D x D or N x N).
+    Returns U (float32, N x k), S (float64, k), V^T (float32, k x D) and the total variance ||X_c||_F^2.
+    """
+    X = X.double()
+    X = X - X.mean(dim=0, keepdim=True)
+    n, d = X.shape
+    if d <= n:
+        eigvals, V = torch.linalg.eigh(X.T @ X)
+    else:
+        eigvals, V = torch.linalg.eigh(X @ X.T)
+    eigvals, V = eigvals.flip(0).clamp(min=0), V.flip(1)
+    total_variance = eigvals.sum()
+
+    explained = torch.cumsum(eigvals, dim=0) / total_variance
+    k = int(torch.searchsorted(explained, torch.tensor(variance_threshold, dtype=explained.dtype,
+                                                       device=explained.device) - 1e-12)) + 1
+    k = max(1, min(k, int((eigvals > rtol * eigvals[0]).sum())))
+    S = eigvals[:k].sqrt()
+    if d <= n:
+        Vt = V[:, :k].T
+        U = (X @ V[:, :k]) / S
+    else:
+        U = V[:, :k]
+        Vt = (U.T @ X) / S[:, None]
+    return {
+        'U': U.float().cpu().numpy(),
+        'S': S.cpu().numpy(),
+        'Vt': Vt.float().cpu().numpy(),
+        'total_variance': np.array(float(total_variance)),
+    }
+
+
+def get_svd_cache_key(feature_hash: str, subset_indices: Optional[List[int]], variance_threshold: float) -> str:
+    """Content-addressed key of a truncated SVD: the hash of the feature file, the subset indices and the threshold."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(feature_hash.encode())
+    h.update(json.dumps(subset_indices).encode())
+    h.update(f'svd_{variance_threshold}'.encode())
+    return h.hexdigest()
+
+
+def load_or_create_svd(cache_dir: str, key: str, svd_fn) -> Dict[str, np.ndarray]:
+    """Truncated SVD stored under `key` (.npz). Computed by `svd_fn` and written to disk first if missing."""
+    fn = os.path.join(cache_dir, f'{key}.npz')
+    if not os.path.exists(fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, s.t. concurrent jobs never read partially written files
+        tmp_fn = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_fn, **svd_fn())
+        os.replace(tmp_fn, fn)
+    with np.load(fn) as f:
+        return {name: f[name] for name in f.files}
+
+
+def _pwcca_weights(coefs: np.ndarray, svd: Dict[str, np.ndarray]) -> np.ndarray:
+    # Importance of each canonical variate h_i = U c_i: sum_j |<h_i, x_j>| over the neurons x_j, with
+    # <h_i, x_j> = (c_i^T S V^T)_j (Morcos et al., 2018)
+    weights = np.abs(coefs.T @ (svd['S'][:, None] * svd['Vt'])).sum(axis=1)
+    return weights / weights.sum()
+
+
+def svd_similarities(svd_1: Dict[str, np.ndarray], svd_2: Dict[str, np.ndarray],
+                     methods: List[str]) -> List[float]:
+    """
+    SVCCA, (symmetrised) PWCCA and orthogonal Procrustes similarity of two truncated SVDs. All methods are derived from
+    the k_1 x k_2 product M = U_1^T U_2: the canonical correlations of the SVD-reduced features are the singular values
+    of M, and the Procrustes similarity max_Q <X_1, X_2 Q> / (||X_1||_F ||X_2||_F) is the nuclear norm of
+    S_1 M S_2, normalized by the total variances.
+    """
+    M = svd_1['U'].astype(np.float64).T @ svd_2['U'].astype(np.float64)
+    P, rho, Qt = np.linalg.svd(M, full_matrices=False)
+    rho = rho.clip(max=1.0)
+    similarities = []
+    for method in methods:
+        if method == 'svcca':
+            similarities.append(float(rho.mean()))
+        elif method == 'pwcca':
+            pwcca_1 = np.dot(_pwcca_weights(P, svd_1), rho)
+            pwcca_2 = np.dot(_pwcca_weights(Qt.T, svd_2), rho)
+            similarities.append(float((pwcca_1 + pwcca_2) / 2))
+        elif method == 'procrustes':
+            nuclear_norm = np.linalg.svd(svd_1['S'][:, None] * M * svd_2['S'][None, :], compute_uv=False).sum()
+            similarities.append(float(nuclear_norm / np.sqrt(svd_1['total_variance'] * svd_2['total_variance'])))
+        else:
+            raise ValueError(f"Unknown SVD-based similarity method: {method}")
+    return similarities
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable
+
+import numpy as np
+import torch
+
+
+def get_nbytes(obj: Any) -> int:
+    """Approximate memory footprint of tensors/arrays (possibly nested in tuples, lists or dicts)."""
+    if isinstance(obj, np.memmap):
+        # Memory-mapped arrays are backed by files and paged in on demand
+        return 0
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(get_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(get_nbytes(o) for o in obj.values())
+    return 0
+
+
+class LRUCache:
+    """
+    In-memory cache with a memory budget (in bytes). If adding an entry exceeds the budget, the least recently used
+    entries are evicted. Entries larger than the budget itself are never cached.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = get_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.cur_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self._entries and self.cur_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.cur_bytes -= evicted_size
+            self._entries[key] = (value, size)
+            self.cur_bytes += size
+
+    def get_or_compute(self, key: Hashable, compute_fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+        value = compute_fn()
+        self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.cur_bytes = 0
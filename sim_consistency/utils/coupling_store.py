@@ -0,0 +1,144 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+def compress_coupling(T: np.ndarray, top_k: int = 32) -> Tuple[np.ndarray, np.ndarray, Dict[str, float]]:
+    """
+    Sparse representation of a coupling matrix: the `top_k` largest entries of each row (int32 column indices and
+    float16 values, scaled by the number of rows s.t. each row of a coupling with uniform marginals sums to one) and
+    summary statistics of the dense coupling.
+    """
+    n, m = T.shape
+    top_k = min(top_k, m)
+    indices = np.argpartition(-T, top_k - 1, axis=1)[:, :top_k]
+    values = np.take_along_axis(T, indices, axis=1)
+    order = np.argsort(-values, axis=1)
+    indices = np.take_along_axis(indices, order, axis=1).astype(np.int32)
+    values = np.take_along_axis(values, order, axis=1)
+
+    total_mass = T.sum()
+    nonzero = T[T > 0]
+    stats = {
+        'entropy': float(-(nonzero * np.log(nonzero)).sum()),
+        'diagonal_mass': float(np.trace(T)),
+        'top_k_mass': float(values.sum() / total_mass),
+        'argmax_match': float(np.mean(indices[:, 0] == np.arange(n))),
+    }
+    return indices, (values * n).astype(np.float16), stats
+
+
+class CouplingStore:
+    """
+    Container for the (compressed) coupling matrices of all model pairs of a dataset. The arrays of all pairs are
+    written to one binary file, their offsets and summary statistics are kept in a JSON index, s.t. the statistics
+    can be used without reading any coupling and single couplings are read lazily (memory-mapped). A coupling that is
+    stored again (e.g., a recomputed pair) overwrites its previous record if it fits, otherwise it is appended. The
+    index entries are buffered and written at most every `flush_interval` seconds (and by `flush`).
+    """
+
+    def __init__(self, root: str, name: str = 'gw_couplings', flush_interval: float = 60.) -> None:
+        self.data_fn = os.path.join(root, f'{name}.bin')
+        self.index_fn = os.path.join(root, f'{name}.json')
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._index_cache = (None, {})
+
+    @contextmanager
+    def _locked(self):
+        # Several jobs (e.g., different GW configs) may write to the container of the same dataset
+        os.makedirs(os.path.dirname(self.index_fn), exist_ok=True)
+        with open(f'{self.index_fn}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_stored_index(self) -> Dict[str, Dict]:
+        # The parsed index is reused as long as the file is unchanged
+        if not os.path.exists(self.index_fn):
+            return {}
+        stat = os.stat(self.index_fn)
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._index_cache[0] != version:
+            with open(self.index_fn, 'r') as f:
+                self._index_cache = (version, json.load(f))
+        return self._index_cache[1]
+
+    def _read_index(self) -> Dict[str, Dict]:
+        return {**self._read_stored_index(), **self._pending}
+
+    def keys(self):
+        return self._read_index().keys()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._read_index()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Summary statistics of all stored couplings, indexed by their key."""
+        return {key: entry['stats'] for key, entry in self._read_index().items()}
+
+    def put(self, key: str, indices: np.ndarray, values: np.ndarray, stats: Dict[str, float]) -> None:
+        data = (np.ascontiguousarray(indices, dtype=np.int32).tobytes()
+                + np.ascontiguousarray(values, dtype=np.float16).tobytes())
+        with self._locked():
+            previous = self._read_index().get(key)
+            # Records of older containers have no capacity, their size is given by their shape
+            capacity = None if previous is None else previous.get(
+                'capacity', previous['n_rows'] * previous['top_k'] * (4 + 2))
+            if capacity is not None and len(data) <= capacity:
+                offset = previous['offset']
+                with open(self.data_fn, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data)
+            else:
+                capacity = len(data)
+                with open(self.data_fn, 'ab') as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(data)
+            self._pending[key] = {
+                'offset': offset,
+                'capacity': capacity,
+                'n_rows': indices.shape[0],
+                'top_k': indices.shape[1],
+                'stats': stats,
+            }
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered index entries to the index of the container."""
+        if self._pending:
+            with self._locked():
+                index = {**self._read_stored_index(), **self._pending}
+                tmp_fn = f'{self.index_fn}.{os.getpid()}.tmp'
+                with open(tmp_fn, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_fn, self.index_fn)
+                self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def get(self, key: str) -> Tuple[np.memmap, np.memmap]:
+        """Memory-mapped column indices and values (scaled by the number of rows) of the top-k entries per row."""
+        entry = self._read_index()[key]
+        shape = (entry['n_rows'], entry['top_k'])
+        indices = np.memmap(self.data_fn, dtype=np.int32, mode='r', offset=entry['offset'], shape=shape)
+        values = np.memmap(self.data_fn, dtype=np.float16, mode='r', offset=entry['offset'] + indices.nbytes,
+                           shape=shape)
+        return indices, values
+
+    def get_dense(self, key: str, n_cols: Optional[int] = None) -> np.ndarray:
+        """Dense (approximate) coupling matrix reconstructed from the stored top-k entries."""
+        indices, values = self.get(key)
+        n_rows = indices.shape[0]
+        T = np.zeros((n_rows, n_cols or n_rows), dtype=np.float32)
+        np.put_along_axis(T, np.asarray(indices, dtype=np.int64), np.asarray(values, dtype=np.float32) / n_rows,
+                          axis=1)
+        return T
@@ -0,0 +1,42 @@
+import json
+import os
+from typing import Any, Dict, Optional
+
+MANIFEST_VERSION = 1
+
+
+class ExtractionManifest:
+    """
+    Progress of the feature extraction of one split: samples and batches done, the position of the dataloader (e.g.,
+    the offsets of the webdataset workers) and the state of the partial feature store arrays. It is only written once
+    the arrays are synced up to the recorded rows and replaced atomically, s.t. a rerun of an interrupted extraction
+    can continue from the last checkpoint.
+    """
+
+    def __init__(self, feature_dir: str, split: str) -> None:
+        self.path = os.path.join(feature_dir, f'extraction_{split}.manifest.json')
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                progress = json.load(f)
+        except json.JSONDecodeError:
+            return None
+        if progress.get('version') != MANIFEST_VERSION:
+            return None
+        return progress
+
+    def write(self, progress: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_fn = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, **progress}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fn, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+# Arrays of the feature store (e.g., features_train.npy) are raw .npy files next to a small JSON header
+# (features_train.json) with their dtype, shape, model, dataset, split and content hash. The header is written last,
+# hence it marks a complete array.
+STORE_VERSION = 1
+
+# numpy has no bfloat16, hence bfloat16 arrays are stored as their int16 bit patterns
+_VIEW_DTYPES = {'bfloat16': (torch.bfloat16, torch.int16)}
+
+
+def get_store_paths(model_dir: str, name: str, split: str) -> Tuple[str, str]:
+    """Paths of the .npy array and its JSON header, e.g., for name 'features' and split 'train'."""
+    return os.path.join(model_dir, f'{name}_{split}.npy'), os.path.join(model_dir, f'{name}_{split}.json')
+
+
+def has_store(model_dir: str, name: str, split: str) -> bool:
+    return os.path.exists(get_store_paths(model_dir, name, split)[1])
+
+
+def read_store_header(model_dir: str, name: str, split: str) -> Dict[str, Any]:
+    with open(get_store_paths(model_dir, name, split)[1], 'r') as f:
+        return json.load(f)
+
+
+def _to_numpy(data: Union[torch.Tensor, np.ndarray]) -> Tuple[np.ndarray, str]:
+    if isinstance(data, np.ndarray):
+        return data, data.dtype.name
+    dtype_name = str(data.dtype).replace('torch.', '')
+    if dtype_name in _VIEW_DTYPES:
+        data = data.view(_VIEW_DTYPES[dtype_name][1])
+    return data.numpy(), dtype_name
+
+
+_NPY_HEADER_SIZE = 128
+
+
+def _npy_header(dtype: np.dtype, shape: Tuple[int, ...]) -> bytes:
+    # .npy (version 1.0) header padded to a fixed size, s.t. it can be rewritten in-place once the number of rows is
+    # known
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': tuple(shape)})
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class StoreWriter:
+    """
+    Streams rows (e.g., the features of each batch) into an array of the store, s.t. the array is never held in
+    memory and the final file needs no reload or concatenation. Rows are appended to the .npy file behind a
+    fixed-size header, which is rewritten with the final shape on `close`. If the number of rows is known, the file
+    is preallocated (more or fewer rows are still handled). The rows are written and hashed by a background thread,
+    s.t. the disk writes overlap with the computation of the next rows. Used as a context manager, the array is
+    only committed if no exception occurred.
+
+    A `resumable` writer keeps its partial file at a fixed path (also on abort). `checkpoint` syncs the rows written
+    so far and returns the state to continue the array from (`resume_from`), e.g., in a rerun of an interrupted job.
+    """
+
+    def __init__(self, model_dir: str, name: str, split: str, n_rows: Optional[int] = None,
+                 model: Optional[str] = None, dataset: Optional[str] = None, max_pending: int = 8,
+                 resumable: bool = False, resume_from: Optional[Dict[str, Any]] = None) -> None:
+        self.model_dir = model_dir
+        self.name = name
+        self.split = split
+        self.n_rows = n_rows
+        self.model = model
+        self.dataset = dataset
+        self.npy_fn, self.header_fn = get_store_paths(model_dir, name, split)
+        self.resumable = resumable or resume_from is not None
+        # Write to a temporary file first, s.t. concurrent jobs never read partially written arrays
+        if self.resumable:
+            self.tmp_fn = f'{self.npy_fn[:-len(".npy")]}.partial.npy'
+        else:
+            self.tmp_fn = f'{self.npy_fn[:-len(".npy")]}.{os.getpid()}.tmp.npy'
+        self.rows_written = 0
+        self.dtype_name = None
+        self._file = None
+        self._row_shape = None
+        self._dtype = None
+        self._hash = hashlib.blake2b(digest_size=20)
+        self._error = None
+        if resume_from is not None:
+            self._resume(resume_from['rows'], resume_from['dtype'])
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _open(self, array: np.ndarray) -> None:
+        os.makedirs(self.model_dir, exist_ok=True)
+        self._row_shape, self._dtype = array.shape[1:], array.dtype
+        self._file = open(self.tmp_fn, 'wb+')
+        self._file.write(_npy_header(self._dtype, (0,) + self._row_shape))
+        if self.n_rows:
+            size = _NPY_HEADER_SIZE + self.n_rows * array[:1].nbytes
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self._file.fileno(), 0, size)
+            else:
+                self._file.truncate(size)
+
+    def _resume(self, rows: int, dtype_name: str, chunk_bytes: int = 1 << 26) -> None:
+        # Continue the partial file after its first (synced) rows, which are hashed again
+        with open(self.tmp_fn, 'rb') as f:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        size = _NPY_HEADER_SIZE + rows * row_bytes
+        if os.path.getsize(self.tmp_fn) < size:
+            raise ValueError(f"{self.tmp_fn} has fewer than the {rows} rows to resume from.")
+        self._file = open(self.tmp_fn, 'rb+')
+        self._file.truncate(size)
+        self._file.seek(_NPY_HEADER_SIZE)
+        for _ in range(0, size - _NPY_HEADER_SIZE, chunk_bytes):
+            self._hash.update(self._file.read(min(chunk_bytes, size - self._file.tell())))
+        self._row_shape, self._dtype = tuple(shape[1:]), dtype
+        self.rows_written = rows
+        self.dtype_name = dtype_name
+
+    def _run(self) -> None:
+        while True:
+            array = self._queue.get()
+            try:
+                if array is None:
+                    return
+                if self._error is not None:
+                    continue
+                if self._file is None:
+                    self._open(array)
+                if array.shape[1:] != self._row_shape or array.dtype != self._dtype:
+                    raise ValueError(f"Rows of shape {array.shape[1:]} ({array.dtype}) do not match the previous rows "
+                                     f"of shape {self._row_shape} ({self._dtype}).")
+                data = memoryview(np.ascontiguousarray(array)).cast('B')
+                self._file.write(data)
+                self._hash.update(data)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"Writing {self.npy_fn} failed.") from self._error
+
+    def write(self, rows: Union[torch.Tensor, np.ndarray]) -> None:
+        """Appends rows (first dimension) to the array. The rows must not be modified afterwards."""
+        self._check_error()
+        array, dtype_name = _to_numpy(rows)
+        self.dtype_name = self.dtype_name or dtype_name
+        self.rows_written += array.shape[0]
+        self._queue.put(array)
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """Waits until all rows are written and syncs them to disk. Returns the state to resume the array from."""
+        self._queue.join()
+        self._check_error()
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return {'rows': self.rows_written, 'dtype': self.dtype_name}
+
+    def _stop(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def close(self) -> Dict[str, Any]:
+        """Finalizes the array: truncates it to the written rows, writes its .npy and JSON headers."""
+        self._stop()
+        if self._error is not None:
+            self.abort()
+            self._check_error()
+        if self._file is None:
+            # No rows were written
+            self._open(np.empty((0,), dtype=np.float32))
+            self.dtype_name = self.dtype_name or 'float32'
+        shape = (self.rows_written,) + self._row_shape
+        self._file.truncate(_NPY_HEADER_SIZE + int(np.prod(shape)) * self._dtype.itemsize)
+        self._file.seek(0)
+        self._file.write(_npy_header(self._dtype, shape))
+        self._file.close()
+        os.replace(self.tmp_fn, self.npy_fn)
+
+        self._hash.update(f'{self.dtype_name}_{list(shape)}'.encode())
+        model_dir = os.path.normpath(self.model_dir)
+        header = {
+            'version': STORE_VERSION,
+            'dtype': self.dtype_name,
+            'shape': list(shape),
+            'model': self.model if self.model is not None else os.path.basename(model_dir),
+            'dataset': self.dataset if self.dataset is not None else os.path.basename(os.path.dirname(model_dir)),
+            'split': self.split,
+            'hash': self._hash.hexdigest(),
+        }
+        tmp_header_fn = f'{self.header_fn}.{os.getpid()}.tmp'
+        with open(tmp_header_fn, 'w') as f:
+            json.dump(header, f, indent=2)
+        os.replace(tmp_header_fn, self.header_fn)
+        return header
+
+    def abort(self) -> None:
+        """Discards the partially written array. The partial file of a resumable writer is kept."""
+        self._stop()
+        if self._file is not None:
+            self._file.close()
+        if not self.resumable and os.path.exists(self.tmp_fn):
+            os.remove(self.tmp_fn)
+
+    def __enter__(self) -> 'StoreWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_store(model_dir: str, name: str, split: str, data: Union[torch.Tensor, np.ndarray],
+                model: Optional[str] = None, dataset: Optional[str] = None,
+                chunk_rows: int = 1 << 16) -> Dict[str, Any]:
+    """
+    Writes an array (e.g., memory-mapped features of a .pt file) to the store in chunks of rows (see `StoreWriter`),
+    s.t. no second copy of the array is needed. Model and dataset default to the names of the model directory and its
+    parent (feature_root/dataset/model).
+    """
+    with StoreWriter(model_dir, name, split, n_rows=data.shape[0], model=model, dataset=dataset) as writer:
+        for start in range(0, data.shape[0], chunk_rows):
+            # Copy the chunk, s.t. the writer thread reads it while the next chunk is loaded
+            chunk = data[start:start + chunk_rows]
+            writer.write(chunk.clone() if isinstance(chunk, torch.Tensor) else np.array(chunk))
+        if data.shape[0] == 0:
+            writer.write(data)
+    return read_store_header(model_dir, name, split)
+
+
+def load_store(model_dir: str, name: str, split: str, subset_indices: Optional[List[int]] = None,
+               mmap: bool = False) -> torch.Tensor:
+    """
+    Array of the store as a tensor. The file is always memory-mapped: subsets of rows only read the pages of these
+    rows, and with `mmap=True` (and no subset) the returned tensor shares the (copy-on-write) memory map.
+    """
+    header = read_store_header(model_dir, name, split)
+    array = np.load(get_store_paths(model_dir, name, split)[0], mmap_mode='c')
+    if subset_indices:
+        array = array[np.asarray(subset_indices)]
+    elif not mmap:
+        array = np.array(array)
+    tensor = torch.from_numpy(array)
+    if header['dtype'] in _VIEW_DTYPES:
+        tensor = tensor.view(_VIEW_DTYPES[header['dtype']][0])
+    return tensor
+
+
+def convert_pt_store(model_dir: str, split: str, names: Tuple[str, ...] = ('features', 'targets'),
+                     model: Optional[str] = None, dataset: Optional[str] = None, remove: bool = False) -> List[str]:
+    """
+    Converts the {name}_{split}.pt files of a model directory to the store (memory-mapped, s.t. large feature
+    files are copied chunk by chunk). Returns the names of the converted arrays. The .pt files are only removed
+    (if `remove`) once all arrays of the split are converted.
+    """
+    converted = []
+    for name in names:
+        pt_fn = os.path.join(model_dir, f'{name}_{split}.pt')
+        if not os.path.exists(pt_fn) or has_store(model_dir, name, split):
+            continue
+        try:
+            data = torch.load(pt_fn, mmap=True)
+        except (TypeError, RuntimeError):
+            # Older torch versions or legacy (non-zip) files do not support memory-mapped loading
+            data = torch.load(pt_fn)
+        write_store(model_dir, name, split, torch.as_tensor(data), model=model, dataset=dataset)
+        converted.append(name)
+    if remove:
+        for name in names:
+            pt_fn = os.path.join(model_dir, f'{name}_{split}.pt')
+            if os.path.exists(pt_fn) and has_store(model_dir, name, split):
+                os.remove(pt_fn)
+    return converted
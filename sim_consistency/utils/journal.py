@@ -0,0 +1,57 @@
+import json
+import os
+import time
+from threading import Lock
+from typing import Dict, Tuple
+
+
+class PairJournal:
+    """
+    Append-only journal (one JSON line per model pair) of the similarities computed so far. Entries are buffered and
+    written to disk at most every `flush_interval` seconds, s.t. a pre-empted job loses at most that much work.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 60.) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = Lock()
+
+    def read(self) -> Dict[Tuple[str, str], Tuple[str, float]]:
+        """Pair key and value of all journaled pairs. Later entries overwrite earlier ones."""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be incomplete if the job was killed while writing
+                    continue
+                entries[(entry['model1'], entry['model2'])] = (entry['key'], entry['value'])
+        return entries
+
+    def append(self, model1: str, model2: str, key: str, value: float) -> None:
+        entry = json.dumps({'model1': model1, 'model2': model2, 'key': key, 'value': float(value)})
+        with self._lock:
+            self._buffer.append(entry)
+            flush = time.monotonic() - self._last_flush >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._buffer:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a+b') as f:
+                    # A killed job may have left an incomplete last line, which must not swallow the first new entry
+                    size = f.seek(0, os.SEEK_END)
+                    f.seek(max(size - 1, 0))
+                    prefix = '\n' if size > 0 and f.read(1) != b'\n' else ''
+                    f.write((prefix + '\n'.join(self._buffer) + '\n').encode())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._buffer = []
+            self._last_flush = time.monotonic()
@@ -0,0 +1,48 @@
+from typing import Optional
+
+import numpy as np
+import torch
+
+TORCH_DTYPES = {
+    'float64': torch.float64,
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
+# numpy has no bfloat16, hence arrays kept as numpy (e.g., RDMs) can only be stored in float16
+NUMPY_DTYPES = {
+    'float64': np.float64,
+    'float32': np.float32,
+    'float16': np.float16,
+}
+
+
+def get_torch_dtype(name: str) -> torch.dtype:
+    if name not in TORCH_DTYPES:
+        raise ValueError(f"Unknown dtype: {name}")
+    return TORCH_DTYPES[name]
+
+
+def get_numpy_dtype(name: str) -> np.dtype:
+    if name not in NUMPY_DTYPES:
+        raise ValueError(f"Storage dtype {name} is not available for numpy arrays, use one of {list(NUMPY_DTYPES)}.")
+    return np.dtype(NUMPY_DTYPES[name])
+
+
+def is_half(name: Optional[str]) -> bool:
+    return name in ['float16', 'bfloat16']
+
+
+def to_storage(x: torch.Tensor, storage_dtype: str, rescale: bool = True) -> torch.Tensor:
+    """
+    Casts a tensor to its storage dtype. Half precision tensors are divided by their maximum absolute value first
+    (if `rescale`), s.t. large values (e.g., of linear gram matrices) do not overflow in float16. Only use the
+    rescaling for scale-invariant comparisons like CKA or correlations.
+    """
+    dtype = get_torch_dtype(storage_dtype)
+    if is_half(storage_dtype) and rescale:
+        scale = x.abs().max()
+        if scale > 0:
+            x = x / scale
+    return x.to(dtype)
@@ -1,8 +1,10 @@
 import argparse
+import hashlib
 import json
 import os
 import random
 import sqlite3
+import warnings
 from itertools import product
 from pathlib import Path
 from typing import Any
@@ -14,6 +16,7 @@ import torch
 
 from sim_consistency.data.builder import get_dataset_collection_from_file, get_dataset_collection
 from sim_consistency.data.constants import probe_dataset_map
+from sim_consistency.utils.feature_store import has_store, load_store, read_store_header
 
 
 def as_list(l):
@@ -26,15 +29,43 @@ def get_subset_data(data: torch.Tensor, subset_indices: List[int]) -> torch.Tens
     return data[subset_indices]
 
 
+def _load_tensor(fn: str, mmap: bool = False) -> torch.Tensor:
+    if mmap:
+        try:
+            return torch.load(fn, mmap=True)
+        except (TypeError, RuntimeError):
+            # Older torch versions or legacy (non-zip) files do not support memory-mapped loading
+            warnings.warn(f"{fn} cannot be memory-mapped and is loaded into memory completely. Convert it to the "
+                          "feature store with scripts/convert_feature_store.py to only read the accessed rows.")
+    return torch.load(fn)
+
+
+def has_array(model_dir: str, name: str = 'features', split: str = 'train') -> bool:
+    """Whether the features (or targets) of a split exist, either in the feature store or as .pt file."""
+    return has_store(model_dir, name, split) or os.path.exists(os.path.join(model_dir, f'{name}_{split}.pt'))
+
+
 def load_features(
         feature_root: str,
         model_id: Optional[str] = None,
         split: str = 'train',
         subset_indices: Optional[List[int]] = None,
-        verbose: bool = False
+        verbose: bool = False,
+        mmap: bool = False,
 ) -> torch.Tensor:
+    """
+    Features of a model. With `mmap=True`, the file is memory-mapped and rows are only read when accessed. Features
+    in the feature store (.npy + JSON header, see `sim_consistency.utils.feature_store`) are preferred over .pt files,
+    their subsets only read the rows of the subset.
+    """
     model_dir = os.path.join(feature_root, model_id) if model_id else feature_root
-    features = torch.load(os.path.join(model_dir, f'features_{split}.pt'))
+    if has_store(model_dir, 'features', split):
+        features = load_store(model_dir, 'features', split, subset_indices, mmap=mmap)
+        if verbose:
+            print(f"Loaded features for {model_id} with shape {features.shape}")
+        return features
+
+    features = _load_tensor(os.path.join(model_dir, f'features_{split}.pt'), mmap=mmap)
 
     if verbose:
         print(f"Loaded features for {model_id} with shape {features.shape}")
@@ -47,6 +78,46 @@ def load_features(
     return features
 
 
+def get_feature_shape(
+        feature_root: str,
+        model_id: Optional[str] = None,
+        split: str = 'train',
+        subset_indices: Optional[List[int]] = None,
+) -> Tuple[int, int]:
+    """Number of samples and feature dimension without reading the full feature file."""
+    model_dir = os.path.join(feature_root, model_id) if model_id else feature_root
+    if has_store(model_dir, 'features', split):
+        shape = read_store_header(model_dir, 'features', split)['shape']
+    else:
+        shape = _load_tensor(os.path.join(model_dir, f'features_{split}.pt'), mmap=True).shape
+    n_samples = len(subset_indices) if subset_indices else shape[0]
+    return n_samples, shape[1]
+
+
+_FILE_HASHES = {}
+
+
+def get_file_hash(path: str, chunk_size: int = 1 << 24) -> str:
+    """Content hash of a file. Memoized per process as long as the size and modification time do not change."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _FILE_HASHES:
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        _FILE_HASHES[memo_key] = h.hexdigest()
+    return _FILE_HASHES[memo_key]
+
+
+def get_feature_hash(feature_root: str, model_id: Optional[str] = None, split: str = 'train') -> str:
+    """Content hash of the features. Read from the header for the feature store, .pt files are hashed."""
+    model_dir = os.path.join(feature_root, model_id) if model_id else feature_root
+    if has_store(model_dir, 'features', split):
+        return read_store_header(model_dir, 'features', split)['hash']
+    return get_file_hash(os.path.join(model_dir, f'features_{split}.pt'))
+
+
 def load_targets(
         feature_root: str,
         model_id: Optional[str] = None,
@@ -55,6 +126,8 @@ def load_targets(
         verbose: bool = False
 ) -> torch.Tensor:
     model_dir = os.path.join(feature_root, model_id) if model_id else feature_root
+    if has_store(model_dir, 'targets', split):
+        return load_store(model_dir, 'targets', split, subset_indices)
     targets = torch.load(os.path.join(model_dir, f'targets_{split}.pt'))
     if subset_indices:
         targets = get_subset_data(targets, subset_indices)
@@ -95,7 +168,7 @@ def check_models(feature_root, model_ids, split):
     prev_model_ids = model_ids
 
     model_ids = sorted(
-        [mid for mid in model_ids if os.path.exists(os.path.join(feature_root, mid, f'features_{split}.pt'))])
+        [mid for mid in model_ids if has_array(os.path.join(feature_root, mid), 'features', split)])
 
     if len(set(prev_model_ids)) != len(set(model_ids)):
         print(f"Features do not exist for the following models: {set(prev_model_ids) - set(model_ids)}")
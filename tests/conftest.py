@@ -0,0 +1,24 @@
+import os
+
+import pytest
+import torch
+
+
+@pytest.fixture
+def feature_root(tmp_path):
+    """Features of 5 models (of different dimensions, with a shared structure) on 60 samples of one dataset."""
+    generator = torch.Generator().manual_seed(0)
+    base = torch.randn(60, 8, generator=generator)
+    for i, dim in enumerate([8, 16, 12, 20, 10]):
+        features = base @ torch.randn(8, dim, generator=generator) + 0.5 * (i + 1) * torch.randn(
+            60, dim, generator=generator)
+        model_dir = tmp_path / 'features' / f'model_{i}'
+        os.makedirs(model_dir)
+        torch.save(features, model_dir / 'features_train.pt')
+        torch.save(torch.arange(60) % 5, model_dir / 'targets_train.pt')
+    return str(tmp_path / 'features')
+
+
+@pytest.fixture
+def model_ids():
+    return [f'model_{i}' for i in range(5)]
@@ -0,0 +1,103 @@
+import io
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, TensorDataset
+
+from sim_consistency.models.featurizer import Featurizer
+from sim_consistency.utils.feature_store import read_store_header
+from sim_consistency.utils.utils import load_features, load_targets
+
+wds = pytest.importorskip('webdataset')
+
+
+class LinearModel(torch.nn.Module):
+    """Linear image encoder raising KeyboardInterrupt on the (`n_fail` + 1)-th batch."""
+
+    def __init__(self, n_fail=None):
+        super().__init__()
+        self.linear = torch.nn.Linear(12, 5)
+        torch.nn.init.normal_(self.linear.weight, generator=torch.Generator().manual_seed(0))
+        torch.nn.init.zeros_(self.linear.bias)
+        self.n_fail = n_fail
+        self.calls = 0
+
+    def encode_image(self, x):
+        self.calls += 1
+        if self.n_fail is not None and self.calls > self.n_fail:
+            raise KeyboardInterrupt
+        return self.linear(x.flatten(1)[:, :12].float())
+
+
+def _extract(make_loader, feature_dir, n_fail=None):
+    """Extracts the features, after a first run interrupted after `n_fail` batches. Returns the resumed batches."""
+    if n_fail is not None:
+        with pytest.raises(KeyboardInterrupt):
+            Featurizer(LinearModel(n_fail)).feature_extraction(make_loader(), None, feature_dir, 'cpu',
+                                                               checkpoint_interval=0)
+    featurizer = Featurizer(LinearModel())
+    featurizer.feature_extraction(make_loader(), None, feature_dir, 'cpu', checkpoint_interval=0)
+    return featurizer.model.calls
+
+
+def _assert_same_store(feature_dir, ref_dir):
+    assert torch.equal(load_features(feature_dir, split='train'), load_features(ref_dir, split='train'))
+    assert torch.equal(load_targets(feature_dir, split='train'), load_targets(ref_dir, split='train'))
+    assert read_store_header(feature_dir, 'features', 'train')['hash'] == read_store_header(
+        ref_dir, 'features', 'train')['hash']
+    assert not any(fn.endswith(('.partial.npy', '.manifest.json')) for fn in os.listdir(feature_dir))
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_map_style_resume_equals_full_run(tmp_path, num_workers):
+    generator = torch.Generator().manual_seed(0)
+    dataset = TensorDataset(torch.randn(1003, 12, generator=generator), torch.randint(0, 10, (1003,)))
+
+    def make_loader():
+        return DataLoader(dataset, batch_size=64, num_workers=num_workers)
+
+    _extract(make_loader, str(tmp_path / 'ref'))
+    calls = _extract(make_loader, str(tmp_path / 'resumed'), n_fail=7)
+    assert calls == 16 - 7
+    _assert_same_store(str(tmp_path / 'resumed'), str(tmp_path / 'ref'))
+
+
+@pytest.fixture(scope='module')
+def wds_root(tmp_path_factory):
+    """5 webdataset shards of unequal sizes with 4x4 PNG images."""
+    root = tmp_path_factory.mktemp('wds')
+    os.makedirs(root / 'train')
+    rng = np.random.default_rng(0)
+    key = 0
+    for shard, n_samples in enumerate([37, 41, 23, 50, 30]):
+        with wds.TarWriter(str(root / 'train' / f'{shard}.tar')) as writer:
+            for _ in range(n_samples):
+                buffer = io.BytesIO()
+                Image.fromarray(rng.integers(0, 255, (4, 4, 3), dtype=np.uint8)).save(buffer, 'png')
+                writer.write({'__key__': f'{key:06d}', 'png': buffer.getvalue(), 'cls': str(key % 7).encode()})
+                key += 1
+    (root / 'train' / 'nshards.txt').write_text('5')
+    return str(root)
+
+
+@pytest.mark.parametrize('num_workers,batch_size', [(0, 16), (2, 8), (3, 10)])
+def test_webdataset_resume_equals_full_run(tmp_path, wds_root, num_workers, batch_size):
+    from sim_consistency.data.builder import build_wds_dataset
+
+    def transform(image):
+        return torch.from_numpy(np.asarray(image, dtype=np.float32)).permute(2, 0, 1)
+
+    def make_loader():
+        dataset = build_wds_dataset(transform, split='train', data_dir=wds_root, label_map=int)
+        return DataLoader(dataset.batched(batch_size), batch_size=None, num_workers=num_workers)
+
+    ref_dir = str(tmp_path / 'ref')
+    n_batches = _extract(make_loader, ref_dir)
+    # Interruptions early, midway and around the exhaustion of the shards of the first workers
+    for n_fail in sorted({3, n_batches // 2, n_batches - 3, n_batches - 2, n_batches - 1}):
+        feature_dir = str(tmp_path / f'resumed_{n_fail}')
+        _extract(make_loader, feature_dir, n_fail=n_fail)
+        _assert_same_store(feature_dir, ref_dir)
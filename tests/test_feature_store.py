@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from sim_consistency.utils.feature_store import StoreWriter, load_store, read_store_header, write_store
+
+
+def _write_interrupted(model_dir, name, data, n_synced, n_lost):
+    """Writes `n_synced` rows and a checkpoint, then `n_lost` rows that are never synced, and aborts."""
+    writer = StoreWriter(model_dir, name, 'train', n_rows=data.shape[0], resumable=True)
+    for start in range(0, n_synced, 10):
+        writer.write(data[start:min(start + 10, n_synced)].clone())
+    state = writer.checkpoint()
+    writer.write(data[n_synced:n_synced + n_lost].clone())
+    writer.abort()
+    return state
+
+
+@pytest.mark.parametrize('data', [torch.randn(95, 7), torch.arange(95) % 4, torch.randn(95, 3).to(torch.bfloat16)])
+def test_resumed_store_equals_single_write(tmp_path, data):
+    write_store(str(tmp_path / 'ref'), 'features', 'train', data)
+    model_dir = str(tmp_path / 'resumed')
+    state = _write_interrupted(model_dir, 'features', data, n_synced=40, n_lost=25)
+    assert state['rows'] == 40
+    assert not os.path.exists(os.path.join(model_dir, 'features_train.npy'))
+
+    with StoreWriter(model_dir, 'features', 'train', n_rows=data.shape[0], resume_from=state) as writer:
+        writer.write(data[40:].clone())
+
+    assert torch.equal(load_store(model_dir, 'features', 'train'), data)
+    header, ref_header = read_store_header(model_dir, 'features', 'train'), read_store_header(
+        str(tmp_path / 'ref'), 'features', 'train')
+    assert header['hash'] == ref_header['hash']
+    assert header['shape'] == ref_header['shape']
+    assert sorted(os.listdir(model_dir)) == ['features_train.json', 'features_train.npy']
+
+
+def test_resume_from_missing_rows_fails(tmp_path):
+    data = torch.randn(50, 4)
+    model_dir = str(tmp_path)
+    state = _write_interrupted(model_dir, 'features', data, n_synced=20, n_lost=0)
+    with pytest.raises(ValueError):
+        StoreWriter(model_dir, 'features', 'train', resume_from=dict(state, rows=60))
+
+
+def test_store_is_only_committed_on_success(tmp_path):
+    model_dir = str(tmp_path)
+    with pytest.raises(KeyboardInterrupt):
+        with StoreWriter(model_dir, 'features', 'train', n_rows=30) as writer:
+            writer.write(torch.randn(10, 4))
+            raise KeyboardInterrupt
+    assert os.listdir(model_dir) == []
+
+    with StoreWriter(model_dir, 'features', 'train', n_rows=30) as writer:
+        writer.write(torch.randn(10, 4))
+        writer.checkpoint()
+        assert not os.path.exists(os.path.join(model_dir, 'features_train.json'))
+    # Fewer rows than preallocated are truncated
+    assert np.load(os.path.join(model_dir, 'features_train.npy')).shape == (10, 4)
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from sim_consistency.tasks import compute_sim_matrices, save_similarity_results
+from sim_consistency.tasks import model_similarity
+from sim_consistency.utils.journal import PairJournal
+
+CONFIGS = [dict(sim_method='cka', kernel='linear'), dict(sim_method='rsa'),
+           dict(sim_method='gw', gw_fixed_coupling=True, max_workers=1)]
+
+
+def _count_pairs(monkeypatch, fail_after=None):
+    """Counts the computed pairs, optionally interrupting the run (after journaling) after `fail_after` pairs."""
+    record_pair = model_similarity.BaseModelSimilarity._record_pair
+    calls = [0]
+
+    def counting_record_pair(self, *args):
+        record_pair(self, *args)
+        calls[0] += 1
+        if fail_after is not None and calls[0] == fail_after:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(model_similarity.BaseModelSimilarity, '_record_pair', counting_record_pair)
+    return calls
+
+
+def test_journal_skips_torn_line(tmp_path):
+    path = str(tmp_path / 'pair_journal.jsonl')
+    journal = PairJournal(path)
+    journal.append('a', 'b', 'key', 1.)
+    journal.flush()
+    with open(path, 'a') as f:
+        f.write('{"model1": "a", "mod')
+
+    journal = PairJournal(path)
+    journal.append('a', 'c', 'key', 2.)
+    journal.flush()
+    assert PairJournal(path).read() == {('a', 'b'): ('key', 1.), ('a', 'c'): ('key', 2.)}
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+@pytest.mark.parametrize('recompute', [False, True])
+def test_journal_resume_equals_full_run(tmp_path, monkeypatch, feature_root, model_ids, config, recompute):
+    full, _, _ = compute_sim_matrices(feature_root=feature_root, model_ids=model_ids, split='train', device='cpu',
+                                      **config)
+    results_root = str(tmp_path / 'results')
+    kwargs = dict(feature_root=feature_root, model_ids=model_ids, split='train', device='cpu',
+                  results_root=results_root, recompute=recompute, **config)
+
+    _count_pairs(monkeypatch, fail_after=4)
+    with pytest.raises(KeyboardInterrupt):
+        compute_sim_matrices(checkpoint_interval=1000., **kwargs)
+    calls = _count_pairs(monkeypatch)
+    sim_mats, ids, pair_keys = compute_sim_matrices(**kwargs)
+
+    assert calls[0] == len(model_ids) * (len(model_ids) - 1) // 2 - 4
+    for name, sim_mat in sim_mats.items():
+        np.testing.assert_allclose(sim_mat, full[name], rtol=0, atol=1e-6)
+        save_similarity_results(os.path.join(results_root, name), sim_mat, ids, pair_keys[name])
+        assert not any(fn.startswith('pair_journal') for fn in os.listdir(os.path.join(results_root, name)))
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+def test_shard_merge_equals_full_run(tmp_path, monkeypatch, feature_root, model_ids, config):
+    full, _, _ = compute_sim_matrices(feature_root=feature_root, model_ids=model_ids, split='train', device='cpu',
+                                      **config)
+    kwargs = dict(feature_root=feature_root, model_ids=model_ids, split='train', device='cpu',
+                  results_root=str(tmp_path / 'results'), **config)
+    with pytest.raises(RuntimeError):
+        compute_sim_matrices(merge=True, **kwargs)
+
+    calls = _count_pairs(monkeypatch)
+    for shard_index in range(3):
+        compute_sim_matrices(shard=(shard_index, 3), **kwargs)
+    assert calls[0] == len(model_ids) * (len(model_ids) - 1) // 2
+
+    sim_mats, _, _ = compute_sim_matrices(merge=True, **kwargs)
+    assert calls[0] == len(model_ids) * (len(model_ids) - 1) // 2
+    for name, sim_mat in sim_mats.items():
+        np.testing.assert_allclose(sim_mat, full[name], rtol=0, atol=1e-6)
+
+
+def test_previous_results_are_reused(tmp_path, monkeypatch, feature_root, model_ids):
+    results_root = str(tmp_path / 'results')
+    kwargs = dict(feature_root=feature_root, split='train', device='cpu', results_root=results_root,
+                  sim_method='cka', kernel='linear')
+    sim_mats, ids, pair_keys = compute_sim_matrices(model_ids=model_ids[:3], **kwargs)
+    for name, sim_mat in sim_mats.items():
+        save_similarity_results(os.path.join(results_root, name), sim_mat, ids, pair_keys[name])
+
+    calls = _count_pairs(monkeypatch)
+    compute_sim_matrices(model_ids=model_ids, **kwargs)
+    # Only the pairs with the two new models are computed
+    assert calls[0] == 3 * 2 + 1
+    calls[0] = 0
+    compute_sim_matrices(model_ids=model_ids, recompute=True, **kwargs)
+    assert calls[0] == len(model_ids) * (len(model_ids) - 1) // 2